@@ -0,0 +1,187 @@
+"""
+Timings of the hot paths for one size of synthetic data, run by run_benchmarks.py
+in a process of its own with REFERENCE_DATA_DIR pointing at the data (the
+reference store reads it when imported). Prints the timings as JSON.
+
+Usage:
+    REFERENCE_DATA_DIR=benchmarks/data/national-seed0/build_data \
+        python -m benchmarks.hot_paths --service-file benchmarks/data/national-seed0/services.csv --repeat 5
+"""
+import argparse
+import json
+import statistics
+import time
+
+import pandas as pd
+
+from pages.page_functions import pop_data_ETL_functions as pop_ETL
+from pages.page_functions import map_functions as map_func
+from pages.page_functions import reference_data as ref_data
+from pages.page_functions import reference_store as ref_store
+from pages.page_functions import forecast_engine
+from pages.page_functions import compact_projections
+
+GEOGRAPHY_LEVEL = 'District Authority or Place'
+MIN_AGE = 18
+MAX_AGE = 65
+BASELINE_YEAR = 2024
+FORECAST_YEAR = 2030
+GENDER = 'Persons'
+BASELINE_PREVALENCE = 500
+FORECAST_PREVALENCE = 600
+
+#----------------------------------------------
+
+def prepare(service_path):
+    """
+    Inputs shared by the benchmarks: every district selected, as the pages do by default,
+    and the output of each pipeline stage for the stage after it.
+    """
+    ctx = {}
+    ctx['pop_df'] = ref_data.get_pop_projections(GEOGRAPHY_LEVEL)
+    ctx['areas'] = sorted(ctx['pop_df'].locations)
+    ctx['service_df'] = pd.read_csv(service_path, encoding='utf-8-sig')
+    ctx['df_imd'] = ref_data.get_reference_data()['lookups']['df_imd_decile']
+
+    population_params = (ctx['areas'], MIN_AGE, MAX_AGE, BASELINE_YEAR, FORECAST_YEAR, GENDER)
+    ctx['df_lsoa'] = pop_ETL.load_and_process_baseline_data(GENDER, GEOGRAPHY_LEVEL, ctx['areas'], MIN_AGE, MAX_AGE)
+    ctx['df_by_age'] = pop_ETL.forecast_population_by_age(ctx['pop_df'], *population_params)
+    ctx['df_forecast'] = pop_ETL.apply_percent_changes_iteratively(ctx['df_lsoa'], ctx['df_by_age'], GEOGRAPHY_LEVEL)
+    df_need = pop_ETL.calculate_and_insert_needs(ctx['df_forecast'].copy(), BASELINE_PREVALENCE, FORECAST_PREVALENCE)
+    ctx['df_need'] = df_need
+    ctx['df_imd_merged'] = pop_ETL.merge_imd_decile(df_need, ctx['df_imd'])
+    df_attributes = map_func.convert_deciles_to_quintiles(ctx['df_imd_merged'].copy(), 'IMD Decile')
+
+    ctx['geometry_store'] = ref_data.get_lsoa_geometry_store(len(df_attributes))
+    df_map_attributes = pop_ETL.map_attributes_stage(df_attributes, ctx['geometry_store'])
+    ctx['df_imd_values'] = df_map_attributes[['LSOA21CD', 'IMD Quintile']]
+    ctx['df_change_values'] = df_map_attributes[['LSOA21CD', 'Net Need Change']]
+    ctx['n_lsoas'] = len(ctx['df_lsoa'])
+    return ctx
+
+#----------------------------------------------
+#each benchmark returns (setup, run): setup() makes the arguments for one run (not timed)
+
+def no_setup():
+    return ()
+
+
+def bench_build_projection_cube(ctx):
+    return no_setup, lambda: forecast_engine.build_projection_cube(ctx['pop_df'])
+
+
+def bench_compact_projections(ctx):
+    df = ctx['pop_df'].to_frame()
+    return no_setup, lambda: compact_projections.compact_projections_from_frame(df)
+
+
+def bench_forecast_population(ctx):
+    return no_setup, lambda: pop_ETL.forecast_population(
+        ctx['pop_df'], ctx['areas'], MIN_AGE, MAX_AGE, BASELINE_YEAR, FORECAST_YEAR, GENDER)
+
+
+def bench_forecast_population_by_age(ctx):
+    return no_setup, lambda: pop_ETL.forecast_population_by_age(
+        ctx['pop_df'], ctx['areas'], MIN_AGE, MAX_AGE, BASELINE_YEAR, FORECAST_YEAR, GENDER)
+
+
+def bench_calculate_population_changes(ctx):
+    return (lambda: (ctx['service_df'].copy(),),
+            lambda service_df: pop_ETL.calculate_population_changes(service_df, ctx['pop_df'], BASELINE_YEAR, FORECAST_YEAR))
+
+
+def bench_load_and_process_baseline_data(ctx):
+    def setup():
+        #a baseline not held in memory is read from the store on every run, not from the cache of recent reads
+        ref_data.load_baseline_for_utlas.clear()
+        return ()
+    return setup, lambda: pop_ETL.load_and_process_baseline_data(GENDER, GEOGRAPHY_LEVEL, ctx['areas'], MIN_AGE, MAX_AGE)
+
+
+def bench_apply_percent_changes_iteratively(ctx):
+    return no_setup, lambda: pop_ETL.apply_percent_changes_iteratively(ctx['df_lsoa'], ctx['df_by_age'], GEOGRAPHY_LEVEL)
+
+
+def bench_calculate_and_insert_needs(ctx):
+    return (lambda: (ctx['df_forecast'].copy(),),
+            lambda df: pop_ETL.calculate_and_insert_needs(df, BASELINE_PREVALENCE, FORECAST_PREVALENCE))
+
+
+def bench_merge_imd_decile(ctx):
+    return no_setup, lambda: pop_ETL.merge_imd_decile(ctx['df_need'], ctx['df_imd'])
+
+
+def bench_convert_deciles_to_quintiles(ctx):
+    return (lambda: (ctx['df_imd_merged'].copy(),),
+            lambda df: map_func.convert_deciles_to_quintiles(df, 'IMD Decile'))
+
+
+def bench_heatmap_html(ctx):
+    return no_setup, lambda: pop_ETL.heatmap_html_stage(ctx['df_imd_values'], ctx['geometry_store'], False)
+
+
+def bench_net_change_map_html(ctx):
+    return no_setup, lambda: pop_ETL.net_change_map_html_stage(ctx['df_change_values'], ctx['geometry_store'], False)
+
+
+BENCHMARKS = {
+    'build_projection_cube': bench_build_projection_cube,
+    'compact_projections': bench_compact_projections,
+    'forecast_population': bench_forecast_population,
+    'forecast_population_by_age': bench_forecast_population_by_age,
+    'calculate_population_changes': bench_calculate_population_changes,
+    'load_and_process_baseline_data': bench_load_and_process_baseline_data,
+    'apply_percent_changes_iteratively': bench_apply_percent_changes_iteratively,
+    'calculate_and_insert_needs': bench_calculate_and_insert_needs,
+    'merge_imd_decile': bench_merge_imd_decile,
+    'convert_deciles_to_quintiles': bench_convert_deciles_to_quintiles,
+    'heatmap_html': bench_heatmap_html,
+    'net_change_map_html': bench_net_change_map_html,
+}
+
+#----------------------------------------------
+
+def time_benchmark(setup, run, repeat):
+    """
+    Seconds taken by each of repeat runs, after one untimed warm up run.
+    """
+    run(*setup())
+    seconds = []
+    for _ in range(repeat):
+        args = setup()
+        start = time.perf_counter()
+        run(*args)
+        seconds.append(time.perf_counter() - start)
+    return seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the hot paths on the reference data in REFERENCE_DATA_DIR.')
+    parser.add_argument('--service-file', required=True, help='Service coverage file for calculate_population_changes.')
+    parser.add_argument('--repeat', type=int, default=5, help='Timed runs of each benchmark (default: 5).')
+    parser.add_argument('--benchmarks', nargs='+', choices=list(BENCHMARKS), default=list(BENCHMARKS),
+                        help='Benchmarks to run (default: all).')
+    args = parser.parse_args()
+
+    #the store is rebuilt from the csv files once, timed as the ingestion benchmark
+    start = time.perf_counter()
+    ref_store.build_reference_store(force=True)
+    build_seconds = time.perf_counter() - start
+    ctx = prepare(args.service_file)
+
+    results = [{'benchmark': 'build_reference_store', 'runs': [build_seconds],
+                'min': build_seconds, 'median': build_seconds, 'mean': build_seconds}]
+    for name in args.benchmarks:
+        seconds = time_benchmark(*BENCHMARKS[name](ctx), args.repeat)
+        results.append({
+            'benchmark': name,
+            'runs': seconds,
+            'min': min(seconds),
+            'median': statistics.median(seconds),
+            'mean': statistics.mean(seconds),
+        })
+    print(json.dumps({'n_lsoas': ctx['n_lsoas'], 'n_districts': len(ctx['areas']), 'results': results}))
+
+
+if __name__ == '__main__':
+    main()
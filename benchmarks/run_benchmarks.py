@@ -0,0 +1,207 @@
+"""
+Benchmarks of the hot paths of the pages and the command line tools, on
+synthetic data at a few sizes up to national scale (see synthetic_data.py).
+
+Each size is written once to benchmarks/data/<size>-seed<seed>/ as a build_data
+directory (and reused on later runs), then timed in a process of its own
+(see hot_paths.py). The timings are saved to benchmarks/results/ as JSON
+named by date and git commit, and each benchmark is compared with its latest
+earlier result on the same machine, so a slowdown between versions shows up
+as a ratio above --threshold.
+
+Usage (from the repo root):
+    python -m benchmarks.run_benchmarks
+    python -m benchmarks.run_benchmarks --sizes small medium --repeat 3
+    python -m benchmarks.run_benchmarks --benchmarks forecast_population merge_imd_decile
+    python -m benchmarks.run_benchmarks --sizes small --compare benchmarks/results/<earlier results>.json
+"""
+import argparse
+import datetime
+import glob
+import json
+import os
+import platform
+import subprocess
+import sys
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from benchmarks import synthetic_data
+from benchmarks.hot_paths import BENCHMARKS
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCHMARK_DIR)
+DATA_DIR = os.path.join(BENCHMARK_DIR, 'data')
+RESULTS_DIR = os.path.join(BENCHMARK_DIR, 'results')
+
+#size name -> number of UTLAs (150 is about the size of England)
+SIZES = {
+    'small': 2,
+    'medium': 20,
+    'national': 150,
+}
+
+SERVICES_PER_FILE = 200
+
+#----------------------------------------------
+
+def git(*args):
+    try:
+        return subprocess.run(['git', *args], cwd=REPO_ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def commit_label():
+    """
+    Short hash of HEAD, with '+dirty' if the tracked files have changes.
+    """
+    commit = git('rev-parse', '--short', 'HEAD') or 'unknown'
+    return commit + ('+dirty' if git('status', '--porcelain', '--untracked-files=no') else '')
+
+
+def machine_info():
+    return {
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'pyarrow': pa.__version__,
+    }
+
+#----------------------------------------------
+
+def size_data(size, seed):
+    """
+    Write the synthetic data for a size (unless already written).
+
+    Returns:
+    tuple: (build_data directory, service coverage file)
+    """
+    size_dir = os.path.join(DATA_DIR, f'{size}-seed{seed}')
+    build_data_dir = os.path.join(size_dir, 'build_data')
+    service_path = os.path.join(size_dir, 'services.csv')
+    if not os.path.exists(service_path):
+        print(f'writing {size} synthetic data to {size_dir}', file=sys.stderr)
+        synthetic_data.write_reference_data(build_data_dir, SIZES[size], seed)
+        lookup = pd.read_csv(os.path.join(build_data_dir, 'lookups', 'lsoa_2021_to_la_district.csv'), encoding='utf-8-sig')
+        synthetic_data.write_service_file(service_path, list(lookup['LAD23NM'].unique()), SERVICES_PER_FILE, seed)
+    return build_data_dir, service_path
+
+
+def run_size(size, seed, repeat, benchmarks):
+    """
+    Time the benchmarks on one size of data, in a process of its own.
+    """
+    build_data_dir, service_path = size_data(size, seed)
+    env = dict(os.environ, REFERENCE_DATA_DIR=build_data_dir, FORECAST_DISK_CACHE_MB='0')
+    command = [sys.executable, '-m', 'benchmarks.hot_paths', '--service-file', service_path,
+               '--repeat', str(repeat), '--benchmarks', *benchmarks]
+    completed = subprocess.run(command, cwd=REPO_ROOT, env=env, capture_output=True, text=True)
+    if completed.returncode != 0:
+        raise RuntimeError(f'{size} benchmarks failed:\n{completed.stderr}')
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+#----------------------------------------------
+
+def medians(results):
+    """
+    (size, benchmark) -> (median seconds, commit) for a results dict.
+    """
+    return {(size, result['benchmark']): (result['median'], results['commit'])
+            for size, size_results in results['sizes'].items() for result in size_results['results']}
+
+
+def previous_medians(machine, paths=None):
+    """
+    Latest median of each (size, benchmark) in the results files (default: every file in
+    RESULTS_DIR), counting only results from the same machine unless the files are given.
+    """
+    found = {}
+    for path in sorted(paths or glob.glob(os.path.join(RESULTS_DIR, '*.json'))):
+        with open(path) as f:
+            results = json.load(f)
+        if paths or results.get('machine') == machine:
+            found.update(medians(results))
+    return found
+
+
+def comparison(results, previous, threshold):
+    """
+    Median of each benchmark now and before, with the ratio of the two.
+    """
+    rows = []
+    for (size, name), (median, _) in medians(results).items():
+        previous_median, previous_commit = previous.get((size, name), (None, None))
+        ratio = median / previous_median if previous_median else None
+        if ratio is None:
+            change = 'new'
+        elif ratio > threshold:
+            change = 'SLOWER'
+        elif ratio < 1 / threshold:
+            change = 'faster'
+        else:
+            change = ''
+        rows.append({'size': size, 'benchmark': name, 'median (s)': median, 'previous (s)': previous_median,
+                     'previous commit': previous_commit, 'ratio': ratio, 'change': change})
+    return pd.DataFrame(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the hot paths on synthetic data and compare with earlier results.')
+    parser.add_argument('--sizes', nargs='+', choices=list(SIZES), default=list(SIZES), help='Sizes of data (default: all).')
+    parser.add_argument('--benchmarks', nargs='+', choices=list(BENCHMARKS), default=list(BENCHMARKS),
+                        help='Benchmarks to run (default: all).')
+    parser.add_argument('--repeat', type=int, default=5, help='Timed runs of each benchmark (default: 5).')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the synthetic data (default: 0).')
+    parser.add_argument('--compare', nargs='+', default=None,
+                        help='Results file(s) to compare with (default: the latest results from this machine in benchmarks/results).')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help='Ratio of medians flagged as slower (or, inverted, faster) (default: 1.25).')
+    parser.add_argument('--no-save', action='store_true', help='Do not save the results.')
+    args = parser.parse_args()
+
+    machine = machine_info()
+    previous = previous_medians(machine, args.compare)
+
+    results = {
+        'commit': commit_label(),
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'machine': machine,
+        'repeat': args.repeat,
+        'seed': args.seed,
+        'sizes': {},
+    }
+    for size in args.sizes:
+        print(f'running {size} benchmarks', file=sys.stderr)
+        results['sizes'][size] = run_size(size, args.seed, args.repeat, args.benchmarks)
+
+    summary = pd.DataFrame([
+        {'size': size, 'lsoas': size_results['n_lsoas'], 'benchmark': result['benchmark'],
+         'median (s)': result['median'], 'min (s)': result['min']}
+        for size, size_results in results['sizes'].items() for result in size_results['results']])
+    print(summary.to_string(index=False, float_format=lambda x: f'{x:.4f}'))
+
+    if previous:
+        df_comparison = comparison(results, previous, args.threshold)
+        print(f'\ncompared with earlier results (ratios above {args.threshold} are SLOWER):')
+        print(df_comparison.to_string(index=False, float_format=lambda x: f'{x:.4f}'))
+        n_slower = (df_comparison['change'] == 'SLOWER').sum()
+        if n_slower:
+            print(f'\n{n_slower} benchmark(s) slower than before', file=sys.stderr)
+
+    if not args.no_save:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+        path = os.path.join(RESULTS_DIR, f"{stamp}_{results['commit']}.json")
+        with open(path, 'w') as f:
+            json.dump(results, f, indent=1)
+        print(f'\nresults saved to {path}')
+
+
+if __name__ == '__main__':
+    main()
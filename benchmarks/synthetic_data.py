@@ -0,0 +1,213 @@
+"""
+Synthetic reference data for the benchmarks, laid out as build_data/ and zTestData/.
+
+write_reference_data writes every file the reference store is built from
+(population projections, LSOA baselines, lookups, IMD deciles and an LSOA
+boundary shapefile) for a made-up country of n_utlas upper tier authorities,
+with the same columns, formats and quirks (quoted thousands, byte order
+marks) as the real ONS / NOMIS downloads. 150 UTLAs is about the size of
+England (~33k LSOAs). write_service_file writes a service coverage file in
+the layout of zTestData/dummy_data_service_age_coverage_with_WTE.csv.
+"""
+import os
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+AGES = list(range(91))
+YEARS = list(range(2024, 2044))
+BASELINE_YEAR = 2022
+GENDERS = ['Persons', 'Males', 'Females']
+
+#the real projection files label gender as 'Male' / 'Female' in places
+PROJECTION_GENDER_LABELS = {'Persons': 'Persons', 'Males': 'Male', 'Females': 'Female'}
+
+#every third UTLA is a unitary authority (one district of the same name), the rest have this many districts
+DISTRICTS_PER_COUNTY = 4
+LSOAS_PER_UNITARY = 180
+LSOAS_PER_DISTRICT = 60
+
+#size of each (square) LSOA in the boundary shapefile, in metres
+LSOA_SIZE = 1000
+
+#----------------------------------------------
+
+def synthetic_geography(n_utlas, rng):
+    """
+    One row per LSOA with its code, name, district and UTLA.
+    """
+    rows = []
+    for u in range(n_utlas):
+        utla = f'Synthetic UTLA {u:03d}'
+        if u % 3 == 0:
+            districts = [(utla, LSOAS_PER_UNITARY)]
+        else:
+            districts = [(f'Synthetic District {u:03d}{chr(65 + d)}', LSOAS_PER_DISTRICT) for d in range(DISTRICTS_PER_COUNTY)]
+        for district, n_lsoas in districts:
+            for j in range(max(1, int(rng.normal(n_lsoas, n_lsoas / 10)))):
+                rows.append((district, utla, f'{district} {j:03d}A'))
+
+    df = pd.DataFrame(rows, columns=['LAD23NM', 'utla_name', 'LSOA21NM'])
+    df.insert(0, 'LSOA21CD', [f'E{1000000 + i:08d}' for i in range(len(df))])
+    district_codes = {name: f'E{7000000 + i:08d}' for i, name in enumerate(df['LAD23NM'].unique())}
+    df['LAD23CD'] = df['LAD23NM'].map(district_codes)
+    return df
+
+
+def age_profile():
+    """
+    Share of the population at each single year of age (flat to 60, then tailing off).
+    """
+    weights = np.where(np.arange(len(AGES)) < 60, 1.0, np.exp(-(np.arange(len(AGES)) - 60) / 12))
+    weights[-1] *= 3    #90 is 90 and over
+    return weights / weights.sum()
+
+
+def synthetic_baselines(df_geography, rng):
+    """
+    Male and female population of each LSOA by single year of age, int64 [LSOA, age].
+    """
+    totals = rng.normal(1600, 250, size=len(df_geography)).clip(800)
+    expected = totals[:, None] * age_profile()[None, :] / 2
+    return {'Males': rng.poisson(expected), 'Females': rng.poisson(expected * 1.03)}
+
+#----------------------------------------------
+
+def thousands(values):
+    return [f'{int(value):,}' for value in values]
+
+
+def write_csv(df, path, encoding='utf-8-sig'):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    df.to_csv(path, index=False, encoding=encoding)
+
+
+def baseline_frame(df_geography, counts):
+    df = pd.DataFrame({
+        'LAD 2021 Code': df_geography['LAD23CD'],
+        'LAD 2021 Name': df_geography['LAD23NM'],
+        'LSOA 2021 Code': df_geography['LSOA21CD'],
+        'LSOA 2021 Name': df_geography['LSOA21NM'],
+        'LA Name': df_geography['utla_name'],
+        'Total': thousands(counts.sum(axis=1)),
+    })
+    return pd.concat([df, pd.DataFrame(counts, columns=[str(age) for age in AGES])], axis=1)
+
+
+def projection_frame(area_names, area_counts, rng):
+    """
+    Projections for each area, gender and year, grown from the baseline at a
+    steady rate for each area and age.
+
+    Parameters:
+    area_names (list): Area names.
+    area_counts (dict): Gender -> int64 [area, age] population in the baseline year.
+    """
+    growth = 1 + rng.normal(0.004, 0.004, size=(len(area_names), len(AGES)))
+    frames = []
+    for year in YEARS:
+        factor = growth ** (year - BASELINE_YEAR)
+        by_gender = {gender: np.rint(area_counts[gender] * factor).astype(np.int64) for gender in ('Males', 'Females')}
+        by_gender['Persons'] = by_gender['Males'] + by_gender['Females']
+        for gender in GENDERS:
+            df = pd.DataFrame(by_gender[gender], columns=[str(age) for age in AGES])
+            df.insert(0, 'All Ages', thousands(by_gender[gender].sum(axis=1)))
+            df.insert(0, 'local authority', area_names)
+            df['Year'] = year
+            df['Gender'] = PROJECTION_GENDER_LABELS[gender]
+            frames.append(df)
+    return pd.concat(frames, ignore_index=True).sort_values(['local authority', 'Year'], kind='stable')
+
+
+def boundaries(df_geography):
+    """
+    A square boundary for each LSOA on a grid in British National Grid metres.
+    """
+    width = int(np.ceil(np.sqrt(len(df_geography))))
+    i = np.arange(len(df_geography))
+    x = 300000 + (i % width) * LSOA_SIZE
+    y = 200000 + (i // width) * LSOA_SIZE
+    return gpd.GeoDataFrame(
+        {'LSOA21CD': df_geography['LSOA21CD'], 'LSOA21NM': df_geography['LSOA21NM']},
+        geometry=shapely.box(x, y, x + LSOA_SIZE, y + LSOA_SIZE), crs=27700)
+
+#----------------------------------------------
+
+def write_reference_data(build_data_dir, n_utlas, seed=0):
+    """
+    Write synthetic source files for n_utlas UTLAs under build_data_dir, with the
+    paths reference_store.REFERENCE_SOURCES and LSOA_SHAPEFILE_PATH expect.
+
+    Returns:
+    dict: Counts of the UTLAs, districts and LSOAs written.
+    """
+    rng = np.random.default_rng(seed)
+    df_geography = synthetic_geography(n_utlas, rng)
+    counts = synthetic_baselines(df_geography, rng)
+    counts['Persons'] = counts['Males'] + counts['Females']
+
+    for gender in GENDERS:
+        path = os.path.join(build_data_dir, 'baseline_pop_lsoa_syoa_sex', f'2022_{gender.lower()}_lsoa_syoa.csv')
+        write_csv(baseline_frame(df_geography, counts[gender]), path)
+
+    df_lookup = df_geography[['LSOA21CD', 'LSOA21NM', 'LAD23CD', 'LAD23NM']].copy()
+    df_lookup['ObjectId'] = np.arange(1, len(df_lookup) + 1)
+    df_lookup['utla_name'] = df_geography['utla_name']
+    write_csv(df_lookup, os.path.join(build_data_dir, 'lookups', 'lsoa_2021_to_la_district.csv'))
+
+    df_imd = pd.DataFrame({
+        'FeatureCode': df_geography['LSOA21CD'],
+        'DateCode': 2019,
+        'Measurement': 'Decile ',
+        'Units': '',
+        'Value': rng.integers(1, 11, size=len(df_geography)),
+        'Indices of Deprivation': 'a. Index of Multiple Deprivation (IMD)',
+    })
+    write_csv(df_imd, os.path.join(build_data_dir, 'lsoa_imd_decile', 'lsoa_imd_decile.csv'))
+
+    #projections, grown from the baseline summed to each level of geography
+    for column, file_name in [
+            ('LAD23NM', 'district_pop_forecast_24_to_43_jucd_only.csv'),
+            ('utla_name', 'utla_pop_forecast_24_to_43_jucd_only.csv')]:
+        codes, names = pd.factorize(df_geography[column])
+        area_counts = {}
+        for gender in ('Males', 'Females'):
+            area_counts[gender] = np.zeros((len(names), len(AGES)), dtype=np.int64)
+            np.add.at(area_counts[gender], codes, counts[gender])
+        df_projection = projection_frame(list(names), area_counts, rng)
+        #the projection downloads have no byte order mark
+        write_csv(df_projection, os.path.join(build_data_dir, 'pop_projections', file_name), encoding='utf-8')
+
+    shapefile_dir = os.path.join(build_data_dir, 'shapefiles_subset')
+    os.makedirs(shapefile_dir, exist_ok=True)
+    boundaries(df_geography).to_file(os.path.join(shapefile_dir, 'local_area_shapefile.shp'))
+
+    return {
+        'utlas': int(df_geography['utla_name'].nunique()),
+        'districts': int(df_geography['LAD23NM'].nunique()),
+        'lsoas': len(df_geography),
+    }
+
+
+def write_service_file(path, district_names, n_services, seed=0):
+    """
+    Write a service coverage file (zTestData layout) of n_services services,
+    each covering a random subset of the districts.
+    """
+    rng = np.random.default_rng(seed)
+    min_ages = rng.integers(0, 60, size=n_services)
+    df = pd.DataFrame({
+        'Service name': [f'Service {i:04d}' for i in range(n_services)],
+        'min age seen': min_ages,
+        'max age seen': np.minimum(min_ages + rng.integers(5, 60, size=n_services), 90),
+        'gender seen': rng.choice(GENDERS, size=n_services),
+        'attendances in 12 months': rng.integers(1000, 50000, size=n_services),
+        'average cost per appt': rng.integers(50, 300, size=n_services),
+        'clinical_wte': np.round(rng.uniform(2, 60, size=n_services), 1),
+    })
+    coverage = np.where(rng.random((n_services, len(district_names))) < 0.3, 'yes', 'no')
+    df = pd.concat([df, pd.DataFrame(coverage, columns=district_names)], axis=1)
+    write_csv(df, path)
+    return df
@@ -0,0 +1,55 @@
+"""
+One-time build step converting the csv files under build_data/ into the
+columnar (Arrow IPC) store read by the app pages, and the LSOA boundary
+shapefile into simplified GeoJSON ready to embed in maps.
+
+Usage:
+    python build_reference_data.py            #rebuild only out of date tables
+    python build_reference_data.py --force    #rebuild every table
+    python build_reference_data.py --vector-tiles    #also build the LSOA vector tiles (needs mapbox-vector-tile)
+    python build_reference_data.py --region Derby Derbyshire    #limit the store to these districts / UTLAs
+    python build_reference_data.py --no-region    #keep every area in the source files
+"""
+import argparse
+import os
+
+from pages.page_functions import reference_store as ref_store
+from pages.page_functions import geometry_store
+from pages.page_functions import vector_tiles
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the columnar reference data store from build_data/ csv files.')
+    parser.add_argument('--force', action='store_true', help='Rebuild every table, even if it is up to date.')
+    parser.add_argument('--vector-tiles', action='store_true', help='Also build the LSOA vector tiles used to map large areas.')
+    region = parser.add_mutually_exclusive_group()
+    region.add_argument('--region', nargs='+', metavar='AREA',
+                        help='District or UTLA names to limit the store to (saved to build_data/region.txt).')
+    region.add_argument('--no-region', action='store_true', help='Remove build_data/region.txt, keeping every area.')
+    args = parser.parse_args()
+
+    if args.region:
+        try:
+            ref_store.region_selection(args.region)
+        except ValueError as error:
+            parser.error(str(error))
+        with open(ref_store.REGION_PATH, 'w') as f:
+            f.write('\n'.join(args.region) + '\n')
+    elif args.no_region and os.path.exists(ref_store.REGION_PATH):
+        os.remove(ref_store.REGION_PATH)
+
+    built = [ref_store.store_path(table_name) for table_name in ref_store.build_reference_store(force=args.force)]
+    built += [geometry_store.geojson_store_path(detail) for detail in geometry_store.build_geometry_store(force=args.force)]
+    if args.vector_tiles:
+        n_tiles = vector_tiles.build_vector_tiles(force=args.force)
+        if n_tiles:
+            built.append(f'{vector_tiles.TILE_DIR} ({n_tiles} tiles)')
+    if built:
+        for path in built:
+            print(f'built {path}')
+    else:
+        print('reference store is up to date')
+
+
+if __name__ == '__main__':
+    main()
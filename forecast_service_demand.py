@@ -0,0 +1,267 @@
+"""
+Headless batch run of the service demand forecast (the 'For many services'
+option of the high level page), for scheduled jobs over many service files.
+
+Each service coverage csv (same layout as
+zTestData/dummy_data_service_age_coverage_with_WTE.csv, or in long format
+with an 'area covered' or 'LSOA covered' column, see service_demand.py) is written out as
+a full table (the input with the forecast columns added) and a shortened
+table (service name, forecast summary and modifiable risk factor estimates).
+With --draws, a table of Monte Carlo percentile bands for each service is
+written as well.
+The forecasts are kept in the disk result cache (see disk_cache.py), keyed
+on the contents of the service file, so rerunning a file that has not
+changed (here or on another machine sharing the cache) reuses them.
+Streamlit is not imported.
+
+Files are spread over --workers processes (default: one per CPU). The
+projections are loaded once and shared with the workers through shared
+memory (see shared_projections.py), not reloaded or pickled per worker.
+With --combined-output, the shortened table of every file is also written
+to one table (with a 'Service file' column), appended as each file finishes.
+
+Usage:
+    python forecast_service_demand.py services.csv --baseline-year 2024 --forecast-year 2030
+    python forecast_service_demand.py services/*.csv --baseline-year 2024 --forecast-year 2035 \\
+        --smoking-prevalence 12.5 --format parquet --output-dir forecasts
+    python forecast_service_demand.py services.csv --baseline-year 2024 --forecast-year 2030 --all-years
+    python forecast_service_demand.py services.csv --baseline-year 2024 --forecast-year 2030 --draws 10000 \\
+        --projection-error-sd 2 --modifier-sd 10
+    python forecast_service_demand.py providers/*.csv --baseline-year 2024 --forecast-year 2030 --workers 16 \\
+        --output-dir forecasts --combined-output forecasts/all_providers.parquet
+"""
+import argparse
+import hashlib
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from pages.page_functions import compact_projections
+from pages.page_functions import forecast_engine
+from pages.page_functions import shared_projections
+from pages.page_functions import service_demand
+from pages.page_functions import trajectory
+from pages.page_functions import lsoa_catchments
+from pages.page_functions import monte_carlo
+from pages.page_functions import disk_cache
+
+#projection table for each --geography option
+GEOGRAPHY_PROJECTIONS = {
+    'district': 'pop_proj_district',
+    'utla': 'pop_proj_utla',
+}
+
+OUTPUT_FORMATS = ['csv', 'parquet']
+
+
+def write_table(df, path, output_format):
+    if output_format == 'parquet':
+        df.to_parquet(path, index=False)
+    else:
+        df.to_csv(path, index=False)
+
+
+def cached(result_cache, key, compute):
+    """
+    compute() through the disk result cache (or just compute() if there is no cache).
+    """
+    if result_cache is None:
+        return compute()
+    found, value = result_cache.get(key)
+    if not found:
+        value = compute()
+        result_cache.put(key, value)
+    return value
+
+
+#LSOA baselines, loaded once per process the first time a file of LSOA catchments is forecast
+_lsoa_age_cube = {}
+
+def lsoa_age_cube_for(service_df):
+    if not service_demand.is_lsoa_catchment(service_df):
+        return None
+    if 'cube' not in _lsoa_age_cube:
+        _lsoa_age_cube['cube'] = lsoa_catchments.load_lsoa_age_cube()
+    return _lsoa_age_cube['cube']
+
+
+def forecast_service_file(service_path, pop_df, baseline_year, forecast_year, prevalences, output_dir, output_format, all_years=False,
+                          draws=0, projection_error_sd=0.0, modifier_sd=0.0, seed=None, geography='district', result_cache=None):
+    """
+    Forecast the demand for every service in one coverage file and write the outputs.
+
+    Returns:
+    tuple: (paths of the full and shortened output tables (and the trajectory table if all_years,
+    and the uncertainty table if draws), the shortened table)
+    """
+    with open(service_path, 'rb') as f:
+        service_file_hash = hashlib.sha256(f.read()).hexdigest()
+    service_df = pd.read_csv(service_path)
+    file_stem = os.path.splitext(os.path.basename(service_path))[0]
+    output_paths = []
+
+    if all_years:
+        #every projection year after the baseline, in one pass
+        years = trajectory.trajectory_years(pop_df, baseline_year)[1:]
+        trajectory_df = cached(
+            result_cache, ('service_change_trajectory', service_file_hash, geography, int(baseline_year)),
+            lambda: trajectory.service_change_trajectory(service_df, pop_df, baseline_year, years, lsoa_age_cube_for(service_df)))
+        trajectory_path = os.path.join(output_dir, f'{file_stem}_forecast_trajectory.{output_format}')
+        write_table(trajectory_df, trajectory_path, output_format)
+        output_paths.append(trajectory_path)
+
+    full_df, shortened_df = cached(
+        result_cache, ('calculate_population_changes', service_file_hash, geography, int(baseline_year), int(forecast_year)),
+        lambda: service_demand.calculate_population_changes(service_df, pop_df, baseline_year, forecast_year, lsoa_age_cube_for(service_df)))
+    shortened_df = service_demand.add_risk_factor_columns(shortened_df, prevalences)
+
+    full_path = os.path.join(output_dir, f'{file_stem}_forecast_full.{output_format}')
+    shortened_path = os.path.join(output_dir, f'{file_stem}_forecast_shortened.{output_format}')
+    write_table(full_df, full_path, output_format)
+    write_table(shortened_df, shortened_path, output_format)
+
+    if draws:
+        uncertainty_df = monte_carlo.service_demand_uncertainty(
+            full_df, ('Normal', [0.0, projection_error_sd]), ('Normal', [0.0, modifier_sd]), n_draws=draws, seed=seed)
+        uncertainty_path = os.path.join(output_dir, f'{file_stem}_forecast_uncertainty.{output_format}')
+        write_table(uncertainty_df, uncertainty_path, output_format)
+        output_paths.append(uncertainty_path)
+
+    return [full_path, shortened_path] + output_paths, shortened_df
+
+#----------------------------------------------
+#worker processes: each attaches to the shared projections once, then forecasts the files it is given
+
+_worker = {}
+
+def init_worker(cube_handle, file_options, use_cache):
+    _worker['cube'], _worker['blocks'] = shared_projections.attach_projection_cube(cube_handle)
+    _worker['file_options'] = file_options
+    _worker['result_cache'] = disk_cache.disk_cache_from_environment() if use_cache else None
+
+
+def forecast_service_file_in_worker(service_path):
+    return forecast_service_file(service_path, _worker['cube'], result_cache=_worker['result_cache'], **_worker['file_options'])
+
+
+def forecast_service_files(service_paths, cube, file_options, n_workers, use_cache):
+    """
+    forecast_service_file for each file, over n_workers processes sharing the projection cube.
+
+    Yields:
+    tuple: (service path, output paths, shortened table), in the order of service_paths,
+    each as soon as it (and the files before it) are done.
+    """
+    if n_workers <= 1:
+        result_cache = disk_cache.disk_cache_from_environment() if use_cache else None
+        for service_path in service_paths:
+            yield (service_path,) + forecast_service_file(service_path, cube, result_cache=result_cache, **file_options)
+        return
+
+    with shared_projections.shared_projection_cube(cube) as cube_handle:
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=init_worker, initargs=(cube_handle, file_options, use_cache)) as pool:
+            for service_path, result in zip(service_paths, pool.map(forecast_service_file_in_worker, service_paths)):
+                yield (service_path,) + result
+
+#----------------------------------------------
+
+class CombinedOutput:
+    """
+    One table of the shortened outputs of every service file, appended to as each file is done
+    (csv, or parquet with a row group per file), with the file name in a 'Service file' column.
+    """
+    def __init__(self, path, output_format):
+        self.path = path
+        self.output_format = output_format
+        self.parquet_writer = None
+        self.n_rows = 0
+
+    def append(self, service_path, shortened_df):
+        df = shortened_df.copy()
+        df.insert(0, 'Service file', os.path.basename(service_path))
+        if self.output_format == 'parquet':
+            if self.parquet_writer is None:
+                table = pa.Table.from_pandas(df, preserve_index=False)
+                self.parquet_writer = pq.ParquetWriter(self.path, table.schema)
+            else:
+                #the same columns in every file, cast to the types of the first (e.g. a column of whole numbers in one file)
+                table = pa.Table.from_pandas(df, schema=self.parquet_writer.schema, preserve_index=False)
+            self.parquet_writer.write_table(table)
+        else:
+            df.to_csv(self.path, mode='w' if self.n_rows == 0 else 'a', header=self.n_rows == 0, index=False)
+        self.n_rows += len(df)
+
+    def close(self):
+        if self.parquet_writer is not None:
+            self.parquet_writer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Forecast population change and demand for service coverage files.')
+    parser.add_argument('service_files', nargs='+', help='Service coverage csv file(s).')
+    parser.add_argument('--baseline-year', type=int, required=True, help='Baseline year.')
+    parser.add_argument('--forecast-year', type=int, required=True, help='Forecast year.')
+    parser.add_argument('--geography', choices=list(GEOGRAPHY_PROJECTIONS), default='district',
+                        help='Level of geography of the area columns in the service files (default: district).')
+    for risk_factor, (description, default_prevalence) in service_demand.RISK_FACTORS.items():
+        parser.add_argument(f"--{risk_factor.replace('_', '-')}-prevalence", dest=f'{risk_factor}_prevalence', type=float,
+                            default=default_prevalence, help=f'Est. %% of {description} (default: {default_prevalence}).')
+    parser.add_argument('--output-dir', default='.', help='Directory to write the output tables to (default: current directory).')
+    parser.add_argument('--format', dest='output_format', choices=OUTPUT_FORMATS, default='csv', help='Output file format (default: csv).')
+    parser.add_argument('--all-years', action='store_true',
+                        help='Also write the population change and demand forecast for every projection year after the baseline.')
+    parser.add_argument('--draws', type=int, default=0,
+                        help='Also write Monte Carlo percentile bands for each service from this many draws (default: 0, none).')
+    parser.add_argument('--projection-error-sd', type=float, default=2.0,
+                        help='Standard deviation of the %% error in the population projections, for --draws (default: 2.0).')
+    parser.add_argument('--modifier-sd', type=float, default=10.0,
+                        help='Standard deviation of the total demand modifier %%, for --draws (default: 10.0).')
+    parser.add_argument('--seed', type=int, default=None, help='Random seed for --draws, for repeatable bands.')
+    parser.add_argument('--no-cache', action='store_true', help='Do not read or write the disk result cache.')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='Worker processes to spread the files over (default: one per CPU, 1 runs them in this process).')
+    parser.add_argument('--combined-output', default=None,
+                        help='Also write the shortened tables of every file to this one file (in --format).')
+    args = parser.parse_args()
+
+    #loaded once and shared by every service file
+    pop_df = compact_projections.load_compact_projections(GEOGRAPHY_PROJECTIONS[args.geography])
+    available_years = pop_df.available_years()
+    for year in [args.baseline_year, args.forecast_year]:
+        if year not in available_years:
+            parser.error(f'no population projections for {year} (available: {min(available_years)}-{max(available_years)})')
+
+    prevalences = {risk_factor: getattr(args, f'{risk_factor}_prevalence') for risk_factor in service_demand.RISK_FACTORS}
+    os.makedirs(args.output_dir, exist_ok=True)
+    file_options = {
+        'baseline_year': args.baseline_year, 'forecast_year': args.forecast_year, 'prevalences': prevalences,
+        'output_dir': args.output_dir, 'output_format': args.output_format, 'all_years': args.all_years,
+        'draws': args.draws, 'projection_error_sd': args.projection_error_sd, 'modifier_sd': args.modifier_sd,
+        'seed': args.seed, 'geography': args.geography,
+    }
+    n_workers = max(1, min(args.workers, len(args.service_files)))
+    combined_output = CombinedOutput(args.combined_output, args.output_format) if args.combined_output else None
+
+    start = time.perf_counter()
+    try:
+        for service_path, output_paths, shortened_df in forecast_service_files(
+                args.service_files, forecast_engine.projection_cube_for(pop_df), file_options, n_workers, not args.no_cache):
+            if combined_output is not None:
+                combined_output.append(service_path, shortened_df)
+            print(f"{service_path} -> {', '.join(output_paths)}")
+    finally:
+        if combined_output is not None:
+            combined_output.close()
+
+    if len(args.service_files) > 1:
+        print(f'{len(args.service_files)} files in {time.perf_counter() - start:.1f}s with {n_workers} worker(s)')
+    if combined_output is not None:
+        print(f'combined output: {combined_output.n_rows} services -> {args.combined_output}')
+
+
+if __name__ == '__main__':
+    main()
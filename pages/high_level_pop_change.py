@@ -16,6 +16,8 @@ st.set_page_config(layout="wide")
 
 #import modules
 from pages.page_functions import file_upload_warnings as warn
+from pages.page_functions import pop_data_ETL_functions as pop_ETL
+from pages.page_functions import reference_data as ref_data
 
 
 #--------------------------------------------------------------
@@ -28,44 +30,6 @@ def get_remaining_years(options, selected_year):
     remaining_years = options[index+1:]   # Extract the remaining years
     return remaining_years
 
-def forecast_population(pop_df, local_authorities, min_age, max_age, start_year, forecast_year, gender):
-
-    # Filter data for the specified local authorities
-    df_filtered = pop_df[pop_df['local authority'].isin(local_authorities)]
-    
-    # Filter data for the specified gender
-    df_filtered = df_filtered[df_filtered['Gender'] == gender]
-    # Define age columns to sum based on min_age and max_age
-    age_columns = [str(age) for age in range(int(min_age), int(max_age) + 1)]
-    
-    # Filter and calculate for the start_year
-    baseline_data = df_filtered[df_filtered['Year'] == start_year]
-    baseline_pop = baseline_data[age_columns].sum(axis=1)
-    baseline_total = baseline_pop.groupby(baseline_data['local authority']).sum()
-    
-    # Filter and calculate for the forecast_year
-    forecast_data = df_filtered[df_filtered['Year'] == forecast_year]
-    forecast_pop = forecast_data[age_columns].sum(axis=1)
-    forecast_total = forecast_pop.groupby(forecast_data['local authority']).sum()
-    
-    # Calculate net change and percentage change
-    net_change = forecast_total - baseline_total
-    percent_change = (net_change / baseline_total) * 100
-    
-    # Prepare the final DataFrame for output (working code on individual service use case)
-    result_df = pd.DataFrame({
-        'Location': local_authorities,
-        f'Total Pop Age {min_age}-{max_age} ({gender})': baseline_total,
-        'Baseline Year Total': baseline_total,
-        'Forecast Year Total': forecast_total,
-        'Net Change': net_change,
-        '% Change': percent_change
-    })
-
-    #result_df.reset_index(inplace=True)
-    return result_df
-
-
 def create_population_change_chart(df, chart_metric):
     """
     This function creates an Altair chart object for rendering in Streamlit, showing either the net change
@@ -142,82 +106,6 @@ def create_population_change_chart_service_upload(df, chart_metric, pop_proj_bas
     return chart
 
 
-def get_population_for_service(pop_df, local_authorities, min_age, max_age, baseline_year, forecast_year, gender):
-    # Filter the population dataframe for the specified local authorities
-    la_df = pop_df[pop_df['local authority'].isin(local_authorities)]
-    
-    # Get the baseline population
-    baseline_df = la_df[(la_df['Year'] == baseline_year) & (la_df['Gender'] == gender)]
-    age_columns = [str(age) for age in range(min_age, max_age + 1)]
-    baseline_population = baseline_df[age_columns].sum().sum()
-
-    # Get the forecast population
-    forecast_df = la_df[(la_df['Year'] == forecast_year) & (la_df['Gender'] == gender)]
-    forecast_population = forecast_df[age_columns].sum().sum()
-
-    return baseline_population, forecast_population
-
-# Example usage in Streamlit app
-def calculate_population_changes(service_df, pop_df, baseline_year, forecast_year):
-    # Assuming all columns after the 4th index are local authorities
-    local_authorities_columns = service_df.columns[6:]
-
-    # Initialize new columns for the output
-    service_df['Baseline Population'] = 0
-    service_df['Forecast Population'] = 0
-    service_df['Net Pop Change'] = 0
-    service_df['% Pop Change'] = 0.0
-    service_df['Forecasted Demand'] = 0
-    service_df['Net Est Demand Change'] = 0
-    service_df['Net Cost Demand Change (£1000s)'] = 0
-    service_df['attendances per wte'] = 0
-
-    for index, service_row in service_df.iterrows():
-        # Identify which local authorities are marked as 'yes'
-        selected_local_authorities = [la for la in local_authorities_columns if service_row[la] == 'yes']
-        
-        # Call the function to get populations
-        baseline_population, forecast_population = get_population_for_service(
-            pop_df,
-            selected_local_authorities,
-            service_row['min age seen'],
-            service_row['max age seen'],
-            baseline_year,
-            forecast_year,
-            service_row['gender seen']
-        )
-
-        # Calculate net change and percent change
-        net_change = forecast_population - baseline_population
-        percent_change = (net_change / baseline_population * 100) if baseline_population else 0
-
-        # Calculate the forecasted demand by applying the percentage change to the attendances
-        forecasted_demand = round(service_row['attendances in 12 months'] * (1 + (percent_change / 100)),0)
-        net_change_forecast_demand = forecasted_demand - service_row['attendances in 12 months']
-        cost_demand_change = (net_change_forecast_demand * (service_row['average cost per appt'])) / 1000
-
-        #calculate the average number of attendances per wte
-        attends_per_wte = service_row['attendances in 12 months'] / service_row['clinical_wte'] 
-
-        # Update the service dataframe with the calculated populations
-        service_df.at[index, 'Baseline Population'] = baseline_population
-        service_df.at[index, 'Forecast Population'] = forecast_population
-        service_df.at[index, 'Net Pop Change'] = net_change
-        service_df.at[index, '% Pop Change'] = percent_change
-        service_df.at[index, 'Forecasted Demand'] = forecasted_demand
-        service_df.at[index, 'Net Est Demand Change'] = net_change_forecast_demand
-        service_df.at[index, 'Net Cost Demand Change (£1000s)'] = cost_demand_change
-        service_df.at[index, 'attendances per wte'] = attends_per_wte
-
-    # Now create a new dataframe with only the required columns
-    columns_to_keep = [service_df.columns[0]] + service_df.columns[-5:].tolist()
-    shortened_service_df = service_df[columns_to_keep]
-
-    #shortened_service_df = shortened_service_df.reset_index(inplace=True)
-
-    return service_df, shortened_service_df
-
-
 def create_scatter_chart(df, x_variable, y_variable, width, height):
     """
     Render a scatter chart using Altair with given x and y variables.
@@ -280,21 +168,17 @@ def create_bar_chart(df, y_variable, x_variable='Service name'):
 #load required files
 #--------------------------------------------------------------
 
-#POP FORECASTS
-pop_proj_path_utla = r'build_data/pop_projections/pop_forecast_24_to_43.csv'
-pop_proj_path_district = r'build_data/pop_projections/district_pop_forecast_24_to_43.csv'
-
 #--------------------------------------------------------------
 #Make dataframes
 #--------------------------------------------------------------
 
-#call function to create dict of necessary reference files
-df_pop_forecast_district = pd.read_csv(pop_proj_path_district)
-df_pop_forecast_utla = pd.read_csv(pop_proj_path_utla)
+#POP FORECASTS (shared across sessions, see reference_data.py)
+df_pop_forecast_district = ref_data.get_pop_projections('District Authority or Place')
+df_pop_forecast_utla = ref_data.get_pop_projections('Upper Tier or Unitary Authority')
 
 #get possible single years of age in the forecast pop df
-list_possible_ages = list(df_pop_forecast_district.iloc[:,2:-2].columns)
-list_possible_years = list(set(list(df_pop_forecast_district['Year'])))
+list_possible_ages = df_pop_forecast_district.age_labels()
+list_possible_years = df_pop_forecast_district.available_years()
 
 #list_possible_district_las = sorted(list(set(df_pop_forecast_district['local authority'])))
 #list_possible_utlas = sorted(list(set(df_pop_forecast_utla['local authority'])))
@@ -423,13 +307,20 @@ if use_case == 'For just one service':
         st.header('Outputs:')
         st.subheader('Population change in selected areas:')
         
-        df_single_service_pop_change = forecast_population(
-        pop_df,
+        #population change for every year from the baseline (cached, so changing the forecast year only takes a slice)
+        df_single_service_trajectory = pop_ETL.forecast_population_trajectory(
+        geography_level,
         list_of_areas_to_forecast,
         pop_proj_min_age,
         pop_proj_max_age,
         pop_proj_baseline_year,
+        pop_proj_gender
+        )
+        df_single_service_pop_change = pop_ETL.forecast_population_for_year(
+        df_single_service_trajectory,
         pop_proj_forecast_year,
+        pop_proj_min_age,
+        pop_proj_max_age,
         pop_proj_gender
         )
 
@@ -457,6 +348,11 @@ if use_case == 'For just one service':
     bar_chart = create_bar_chart(df_single_service_pop_change, y_variable, x_variable='Location')
     st.altair_chart(bar_chart)
 
+    st.subheader(f'Population change from {pop_proj_baseline_year}, for every forecast year:')
+    trajectory_variable = st.selectbox('What would you like to display on the trajectory chart?', options=['Net Change', '% Change', 'Forecast Year Total'], index=0)
+    trajectory_chart = pop_ETL.create_trajectory_chart(df_single_service_trajectory, trajectory_variable, pop_proj_forecast_year, color_variable='Location')
+    st.altair_chart(trajectory_chart)
+
 
 #--------------------------------------------------------------
 
@@ -483,9 +379,16 @@ elif use_case == 'For many services (requires file upload)':
         users_file = r'zTestData/dummy_data_service_age_coverage_with_WTE.csv'
         st.write('Test/dummy data in use as no file selected')
     
-    service_df = pd.read_csv(users_file)
+    #large files are forecast a chunk of rows at a time, rather than read whole (see pop_ETL.forecast_service_upload_in_chunks)
+    stream_upload = pop_ETL.upload_size(users_file) >= pop_ETL.STREAMING_UPLOAD_MIN_BYTES
+    if stream_upload:
+        service_df = pd.read_csv(users_file, nrows=1000)
+    else:
+        service_df = pd.read_csv(users_file)
     st.subheader('Preview of data set in use:')
     with st.expander(label='Click to preview the dataset in use:'):
+        if stream_upload:
+            st.write(f'The file is large ({pop_ETL.upload_size(users_file) / 2**20:,.0f} MB), so only the first {len(service_df):,} services are shown here. Every service is forecast below, a chunk at a time.')
         st.dataframe(service_df)
 
     st.subheader('Set parameters:')
@@ -526,24 +429,43 @@ elif use_case == 'For many services (requires file upload)':
 
     
     st.subheader('Population change by service:')
-    updated_service_df_with_pop_demand_forecast, shortened_service_df_with_forecast = calculate_population_changes(service_df, pop_df, pop_proj_baseline_year, pop_proj_forecast_year)
-    
-    #update shortened_service_df_with_forecast with modifiable risk factor population using user-provided prevalence rate, for the current attendances
-    shortened_service_df_with_forecast['Current est smokers'] = round((shortened_service_df_with_forecast['Forecasted Demand'] - shortened_service_df_with_forecast['Net Est Demand Change']) * (smoking_prevalence/100),0)
-    shortened_service_df_with_forecast['Current est overweight or obese pts'] = round((shortened_service_df_with_forecast['Forecasted Demand'] - shortened_service_df_with_forecast['Net Est Demand Change']) * (overweight_or_obesity_prevalence/100),0)
-    shortened_service_df_with_forecast['Current est obese pts'] = round((shortened_service_df_with_forecast['Forecasted Demand'] - shortened_service_df_with_forecast['Net Est Demand Change']) * (obesity_prevalence/100),0)
+    if stream_upload:
+        #every year from the baseline is forecast into a file kept for the session, the page reads the first services for the forecast year
+        service_forecast_files = pop_ETL.forecast_service_upload_in_chunks(users_file, pop_df, pop_proj_baseline_year)
+        updated_service_df_with_pop_demand_forecast, shortened_service_df_with_forecast = service_forecast_files.changes_for_year(pop_proj_forecast_year, nrows=pop_ETL.STREAMING_PREVIEW_SERVICES)
+    else:
+        #every year from the baseline is forecast once per file and baseline year, the forecast year is a slice of it
+        services_df, trajectory_years, service_populations = pop_ETL.service_upload_trajectory(users_file, service_df, pop_df, pop_proj_baseline_year)
+        updated_service_df_with_pop_demand_forecast, shortened_service_df_with_forecast = pop_ETL.population_changes_for_year(services_df, trajectory_years, service_populations, pop_proj_forecast_year)
     
-    #update shortened_service_df_with_forecast with modifiable risk factor population using user-provided prevalence rate for the forecast demand population
-    shortened_service_df_with_forecast['Forecast est smokers'] = round(shortened_service_df_with_forecast['Forecasted Demand'] * (smoking_prevalence/100),0)
-    shortened_service_df_with_forecast['Forecast est overweight or obese pts'] = round(shortened_service_df_with_forecast['Forecasted Demand'] * (overweight_or_obesity_prevalence/100),0)
-    shortened_service_df_with_forecast['Forecast est obese pts'] = round(shortened_service_df_with_forecast['Forecasted Demand'] * (obesity_prevalence/100),0)
+    #update shortened_service_df_with_forecast with modifiable risk factor population using user-provided prevalence rate, for the current and forecast demand
+    shortened_service_df_with_forecast = pop_ETL.add_risk_factor_columns(shortened_service_df_with_forecast, smoking_prevalence, overweight_or_obesity_prevalence, obesity_prevalence)
 
     with st.expander(label='Click to preview the updated dataset with forecasts added'):
-        st.write(updated_service_df_with_pop_demand_forecast) 
+        if stream_upload:
+            st.write(f'The service information and forecasts of the first {len(updated_service_df_with_pop_demand_forecast):,} of {service_forecast_files.n_services:,} services (download the file below for every service, with its area columns):')
+            st.write(updated_service_df_with_pop_demand_forecast)
+            #the csv is only built when the button is clicked
+            st.download_button(
+                label='Download the updated dataset (csv)',
+                data=pop_ETL.full_forecast_download(users_file, service_forecast_files, pop_proj_forecast_year),
+                file_name='service_forecast_full.csv',
+                mime='text/csv',
+                on_click='ignore')
+        else:
+            st.write(updated_service_df_with_pop_demand_forecast) 
 
     #col1, col2 = st.columns(2)
 
     #with col1:
+    if stream_upload:
+        st.write(f'The first {len(shortened_service_df_with_forecast):,} of {service_forecast_files.n_services:,} services are shown and charted below. Download the file below for every service:')
+        st.download_button(
+            label='Download the forecasts with risk factors (csv)',
+            data=pop_ETL.shortened_forecast_download(service_forecast_files, pop_proj_forecast_year, smoking_prevalence, overweight_or_obesity_prevalence, obesity_prevalence),
+            file_name='service_forecast_risk_factors.csv',
+            mime='text/csv',
+            on_click='ignore')
     st.write(shortened_service_df_with_forecast) 
     #with col2:
     #    st.altair_chart(create_population_change_chart_service_upload(shortened_service_df_with_forecast, chart_metric, pop_proj_baseline_year, pop_proj_forecast_year))
@@ -10,6 +10,12 @@ from streamlit_folium import st_folium
 from pages.page_functions import pop_data_ETL_functions as pop_ETL
 from pages.page_functions import map_functions as map_func
 from pages.page_functions import file_upload_warnings as warn
+from pages.page_functions import reference_data as ref_data
+from pages.page_functions import vector_tiles
+from pages.page_functions import scenario_engine
+from pages.page_functions import monte_carlo
+from pages.page_functions import result_cache
+from pages.page_functions import stage_profiler
 
 #set page config
 st.set_page_config(layout="wide")
@@ -19,6 +25,11 @@ st.set_page_config(layout="wide")
 #----------------------------
 st.title(':green[Mapping Population Forecast Change]🗺️')
 debug_mode = st.radio(label='turn on debug mode', options=['Yes', 'No'], index=1, horizontal=True, help='Turning this on will display the tables that are produced when the model runs. The formatting of these is not great, it has largely been included to aid with putting this together, but kept in case you want to visualise the method being applied.')
+profile_mode = st.radio(label='turn on profiling mode', options=['Yes', 'No'], index=1, horizontal=True, help='Turning this on records how long each step of the model and each map takes to run (and the memory and rows it uses), shown as a chart at the bottom of the page. Use this if the page is slow, to see which step is responsible.')
+
+#every measured step of this run records into the profiler (or nothing, with profiling off, see stage_profiler.py)
+profiler = stage_profiler.StageProfiler('mapping_pop_change') if profile_mode == 'Yes' else None
+stage_profiler.activate(profiler)
 #----------------------------
 #Overview of functionality (summary) - signpost to menu to review the method 
 #and assumptions that are being made in the model
@@ -95,27 +106,26 @@ apply_population_change = 'Apply population change to current demand'
 baseline_demand_apportion_total_activity = 'Enter a total activity figure'
 baseline_demand_upload_lsoa_aggregate_counts = 'Upload a file of agregated activity counts by LSOA'
 
-#POP FORECASTS
-pop_proj_path_utla = r'build_data/pop_projections/utla_pop_forecast_24_to_43_jucd_only.csv'
-pop_proj_path_district = r'build_data/pop_projections/district_pop_forecast_24_to_43_jucd_only.csv'
+#reference data is loaded once per server process and shared across sessions (see reference_data.py)
+with stage_profiler.measure('load_reference_data'):
+    dict_reference_data = ref_data.get_reference_data()
 
-#IMD DECILE BY LSOA
-lsoa_imd_decile_path = r'build_data/lsoa_imd_decile/lsoa_imd_decile.csv'
-df_lsoa_imd_decile = pd.read_csv(lsoa_imd_decile_path)
+    #IMD DECILE BY LSOA
+    df_lsoa_imd_decile = dict_reference_data['lookups']['df_imd_decile']
 
-#call function to create dict of necessary reference files
-df_pop_forecast_district = pd.read_csv(pop_proj_path_district)
-df_pop_forecast_utla = pd.read_csv(pop_proj_path_utla)
+    #POP FORECASTS
+    df_pop_forecast_district = ref_data.get_pop_projections('District Authority or Place')
+    df_pop_forecast_utla = ref_data.get_pop_projections('Upper Tier or Unitary Authority')
 
-list_possible_ages = list(df_pop_forecast_district.iloc[:,2:-2].columns)
-list_possible_years = list(set(list(df_pop_forecast_district['Year'])))
+list_possible_ages = df_pop_forecast_district.age_labels()
+list_possible_years = df_pop_forecast_district.available_years()
 
 #list_possible_district_las = sorted(list(set(df_pop_forecast_district['local authority'])))
 #list_possible_utlas = sorted(list(set(df_pop_forecast_utla['local authority'])))
 
-#load the shapefile
+#the LSOA boundaries are not loaded here, the maps join their values onto the shared
+#precomputed boundaries when they are drawn (see ref_data.get_lsoa_geometry_store)
 #geodf_lsoa_boundaries = map_func.load_shapefile(r'build_data/shapefiles/LSOA_2021_EW_BFC_V8.shp')
-geodf_lsoa_boundaries = map_func.load_shapefile(r'build_data/shapefiles_subset/local_area_shapefile.shp')
 
 #----------------------------
 #Parameter selection within expander to save screen space from results
@@ -276,6 +286,8 @@ with st.expander('Click to view / set required parameters'):
                 list_possible_outputs+=['Map - Current demand vs Need']
         if 'Charts' in list_type_of_outputs:
             list_possible_outputs += ['Chart - Population Change', 'Chart - Modelled Demand Change']
+            if how_to_model_demand == prevalence_use:
+                list_possible_outputs += ['Chart - Demand Scenarios', 'Chart - Demand Uncertainty']
         list_outputs = st.multiselect(label='Select the outputs to produce', options=list_possible_outputs)
 
 #button_confirm_params = st.button(label='Confirm parameters')
@@ -286,40 +298,39 @@ with st.expander('Click to view / set required parameters'):
 
 
 #Use the parameters to derive the required datasets
+#(the pipeline stages only rerun when their inputs change, so changing the prevalence
+#recomputes the need stage and need maps only, see run_lsoa_pipeline)
+lsoa_pipeline_params = {
+    'pop_proj_gender': pop_proj_gender,
+    'geography_level': geography_level,
+    'list_of_areas_to_forecast': list_of_areas_to_forecast,
+    'pop_proj_min_age': pop_proj_min_age,
+    'pop_proj_max_age': pop_proj_max_age,
+    'pop_proj_baseline_year': pop_proj_baseline_year,
+    'pop_proj_forecast_year': pop_proj_forecast_year,
+    #need is only added when demand is modelled from prevalence rates
+    'baseline_prevalence': baseline_prevalence if how_to_model_demand == prevalence_use else None,
+    'forecast_prevalence': forecast_prevalence if how_to_model_demand == prevalence_use else None,
+    'df_lsoa_imd_decile': df_lsoa_imd_decile,
+    }
+#the page stops here while the baseline cannot be loaded for the selections (e.g. no areas selected yet)
 try:
-    df_lsoa_syoa_selected_age_range = pop_ETL.load_and_process_baseline_data(pop_proj_gender, geography_level, list_of_areas_to_forecast, pop_proj_min_age, pop_proj_max_age)
+    pop_ETL.run_lsoa_pipeline(['lsoa_baseline'], lsoa_pipeline_params)
 except:
     st.stop()
 
-#function call to derive the total pop in the age / gender of interest
-df_summed_pop_change = pop_ETL.forecast_population(
-        df_forecast_pop_all_years,
-        list_of_areas_to_forecast,
-        pop_proj_min_age,
-        pop_proj_max_age,
-        pop_proj_baseline_year,
-        pop_proj_forecast_year,
-        pop_proj_gender
-        )
-
+#the later stages reuse the baseline from the run above, and their errors are shown
+lsoa_pipeline = pop_ETL.run_lsoa_pipeline(
+    ['lsoa_baseline', 'population_change', 'population_change_by_age', 'lsoa_forecast', 'lsoa_attributes'], lsoa_pipeline_params)
 
-#calculate the population change percentage for the chosen geography, age, gender, timeframes
-df_individual_ages_pop_change = pop_ETL.forecast_population_by_age(
-    df_forecast_pop_all_years, 
-    list_of_areas_to_forecast, 
-    pop_proj_min_age, 
-    pop_proj_max_age, 
-    pop_proj_baseline_year, 
-    pop_proj_forecast_year, 
-    pop_proj_gender
-    )
+df_lsoa_syoa_selected_age_range = lsoa_pipeline['lsoa_baseline']
+df_summed_pop_change = lsoa_pipeline['population_change']
+df_individual_ages_pop_change = lsoa_pipeline['population_change_by_age']
+df_inflated_lsoa_level_pop = lsoa_pipeline['lsoa_forecast']
 
 #aggregated up the above df, to sum pop for each year of age by each geography in scope
 #df_aggregated_change_by_year_of_age = pop_ETL.aggregate_by_age(df_individual_ages_pop_change)
 
-#apply the pop change above to the LSOAs, that fall within the geography selected
-df_inflated_lsoa_level_pop = pop_ETL.apply_percent_changes_iteratively(df_lsoa_syoa_selected_age_range, df_individual_ages_pop_change, geography_level)
-
 
 #<<< testing section >>>>
 #st.write('debug section')
@@ -327,6 +338,10 @@ df_inflated_lsoa_level_pop = pop_ETL.apply_percent_changes_iteratively(df_lsoa_s
 #-------------------------------
 
 if debug_mode == 'Yes':
+    st.header('Pipeline stages computed or reused on this run')
+    st.write(pop_ETL.LSOA_PIPELINE.run_summary())
+    st.write('shared forecast result cache')
+    st.write(result_cache.forecast_results.metrics())
     st.header('Susbet baseline pop by single year of age and district selections')
     st.write(df_lsoa_syoa_selected_age_range.head())
     st.write('source forecast df for single year of age, selected geography, available genders')
@@ -349,27 +364,26 @@ if debug_mode == 'Yes':
 #local_area_gdf.to_file('build_data/shapefiles_subset/local_area_shapefile.shp')
 
 #----------------------------
-#merge with df created above with the shapefile loaded into variable geodf_lsoa_boundaries
-#when the app loaded (this is held in cache after that point)
+#add need and IMD to the df created above, ready to join onto the LSOA boundaries when the maps are drawn
+#(the lsoa_need, lsoa_imd and lsoa_attributes stages: calculate_and_insert_needs, merge_imd_decile, convert_deciles_to_quintiles)
 #----------------------------
-if how_to_model_demand == prevalence_use:
-    #apply prevalence rates to 
-    df_inflated_lsoa_level_pop = pop_ETL.calculate_and_insert_needs(df_inflated_lsoa_level_pop, baseline_prevalence, forecast_prevalence)
-    #st.write(df_inflated_lsoa_level_pop)
-
-else:
-    #consider incorporating here logic to increase demand figure by pop change % ? 
-    pass
+df_inflated_lsoa_level_pop = lsoa_pipeline['lsoa_attributes']
 
+#precomputed WGS84 boundaries (simplified for the number of LSOAs) that map values are joined onto at render time
+lsoa_geometry_store = ref_data.get_lsoa_geometry_store(len(df_inflated_lsoa_level_pop))
+lsoa_pipeline_params['lsoa_geometry_store'] = lsoa_geometry_store
 
-#merge in IMD decile to ensure this is in the geodf (next line)
-df_inflated_lsoa_level_pop = pop_ETL.merge_imd_decile(df_inflated_lsoa_level_pop, df_lsoa_imd_decile)
-
-#convert imd deciles to quintiles
-df_inflated_lsoa_level_pop = map_func.convert_deciles_to_quintiles(df_inflated_lsoa_level_pop, 'IMD Decile')
-
-# Merge the GeoDataFrame with the count data DataFrame
-gdf_merged = geodf_lsoa_boundaries.merge(df_inflated_lsoa_level_pop, on='LSOA21CD', how='inner')
+if lsoa_geometry_store is None:
+    st.warning('The LSOA boundary shapefile could not be found, so maps are not available.')
+    list_outputs = [output for output in list_outputs if not output.startswith('Map - ')]
+    df_map_attributes = df_inflated_lsoa_level_pop.iloc[0:0]
+    use_vector_tiles = False
+else:
+    #attributes only (no geometry) for the LSOAs that have a boundary to draw
+    df_map_attributes = pop_ETL.run_lsoa_pipeline(['lsoa_map_attributes'], lsoa_pipeline_params)['lsoa_map_attributes']
+    #large areas are drawn from the vector tiles (if they have been built) rather than embedding every boundary in the page
+    use_vector_tiles = len(df_map_attributes) > vector_tiles.MIN_FEATURES_FOR_TILES and vector_tiles.tiles_available()
+lsoa_pipeline_params['use_vector_tiles'] = use_vector_tiles
 
 #list_test_to_map = ['LSOA21CD', 'geometry', 'Baseline Population']
 
@@ -407,20 +421,30 @@ if list_outputs:
                 st.subheader('Map of deprivation (IMD)')
                 st.write("""The below map shows deprivation quintiles, with areas more 
                 deprived shaded in red, and areas less deprived shaded in green.""")
-                imd_decile_map = map_func.render_folium_map_heatmap(gdf_merged, count_column='IMD Quintile', line_weight=1, color_scheme='RdYlGn', title='', LSOA_column = 'LSOA21CD')
+                map_func.show_map_html(pop_ETL.run_lsoa_pipeline(['imd_map'], lsoa_pipeline_params)['imd_map'])
             
             elif list_outputs[i] == 'Map - Population Change':
                 st.subheader(f'Map of Population Change ({pop_proj_gender}, aged {pop_proj_min_age}-{pop_proj_max_age})')
                 st.write('The below map shows modelled population change in the demographic of interest. Population decreases are shaded :blue[**blue**] and population increases are shaded :red[**red**].')
-                map = map_func.render_folium_map_heatmap_net_change(gdf_merged, 'Net Pop Change', line_weight=1, title='')
+                map_func.show_map_html(pop_ETL.run_lsoa_pipeline(['population_change_map'], lsoa_pipeline_params)['population_change_map'])
             
             elif list_outputs[i] == 'Map - Estimated Need Change':
                 st.subheader(f'Map of Estimated Change in Need ({pop_proj_gender}, aged {pop_proj_min_age}-{pop_proj_max_age})')
                 st.write('The below map shows modelled change in need, using the user entered prevalence rates, and applying these to the estimated future population. Decreases are shaded :blue[blue] and increases are shaded :red[red].')
-                map = map_func.render_folium_map_heatmap_net_change(gdf_merged, 'Net Need Change', line_weight=1, title='')
+                map_func.show_map_html(pop_ETL.run_lsoa_pipeline(['need_change_map'], lsoa_pipeline_params)['need_change_map'])
             
             elif list_outputs[i] == 'Chart - Population Change':
-                st.write('This section still needs to be built.')
+                st.subheader(f'Population Change from {pop_proj_baseline_year} ({pop_proj_gender}, aged {pop_proj_min_age}-{pop_proj_max_age})')
+                st.write(f'The below chart shows the modelled population of the selected LSOAs in every projection year. The selected forecast year ({pop_proj_forecast_year}) is marked in :red[**red**].')
+
+                #forecast population of every LSOA for every year from the baseline (the pipeline stage the forecast year is sliced from)
+                df_lsoa_trajectory = pop_ETL.run_lsoa_pipeline(['lsoa_trajectory'], lsoa_pipeline_params)['lsoa_trajectory']
+                df_population_trajectory = pop_ETL.summarise_lsoa_trajectory(df_lsoa_trajectory)
+
+                trajectory_variable = st.selectbox('What would you like to display on the chart?', options=['Forecast Population', 'Net Change', '% Change'], index=0)
+                st.altair_chart(pop_ETL.create_trajectory_chart(df_population_trajectory, trajectory_variable, pop_proj_forecast_year))
+                with st.expander(label='Click to view the population change in each year'):
+                    st.write(df_population_trajectory)
             
             elif list_outputs[i] == 'Map - Current demand vs Need':
                 st.subheader(f'Map of Baseline Estimated Need Seen ({pop_proj_gender}, aged {pop_proj_min_age}-{pop_proj_max_age})')
@@ -432,20 +456,102 @@ if list_outputs:
                 indicate areas where the volume of activity seen is less than 
                 the level of estimated need in that area, based on the entered prevalence rate.""")
                 
-                user_df = df_users_activity_per_lsoa[[lsoa_col, activity_count_col]]
-                gdf_subset_baseline_met_need = gdf_merged[['LSOA21CD', 'geometry', 'Baseline Need']]
+                lsoa_pipeline_params.update({'df_users_activity': df_users_activity_per_lsoa, 'lsoa_col': lsoa_col, 'activity_count_col': activity_count_col})
+                map_func.show_map_html(pop_ETL.run_lsoa_pipeline(['met_need_map'], lsoa_pipeline_params)['met_need_map'])
 
-                # Merge the GeoDataFrame with the DataFrame
-                gdf_subset_baseline_met_need = gdf_subset_baseline_met_need.merge(user_df, on=lsoa_col, how='left')
+            elif list_outputs[i] == 'Chart - Demand Scenarios':
+                st.subheader('Range of modelled demand change')
+                st.write(f"""The below shows the modelled net demand change in {pop_proj_forecast_year} over a range 
+                of prevalence rates and demand modifiers either side of the values entered, to give a range rather 
+                than a single estimate. The total modifier is the sum of the demand modifier considerations 
+                (technology, environmental, economic etc.).""")
 
-                # Fill missing Activity_Count values with 0
-                gdf_subset_baseline_met_need[activity_count_col] = gdf_subset_baseline_met_need[activity_count_col].fillna(0)
+                col1, col2, col3, col4 = st.columns(4)
+                with col1:
+                    baseline_prevalence_range = st.slider(label='Baseline prevalence range (% either side of entered value)', min_value=-50, max_value=50, value=(-10, 10))
+                with col2:
+                    forecast_prevalence_range = st.slider(label='Forecast prevalence range (% either side of entered value)', min_value=-50, max_value=50, value=(-10, 10))
+                with col3:
+                    modifier_range = st.slider(label='Total modifier range (%)', min_value=-100, max_value=100, value=(-20, 20))
+                with col4:
+                    scenario_steps = st.slider(label='Values tried for each', min_value=3, max_value=51, value=21, step=2)
+
+                if baseline_prevalence == 0:
+                    st.write('Enter a baseline prevalence above to model demand scenarios.')
+                else:
+                    #every combination of the three parameters, evaluated in one array computation
+                    df_demand_scenarios = scenario_engine.demand_scenarios(
+                        df_inflated_lsoa_level_pop['Baseline Population'],
+                        df_inflated_lsoa_level_pop['Forecast Population'],
+                        total_activity_number,
+                        scenario_engine.parameter_grid(baseline_prevalence * (1 + baseline_prevalence_range[0] / 100), baseline_prevalence * (1 + baseline_prevalence_range[1] / 100), scenario_steps),
+                        scenario_engine.parameter_grid(forecast_prevalence * (1 + forecast_prevalence_range[0] / 100), forecast_prevalence * (1 + forecast_prevalence_range[1] / 100), scenario_steps),
+                        scenario_engine.parameter_grid(modifier_range[0], modifier_range[1], scenario_steps),
+                        )
+
+                    st.write(f'Spread of results over {len(df_demand_scenarios):,} scenarios:')
+                    st.write(scenario_engine.scenario_range(df_demand_scenarios).round(1))
+
+                    st.subheader('Sensitivity to each parameter')
+                    st.write('Each chart varies one parameter over its range, holding the others at the entered values (and no modifier).')
+                    df_sensitivity = scenario_engine.one_way_sensitivity(df_demand_scenarios, {
+                        'Baseline prevalence': baseline_prevalence,
+                        'Forecast prevalence': forecast_prevalence,
+                        'Total modifier %': 0,
+                        })
+                    st.altair_chart(pop_ETL.create_sensitivity_chart(df_sensitivity, 'Modified Net Demand Change'))
+
+                    with st.expander(label='Click to view every scenario'):
+                        st.write(df_demand_scenarios)
+
+            elif list_outputs[i] == 'Chart - Demand Uncertainty':
+                st.subheader('Uncertainty in modelled demand change')
+                st.write(f"""The below gives a range for the modelled demand in {pop_proj_forecast_year} by drawing the 
+                prevalence rates, the error in the population projections and the total demand modifier at random 
+                from the distributions entered, and repeating the calculation for each draw. The percentiles show 
+                the range the results fall in, e.g. 90% of draws fall between the 5th and 95th percentiles.""")
+
+                uncertain_inputs = {
+                    'Baseline prevalence (per 100,000)': ('Normal', [baseline_prevalence, baseline_prevalence * 0.1]),
+                    'Forecast prevalence (per 100,000)': ('Normal', [forecast_prevalence, forecast_prevalence * 0.1]),
+                    'Population projection error (%)': ('Normal', [0.0, 2.0]),
+                    'Total modifier (%)': ('Normal', [0.0, 10.0]),
+                    }
+                input_distributions = []
+                for col, (input_label, (default_distribution, default_parameters)) in zip(st.columns(len(uncertain_inputs)), uncertain_inputs.items()):
+                    with col:
+                        distribution = st.selectbox(label=input_label, options=list(monte_carlo.DISTRIBUTIONS), index=list(monte_carlo.DISTRIBUTIONS).index(default_distribution))
+                        parameters = []
+                        for j, parameter_name in enumerate(monte_carlo.DISTRIBUTIONS[distribution]):
+                            #triangular and uniform default to the normal's mean +/- 2 standard deviations
+                            mean, sd = default_parameters
+                            default_value = {'low': mean - 2 * sd, 'high': mean + 2 * sd, 'standard deviation': sd}.get(parameter_name, mean)
+                            parameters.append(st.number_input(label=parameter_name.capitalize(), value=float(default_value), key=f'mc_{input_label}_{distribution}_{j}'))
+                        input_distributions.append((distribution, parameters))
+
+                col1, col2 = st.columns(2)
+                with col1:
+                    n_draws = st.select_slider(label='Number of draws', options=[1000, 2000, 5000, 10000, 20000, 50000], value=10000)
+                with col2:
+                    random_seed = st.number_input(label='Random seed (the same seed gives the same draws)', min_value=0, value=42, step=1)
 
-                # Calculate 'Baseline Met Need'
-                gdf_subset_baseline_met_need['Baseline Met Need'] = gdf_subset_baseline_met_need['Baseline Need'] - gdf_subset_baseline_met_need[activity_count_col]
+                if baseline_prevalence == 0:
+                    st.write('Enter a baseline prevalence above to model demand uncertainty.')
+                else:
+                    with stage_profiler.measure('simulate_demand_uncertainty', rows_in=len(df_inflated_lsoa_level_pop)) as profile_record:
+                        df_demand_draws, df_lsoa_need_bands = pop_ETL.simulate_demand_uncertainty(
+                            df_inflated_lsoa_level_pop, total_activity_number, *input_distributions, n_draws, int(random_seed))
+                        profile_record['rows_out'] = len(df_demand_draws)
+                    df_outcome_bands = monte_carlo.outcome_bands(df_demand_draws)
 
-                #st.write(gdf_subset_baseline_met_need.head())
-                map = map_func.render_folium_map_heatmap_net_change(gdf_subset_baseline_met_need, 'Baseline Met Need', line_weight=1, title='')
+                    st.write(f'Percentiles of the results over {n_draws:,} draws:')
+                    st.write(df_outcome_bands.round(1))
+
+                    uncertainty_variable = st.selectbox('What would you like to display on the chart?', options=list(df_outcome_bands.index), index=len(df_outcome_bands) - 1)
+                    st.altair_chart(pop_ETL.create_uncertainty_chart(df_demand_draws, uncertainty_variable, df_outcome_bands))
+
+                    with st.expander(label='Click to view the need percentiles for each LSOA'):
+                        st.write(df_lsoa_need_bands)
 
             elif list_outputs[i] == 'Chart - Modelled Demand Change':
                 st.header('Demand considerations')
@@ -642,7 +748,25 @@ if list_outputs:
                     else:
                         st.subheader(f":green[{round(forecast_demand_modified,0)}]")
 
-               
+#----------------------------------------
+#profile of this run (profiling mode), to find which step is slow
+#----------------------------------------
+if profiler is not None:
+    profiler.finish()
+    stage_profiler.activate(None)
+    df_profile = profiler.summary()
+
+    st.header(':green[Profile of this run]')
+    st.write(f'Run {profiler.run_id} took {profiler.total_seconds:.2f}s. Each bar is a step of the model, from when it started to when it finished (faded bars are steps reused from an earlier run). Hover over a bar for its peak memory and row counts.')
+    st.altair_chart(pop_ETL.create_profile_waterfall_chart(df_profile))
+    with st.expander(label='Click to view the timings of each step'):
+        st.dataframe(df_profile, hide_index=True)
+
+    profile_log_path = profiler.write_log(lsoa_pipeline_params)
+    if profile_log_path:
+        st.write(f'This run has been written to the profile log ({profile_log_path}).')
+    st.download_button(label='Download the profile (json)', data=profiler.to_json(lsoa_pipeline_params), file_name=f'profile_{profiler.run_id}.json', mime='application/json')
+
 
 
 #----------------------------------------
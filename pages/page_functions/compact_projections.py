@@ -0,0 +1,189 @@
+import numpy as np
+import pandas as pd
+
+from pages.page_functions import reference_store as ref_store
+
+#--------------------------------------------------------------
+# Compact in-memory form of the population projection tables.
+#
+# The projection frames repeat the local authority and gender names as
+# strings on every row and hold the ages as 91 separate int64 columns named
+# '0' to '90'. Here the names are integer codes into a list of categories,
+# the years an int16 array and the ages one contiguous int32 matrix
+# [row, age], so a national table takes a fraction of the memory and every
+# filter is a vectorised integer compare. to_frame() gives back the frame
+# the rest of the code was written against, for anything that needs it.
+#
+# No streamlit in here so it can be used by the pages and the command line.
+#--------------------------------------------------------------
+
+LOCATION_COLUMN = 'local authority'
+GENDER_COLUMN = 'Gender'
+YEAR_COLUMN = 'Year'
+TOTAL_COLUMN = 'All Ages'
+
+#----------------------------------------------
+
+def smallest_code_dtype(n_categories):
+    """
+    Smallest signed integer type able to hold codes for n_categories (and -1 for unknown).
+    """
+    for dtype in (np.int8, np.int16, np.int32):
+        if n_categories <= np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+
+class CompactProjections:
+    """
+    Population projections held as integer codes and a contiguous age matrix.
+
+    Attributes:
+    locations (ndarray): Local authority names, indexed by location_codes.
+    genders (ndarray): Gender labels ('Persons', 'Males', 'Females'), indexed by gender_codes.
+    location_codes (ndarray): Code of the local authority of each row.
+    gender_codes (ndarray): Code of the gender of each row.
+    years (ndarray): int16 projection year of each row.
+    ages (ndarray): int16 single years of age, in the order of the columns of counts.
+    counts (ndarray): C-contiguous int32 population counts [row, age].
+    totals (ndarray): int32 'All Ages' total of each row.
+    columns (list): Column order of the frame the table was built from, used by to_frame.
+    """
+
+    def __init__(self, locations, genders, location_codes, gender_codes, years, ages, counts, totals, columns):
+        self.locations = np.asarray(locations, dtype=object)
+        self.genders = np.asarray(genders, dtype=object)
+        self.location_codes = location_codes
+        self.gender_codes = gender_codes
+        self.years = years
+        self.ages = ages
+        self.counts = np.ascontiguousarray(counts)
+        self.totals = totals
+        self.columns = list(columns)
+
+        self.location_index = {location: i for i, location in enumerate(self.locations)}
+        self.gender_index = {gender: i for i, gender in enumerate(self.genders)}
+
+    def __len__(self):
+        return len(self.years)
+
+    @property
+    def nbytes(self):
+        """
+        Memory held by the arrays (the category names are counted once each).
+        """
+        arrays = (self.location_codes, self.gender_codes, self.years, self.ages, self.counts, self.totals)
+        names = sum(len(str(name)) for name in self.locations) + sum(len(str(name)) for name in self.genders)
+        return sum(array.nbytes for array in arrays) + names
+
+    #----------------------------------------------
+
+    def available_years(self):
+        """
+        Projection years in the table, ascending.
+        """
+        return [int(year) for year in np.unique(self.years)]
+
+    def age_labels(self):
+        """
+        The single years of age as the column names of the frame ('0' to '90').
+        """
+        return [str(age) for age in self.ages]
+
+    def age_positions(self, min_age, max_age):
+        """
+        Slice of the columns of counts for ages min_age to max_age (inclusive). Raises KeyError for
+        ages outside of the projections, as selecting a missing age column would.
+        """
+        low = int(min_age) - int(self.ages[0])
+        high = int(max_age) - int(self.ages[0]) + 1
+        if low < 0 or low >= len(self.ages):
+            raise KeyError(str(min_age))
+        if high <= 0 or high > len(self.ages):
+            raise KeyError(str(max_age))
+        return slice(low, high)
+
+    def rows(self, local_authorities=None, gender=None, years=None):
+        """
+        Boolean mask of the rows for any of the local authorities, the gender and any of the years.
+        Arguments left as None are not filtered on. Unknown names match no rows.
+        """
+        mask = np.ones(len(self), dtype=bool)
+        if local_authorities is not None:
+            codes = [self.location_index[location] for location in local_authorities if location in self.location_index]
+            mask &= np.isin(self.location_codes, np.array(codes, dtype=self.location_codes.dtype))
+        if gender is not None:
+            code = self.gender_index.get(ref_store.GENDER_LABELS.get(gender, gender), -1)
+            mask &= self.gender_codes == code
+        if years is not None:
+            mask &= np.isin(self.years, np.array(list(years), dtype=np.int64))
+        return mask
+
+    def age_counts(self, rows, min_age, max_age):
+        """
+        Counts for ages min_age to max_age of the selected rows (a mask or row positions), shaped [row, age].
+        """
+        return self.counts[rows, self.age_positions(min_age, max_age)]
+
+    #----------------------------------------------
+
+    def to_frame(self, rows=None):
+        """
+        The table (or the selected rows, a mask or row positions) as a frame laid out as the
+        projection csv: 'local authority', 'All Ages', '0' to '90', 'Year' and 'Gender'.
+        """
+        if rows is None:
+            rows = slice(None)
+        counts = self.counts[rows]
+        data = {
+            LOCATION_COLUMN: pd.Series(self.locations[self.location_codes[rows]], dtype='str'),
+            GENDER_COLUMN: pd.Series(self.genders[self.gender_codes[rows]], dtype='str'),
+            YEAR_COLUMN: self.years[rows].astype(np.int64),
+            TOTAL_COLUMN: self.totals[rows].astype(np.int64),
+        }
+        for i, label in enumerate(self.age_labels()):
+            data[label] = counts[:, i].astype(np.int64)
+        return pd.DataFrame({column: data[column] for column in self.columns})
+
+    def head(self, n=5):
+        return self.to_frame(np.arange(min(n, len(self))))
+
+#----------------------------------------------
+
+def compact_projections_from_frame(pop_df):
+    """
+    Build a CompactProjections from a projection frame with 'local authority', 'Gender',
+    'Year', 'All Ages' and single year of age ('0' to '90') columns.
+    """
+    age_columns = ref_store.age_columns_in(pop_df)
+    ages = np.array([int(age) for age in age_columns], dtype=np.int16)
+    if len(ages) and not np.array_equal(ages, np.arange(ages[0], ages[0] + len(ages))):
+        raise ValueError('the single year of age columns are not consecutive ages')
+
+    counts = pop_df[age_columns].to_numpy(dtype=np.int64)
+    totals = pop_df[TOTAL_COLUMN].to_numpy(dtype=np.int64)
+    if max(counts.max(initial=0), totals.max(initial=0)) > np.iinfo(np.int32).max:
+        raise ValueError('population counts are too large to hold as int32')
+
+    #codes in order of first appearance, as the projection cube has always used
+    location_codes, locations = pd.factorize(pop_df[LOCATION_COLUMN])
+    gender_codes, genders = pd.factorize(pop_df[GENDER_COLUMN].replace(ref_store.GENDER_LABELS))
+
+    return CompactProjections(
+        locations=list(locations),
+        genders=list(genders),
+        location_codes=location_codes.astype(smallest_code_dtype(len(locations))),
+        gender_codes=gender_codes.astype(smallest_code_dtype(len(genders))),
+        years=pop_df[YEAR_COLUMN].to_numpy(dtype=np.int16),
+        ages=ages,
+        counts=counts.astype(np.int32),
+        totals=totals.astype(np.int32),
+        columns=pop_df.columns,
+    )
+
+
+def load_compact_projections(table_name):
+    """
+    Load a projection table from the reference store ('pop_proj_district' or 'pop_proj_utla') in compact form.
+    """
+    return compact_projections_from_frame(ref_store.load_reference_table(table_name))
@@ -0,0 +1,201 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+import pandas as pd
+import pyarrow as pa
+
+from pages.page_functions import reference_store as ref_store
+
+#--------------------------------------------------------------
+# Disk backed cache of forecast results, shared by every replica of the
+# app (and the command line tools) that points at the same directory.
+#
+# Each result (a data frame, or a tuple of them) is written as Arrow IPC
+# files in FORECAST_DISK_CACHE_DIR, indexed by a small SQLite database
+# (results.sqlite) holding its size and when it was last used. Keys are a
+# hash of the parameters and the reference data version, so results
+# computed from older reference data are never reused (and are the first
+# to go when the cache is trimmed to FORECAST_DISK_CACHE_MB).
+#
+# Files are written under a temporary name and renamed into place, so a
+# replica never reads a half written result. If the directory is on a
+# shared volume it needs working file locks for SQLite.
+#
+# No streamlit in here so it can be used by the pages and the command line.
+#--------------------------------------------------------------
+
+DEFAULT_CACHE_DIR = os.path.join(ref_store.STORE_DIR, 'result_cache')
+DEFAULT_MAX_MB = 2048
+
+#bumped if the way results are written changes, so old files are not read
+CACHE_FORMAT_VERSION = 1
+
+#----------------------------------------------
+
+def is_cacheable(value):
+    """
+    True for the results the disk cache can hold: a data frame or a tuple of data frames.
+    """
+    if isinstance(value, pd.DataFrame):
+        return True
+    return isinstance(value, tuple) and len(value) > 0 and all(isinstance(item, pd.DataFrame) for item in value)
+
+
+def write_table(df, path):
+    table = pa.Table.from_pandas(df, preserve_index=True)
+    temporary_path = f'{path}.{uuid.uuid4().hex}.tmp'
+    with pa.OSFile(temporary_path, 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(temporary_path, path)
+
+
+def read_table(path):
+    with pa.memory_map(path, 'r') as source:
+        return pa.ipc.open_file(source).read_all().to_pandas()
+
+#----------------------------------------------
+
+class DiskResultCache:
+    """
+    Results on disk, trimmed to max_bytes by dropping results from other reference
+    data versions, then the least recently used.
+    """
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+
+    def _connect(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        connection = sqlite3.connect(os.path.join(self.cache_dir, 'results.sqlite'), timeout=30)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute("""
+            CREATE TABLE IF NOT EXISTS results (
+                key TEXT PRIMARY KEY,
+                version TEXT NOT NULL,
+                n_tables INTEGER NOT NULL,
+                is_tuple INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            )""")
+        return connection
+
+    def _table_path(self, key_hash, i):
+        return os.path.join(self.cache_dir, f'{key_hash}_{i}.arrow')
+
+    def version(self):
+        return f'{ref_store.reference_data_version()}-{CACHE_FORMAT_VERSION}'
+
+    def key_hash(self, key, version):
+        return hashlib.sha256(repr((version, key)).encode()).hexdigest()
+
+    def get(self, key):
+        """
+        Returns:
+        tuple: (True, result) if key is cached for the current reference data, otherwise (False, None).
+        """
+        version = self.version()
+        key_hash = self.key_hash(key, version)
+        with self._lock, self._connect() as connection:
+            row = connection.execute('SELECT n_tables, is_tuple FROM results WHERE key = ?', (key_hash,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return False, None
+            try:
+                tables = [read_table(self._table_path(key_hash, i)) for i in range(row[0])]
+            except (OSError, pa.ArrowInvalid):
+                #removed (or being replaced) by another process, treat it as not cached
+                connection.execute('DELETE FROM results WHERE key = ?', (key_hash,))
+                self.misses += 1
+                return False, None
+            connection.execute('UPDATE results SET last_used = ? WHERE key = ?', (time.time(), key_hash))
+            self.hits += 1
+        return True, tuple(tables) if row[1] else tables[0]
+
+    def put(self, key, value):
+        """
+        Write value to disk under key (results that are not data frames are not cached).
+        """
+        if not is_cacheable(value):
+            return
+        version = self.version()
+        key_hash = self.key_hash(key, version)
+        tables = list(value) if isinstance(value, tuple) else [value]
+        with self._lock:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            for i, df in enumerate(tables):
+                write_table(df, self._table_path(key_hash, i))
+            size = sum(os.path.getsize(self._table_path(key_hash, i)) for i in range(len(tables)))
+            with self._connect() as connection:
+                connection.execute(
+                    'INSERT OR REPLACE INTO results (key, version, n_tables, is_tuple, size, last_used) VALUES (?, ?, ?, ?, ?, ?)',
+                    (key_hash, version, len(tables), int(isinstance(value, tuple)), size, time.time()))
+                self.writes += 1
+                self._trim(connection, version)
+
+    def _trim(self, connection, version):
+        total = connection.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # other reference data versions first, then least recently used
+        rows = connection.execute(
+            'SELECT key, n_tables, size FROM results ORDER BY version = ?, last_used', (version,)).fetchall()
+        for key_hash, n_tables, size in rows:
+            if total <= self.max_bytes:
+                break
+            connection.execute('DELETE FROM results WHERE key = ?', (key_hash,))
+            for i in range(n_tables):
+                try:
+                    os.remove(self._table_path(key_hash, i))
+                except FileNotFoundError:
+                    pass
+            total -= size
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock, self._connect() as connection:
+            for key_hash, n_tables in connection.execute('SELECT key, n_tables FROM results').fetchall():
+                for i in range(n_tables):
+                    try:
+                        os.remove(self._table_path(key_hash, i))
+                    except FileNotFoundError:
+                        pass
+            connection.execute('DELETE FROM results')
+
+    def metrics(self):
+        """
+        Size on disk and this process's hit / write / eviction counts.
+        """
+        with self._lock, self._connect() as connection:
+            entries, size = connection.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results').fetchone()
+        lookups = self.hits + self.misses
+        return {
+            'entries': entries,
+            'size_mb': size / 2**20,
+            'max_mb': self.max_bytes / 2**20,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'writes': self.writes,
+            'evictions': self.evictions,
+        }
+
+
+def disk_cache_from_environment():
+    """
+    The disk cache configured by FORECAST_DISK_CACHE_DIR and FORECAST_DISK_CACHE_MB
+    (None if FORECAST_DISK_CACHE_MB is 0, turning it off).
+    """
+    max_mb = float(os.environ.get('FORECAST_DISK_CACHE_MB', DEFAULT_MAX_MB))
+    if max_mb <= 0:
+        return None
+    return DiskResultCache(os.environ.get('FORECAST_DISK_CACHE_DIR', DEFAULT_CACHE_DIR), int(max_mb * 2**20))
@@ -39,7 +39,8 @@ def render_warning_service_coverage():
     st.write(""":red[It is **your** responsibility to ensure the file you use 
     contains **only** the required summary information per service (e.g. service name, 
     min age seen, max age seen, gender seen, and geographical coverage indicated by 
-    'yes' or 'no') and **no other data**. In choosing this option you are 
+    'yes' or 'no', or by one row per area covered in an 'area covered' column) and 
+    **no other data**. In choosing this option you are 
     confirming you are doing so in accordance with your organisation's Information 
     Governance policies and all legal duties. 
     ]""")
@@ -0,0 +1,191 @@
+import weakref
+
+import numpy as np
+import pandas as pd
+
+from pages.page_functions import reference_store as ref_store
+from pages.page_functions import compact_projections
+
+#--------------------------------------------------------------
+# Dense array representation of the population projection tables.
+#
+# A projection frame (one row per local authority, gender and year, one
+# column per single year of age) is turned into an array indexed as
+# [geography, gender, year, age], plus a prefix sum over age so the total
+# population for any min-max age band is a subtraction of two values
+# rather than a sum over columns.
+#
+# No streamlit in here, the engine is shared with the command line tools.
+#--------------------------------------------------------------
+
+class ProjectionCube:
+    """
+    Population projections held as dense arrays.
+
+    Attributes:
+    locations (list): Local authority names, in the order of axis 0.
+    genders (list): Gender labels, in the order of axis 1.
+    years (list): Projection years, in the order of axis 2.
+    ages (ndarray): Single years of age, in the order of axis 3.
+    counts (ndarray): int64 population counts [geography, gender, year, age].
+    prefix (ndarray): Cumulative sum of counts over age with a leading zero,
+        so prefix[..., a] is the population aged below ages[a].
+    present (ndarray): bool [geography, gender, year], True where the source
+        frame had at least one row for that combination.
+
+    prefix can be passed in when it has already been computed (e.g. a cube
+    attached to shared memory, see shared_projections.py).
+    """
+
+    def __init__(self, locations, genders, years, ages, counts, present, prefix=None):
+        self.locations = list(locations)
+        self.genders = list(genders)
+        self.years = list(years)
+        self.ages = np.asarray(ages)
+        self.counts = counts
+        self.present = present
+
+        self.location_index = {location: i for i, location in enumerate(self.locations)}
+        self.gender_index = {gender: i for i, gender in enumerate(self.genders)}
+        self.year_index = {year: i for i, year in enumerate(self.years)}
+
+        if prefix is None:
+            prefix = np.zeros(counts.shape[:-1] + (counts.shape[-1] + 1,), dtype=counts.dtype)
+            np.cumsum(counts, axis=-1, out=prefix[..., 1:])
+        self.prefix = prefix
+
+    #----------------------------------------------
+
+    def gender_position(self, gender):
+        """
+        Position of gender on axis 1, accepting 'Male'/'Males' style labels. None if unknown.
+        """
+        gender = ref_store.GENDER_LABELS.get(gender, gender)
+        return self.gender_index.get(gender)
+
+    def year_position(self, year):
+        return self.year_index.get(year)
+
+    def age_position(self, age):
+        """
+        Position of a single year of age on axis 3. Raises KeyError for ages
+        outside of the projections, as selecting a missing age column would.
+        """
+        position = int(age) - int(self.ages[0])
+        if position < 0 or position >= len(self.ages):
+            raise KeyError(str(age))
+        return position
+
+    def location_positions(self, local_authorities):
+        """
+        Positions on axis 0 of the given local authorities. Names not in the
+        projections are returned as -1.
+        """
+        return np.array([self.location_index.get(location, -1) for location in local_authorities], dtype=np.int64)
+
+    #----------------------------------------------
+
+    def band_totals(self, local_authorities, gender, year, min_age, max_age):
+        """
+        Total population aged min_age to max_age (inclusive) for each local authority.
+
+        Returns:
+        Series: Totals indexed by local authority name (sorted, as a groupby
+        would), covering only the local authorities with data for that gender and year.
+        """
+        low = self.age_position(min_age)
+        high = self.age_position(max_age) + 1
+
+        g = self.gender_position(gender)
+        y = self.year_position(year)
+        if g is None or y is None:
+            return pd.Series([], index=pd.Index([], name='local authority'), dtype='int64')
+
+        names = sorted({location for location in local_authorities if location in self.location_index})
+        positions = self.location_positions(names)
+        positions = positions[self.present[positions, g, y]]
+        totals = self.prefix[positions, g, y, high] - self.prefix[positions, g, y, low]
+
+        return pd.Series(totals, index=pd.Index([self.locations[p] for p in positions], name='local authority'))
+
+    def single_age_counts(self, local_authorities, gender, year, min_age, max_age):
+        """
+        Population for each single year of age from min_age to max_age.
+
+        Returns:
+        tuple: (counts, present) where counts is an int64 array shaped
+        [age, local authority] in the order given, and present is a bool array
+        flagging the local authorities with data for that gender and year.
+        """
+        low = self.age_position(min_age)
+        high = self.age_position(max_age) + 1
+        n_ages = high - low
+
+        g = self.gender_position(gender)
+        y = self.year_position(year)
+        positions = self.location_positions(local_authorities)
+        if g is None or y is None:
+            return np.zeros((n_ages, len(positions)), dtype=np.int64), np.zeros(len(positions), dtype=bool)
+
+        present = (positions >= 0) & self.present[np.maximum(positions, 0), g, y]
+        counts = np.where(present[:, None], self.counts[np.maximum(positions, 0), g, y, low:high], 0)
+        return counts.T, present
+
+#----------------------------------------------
+
+def build_projection_cube(pop_df):
+    """
+    Build a ProjectionCube from population projections, either a CompactProjections
+    or a projection frame with 'local authority', 'Gender', 'Year', 'All Ages' and
+    single year of age columns ('0' to '90').
+    """
+    projections = pop_df
+    if not isinstance(projections, compact_projections.CompactProjections):
+        projections = compact_projections.compact_projections_from_frame(pop_df)
+
+    years, year_codes = np.unique(projections.years, return_inverse=True)
+    codes = (projections.location_codes, projections.gender_codes, year_codes)
+
+    shape = (len(projections.locations), len(projections.genders), len(years))
+    counts = np.zeros(shape + (len(projections.ages),), dtype=np.int64)
+    #rows are accumulated so duplicate (location, gender, year) rows are summed, as a groupby would
+    np.add.at(counts, codes, projections.counts)
+
+    present = np.zeros(shape, dtype=bool)
+    present[codes] = True
+
+    return ProjectionCube(
+        locations=list(projections.locations),
+        genders=list(projections.genders),
+        years=[int(year) for year in years],
+        ages=projections.ages.astype(np.int64),
+        counts=counts,
+        present=present,
+    )
+
+#----------------------------------------------
+
+#cubes built so far, keyed on id() of the frame they were built from
+_projection_cubes = {}
+
+def projection_cube_for(pop_df):
+    """
+    Return the ProjectionCube for pop_df (a CompactProjections or frame), building it on first use.
+    A ProjectionCube is returned as it is.
+
+    Cubes are kept for as long as the table they were built from is alive,
+    so the shared reference tables are only converted once per process.
+    The table must not be modified in place after the cube is built.
+    """
+    if isinstance(pop_df, ProjectionCube):
+        return pop_df
+
+    key = id(pop_df)
+    entry = _projection_cubes.get(key)
+    if entry is not None and entry[0]() is pop_df:
+        return entry[1]
+
+    cube = build_projection_cube(pop_df)
+    frame_ref = weakref.ref(pop_df, lambda _, key=key: _projection_cubes.pop(key, None))
+    _projection_cubes[key] = (frame_ref, cube)
+    return cube
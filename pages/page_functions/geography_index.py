@@ -0,0 +1,96 @@
+import numpy as np
+import pandas as pd
+
+#--------------------------------------------------------------
+# Prebuilt LSOA to district / UTLA index for an LSOA baseline frame.
+#
+# Each LSOA row of the baseline is given an integer district id (from the
+# LSOA lookup) and UTLA id (from the 'LA Name' column of the baseline), and
+# for every area the row offsets of its LSOAs are stored. Selecting LSOAs
+# for a set of areas is then a gather of precomputed row positions rather
+# than merging the lookup onto the baseline and scanning it with isin.
+#
+# lsoa_catchments.py (and so forecast_service_demand.py) imports this, so
+# it must not import streamlit.
+#--------------------------------------------------------------
+
+DISTRICT_COLUMN = 'LAD23NM'
+UTLA_COLUMN = 'LA Name'
+
+#column holding the area names, for each geography level
+GEOGRAPHY_LEVEL_COLUMNS = {
+    'Upper Tier or Unitary Authority': UTLA_COLUMN,
+    'District Authority or Place': DISTRICT_COLUMN,
+}
+
+
+class LsoaGeographyIndex:
+    """
+    Row positions of the LSOAs in each district and UTLA of a baseline frame.
+
+    Attributes:
+    lsoa_codes (ndarray): LSOA 2021 code of each row.
+    area_names (dict): Column name -> ndarray of area names, in id order.
+    area_ids (dict): Column name -> int32 ndarray of the area id of each row (-1 if unknown).
+    rows_by_area (dict): Column name -> {area name: int64 ndarray of row offsets}.
+    """
+
+    def __init__(self, lsoa_codes, area_labels):
+        self.lsoa_codes = np.asarray(lsoa_codes)
+        self.area_names = {}
+        self.area_ids = {}
+        self.rows_by_area = {}
+
+        for column, labels in area_labels.items():
+            ids, names = pd.factorize(pd.Series(labels))
+            ids = ids.astype(np.int32)
+            order = np.argsort(ids, kind='stable')
+            boundaries = np.searchsorted(ids[order], np.arange(len(names) + 1))
+
+            self.area_names[column] = np.asarray(names, dtype=object)
+            self.area_ids[column] = ids
+            self.rows_by_area[column] = {
+                name: order[boundaries[i]:boundaries[i + 1]].astype(np.int64) for i, name in enumerate(names)}
+
+    def rows_for_areas(self, column, areas):
+        """
+        Row offsets (in frame order) of every LSOA in any of the areas.
+        Unknown area names are ignored.
+        """
+        rows_by_area = self.rows_by_area[column]
+        selected = [rows_by_area[area] for area in set(areas) if area in rows_by_area]
+        if not selected:
+            return np.array([], dtype=np.int64)
+        return np.sort(np.concatenate(selected))
+
+    def area_names_for_rows(self, column, rows):
+        """
+        Area name of each of the given rows (None where the LSOA has no area).
+        """
+        ids = self.area_ids[column][rows]
+        names = np.append(self.area_names[column], None)
+        return names[ids]
+
+
+def build_lsoa_geography_index(baseline_lsoa_pop_syoa, lsoa_district_utla_lookup):
+    """
+    Build the index for a baseline frame.
+
+    Parameters:
+    baseline_lsoa_pop_syoa (DataFrame): LSOA single year of age baseline, with
+        'LSOA 2021 Code' and 'LA Name' (UTLA) columns.
+    lsoa_district_utla_lookup (DataFrame): Lookup with 'LSOA21CD' and 'LAD23NM' columns.
+
+    Returns:
+    LsoaGeographyIndex
+    """
+    lsoa_codes = baseline_lsoa_pop_syoa['LSOA 2021 Code'].to_numpy()
+
+    lookup = lsoa_district_utla_lookup.drop_duplicates(subset='LSOA21CD')
+    lookup_rows = pd.Index(lookup['LSOA21CD']).get_indexer(lsoa_codes)
+    district_names = np.append(lookup[DISTRICT_COLUMN].to_numpy(dtype=object), None)[lookup_rows]
+
+    return LsoaGeographyIndex(lsoa_codes, {
+        DISTRICT_COLUMN: district_names,
+        UTLA_COLUMN: baseline_lsoa_pop_syoa[UTLA_COLUMN].to_numpy(dtype=object),
+    })
@@ -0,0 +1,242 @@
+import json
+import os
+import uuid
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+from pages.page_functions import reference_store as ref_store
+
+#--------------------------------------------------------------
+# Precomputed LSOA boundaries, ready to embed in a Folium map.
+#
+# The boundary shapefile is simplified once at a few zoom appropriate
+# tolerances (keeping shared edges between neighbouring LSOAs intact),
+# reprojected to WGS84, rounded to ~1m and written to the store as
+# GeoJSON keyed by LSOA code. At render time only the attribute values
+# (net change, need, IMD quintile) are joined onto the prepared geometry,
+# so nothing is reprojected or re-serialised from a GeoDataFrame.
+#--------------------------------------------------------------
+
+#simplification tolerance in metres (British National Grid) for each level of detail
+SIMPLIFY_TOLERANCES = {
+    'full': 0,
+    'fine': 5,
+    'medium': 20,
+    'coarse': 75,
+}
+
+#the largest number of LSOAs drawn at each level of detail, coarser levels are used beyond this
+DETAIL_FEATURE_LIMITS = [
+    ('fine', 1000),
+    ('medium', 5000),
+    ('coarse', None),
+]
+
+#decimal places kept in WGS84 coordinates (5 is roughly 1m)
+COORDINATE_PRECISION = 5
+
+LSOA_CODE_COLUMN = 'LSOA21CD'
+
+#features read from the shapefile at a time when limiting it to a region
+SHAPEFILE_CHUNK_FEATURES = 5000
+
+#----------------------------------------------
+
+def geojson_store_path(detail):
+    return os.path.join(ref_store.STORE_DIR, f'lsoa_boundaries_{detail}.geojson')
+
+
+def is_stale(detail, shapefile_path=ref_store.LSOA_SHAPEFILE_PATH):
+    path = geojson_store_path(detail)
+    if not os.path.exists(path):
+        return True
+    if os.path.exists(ref_store.REGION_PATH) and os.path.getmtime(path) < os.path.getmtime(ref_store.REGION_PATH):
+        return True
+    return os.path.getmtime(path) < os.path.getmtime(shapefile_path)
+
+
+def read_lsoa_boundaries(shapefile_path, selection=None):
+    """
+    Read the LSOA boundaries, keeping only the LSOAs in the region.
+
+    Parameters:
+    selection (dict): Output of reference_store.region_selection, or None to read every LSOA.
+        With a region the shapefile is read SHAPEFILE_CHUNK_FEATURES at a time, so a
+        national boundary file is never held in memory whole.
+    """
+    if selection is None:
+        return gpd.read_file(shapefile_path)
+    chunks = []
+    start = 0
+    while True:
+        chunk = gpd.read_file(shapefile_path, rows=slice(start, start + SHAPEFILE_CHUNK_FEATURES))
+        if len(chunk) == 0:
+            break
+        chunks.append(chunk[chunk[LSOA_CODE_COLUMN].isin(selection['lsoas'])])
+        start += SHAPEFILE_CHUNK_FEATURES
+    return gpd.GeoDataFrame(pd.concat(chunks, ignore_index=True), crs=chunks[0].crs)
+
+
+def simplify_boundaries(geometries, tolerance):
+    """
+    Simplify a set of polygons that tile an area without opening gaps or
+    overlaps between neighbours (falls back to per polygon simplification
+    on older GEOS versions).
+    """
+    if tolerance == 0:
+        return geometries
+    if hasattr(shapely, 'coverage_simplify'):
+        return shapely.coverage_simplify(geometries, tolerance)
+    return shapely.simplify(geometries, tolerance, preserve_topology=True)
+
+#----------------------------------------------
+
+def build_geojson_store(gdf_lsoa, detail, region=''):
+    """
+    Write the LSOA boundaries at one level of detail to the store.
+
+    Parameters:
+    gdf_lsoa (GeoDataFrame): LSOA boundaries with an 'LSOA21CD' column, in any projected CRS.
+    detail (str): One of the keys in SIMPLIFY_TOLERANCES.
+    region (str): Fingerprint of the region the boundaries were limited to (see reference_store.region_fingerprint).
+
+    Returns:
+    dict: The GeoJSON FeatureCollection that was written.
+    """
+    gdf = gdf_lsoa[[LSOA_CODE_COLUMN, 'geometry']].to_crs(epsg=27700)
+    geometries = simplify_boundaries(np.asarray(gdf.geometry), SIMPLIFY_TOLERANCES[detail])
+
+    #centroids are taken in metres before reprojecting, so they are not distorted
+    centroids = gpd.GeoSeries(shapely.centroid(np.asarray(gdf.geometry)), crs=27700).to_crs(epsg=4326)
+    geometries = gpd.GeoSeries(geometries, crs=27700).to_crs(epsg=4326)
+    geometries = shapely.set_precision(np.asarray(geometries), 10 ** -COORDINATE_PRECISION)
+
+    features = []
+    for code, geometry_json, centroid in zip(gdf[LSOA_CODE_COLUMN], shapely.to_geojson(geometries), centroids):
+        features.append({
+            'type': 'Feature',
+            'id': code,
+            'geometry': json.loads(geometry_json),
+            'properties': {
+                LSOA_CODE_COLUMN: code,
+                'centroid_lat': round(centroid.y, COORDINATE_PRECISION),
+                'centroid_lon': round(centroid.x, COORDINATE_PRECISION),
+            },
+        })
+    feature_collection = {'type': 'FeatureCollection', 'region': region, 'features': features}
+
+    os.makedirs(ref_store.STORE_DIR, exist_ok=True)
+    #a temp file of its own, so concurrent builders never write to the same file
+    tmp_path = f'{geojson_store_path(detail)}.{uuid.uuid4().hex}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(feature_collection, f, separators=(',', ':'))
+    os.replace(tmp_path, geojson_store_path(detail))
+    return feature_collection
+
+
+def build_geometry_store(force=False, shapefile_path=ref_store.LSOA_SHAPEFILE_PATH):
+    """
+    Build (or refresh) the GeoJSON boundaries at every level of detail.
+
+    Returns:
+    list: Levels of detail that were (re)built (empty if there is no shapefile).
+    """
+    if not os.path.exists(shapefile_path):
+        return []
+    stale = [detail for detail in SIMPLIFY_TOLERANCES if force or is_stale(detail, shapefile_path)]
+    if stale:
+        selection = ref_store.region_selection(ref_store.read_region())
+        gdf_lsoa = read_lsoa_boundaries(shapefile_path, selection)
+        for detail in stale:
+            build_geojson_store(gdf_lsoa, detail, selection['fingerprint'] if selection is not None else '')
+    return stale
+
+#----------------------------------------------
+
+class LsoaGeometryStore:
+    """
+    LSOA boundaries at one level of detail, as GeoJSON geometry keyed by LSOA code.
+    Shared between sessions, so the geometry dicts must not be modified.
+    """
+
+    def __init__(self, feature_collection):
+        features = feature_collection['features']
+        self.codes = pd.Index([feature['id'] for feature in features])
+        self.geometries = [feature['geometry'] for feature in features]
+        self.centroid_lat = np.array([feature['properties']['centroid_lat'] for feature in features])
+        self.centroid_lon = np.array([feature['properties']['centroid_lon'] for feature in features])
+
+    def positions(self, lsoa_codes):
+        """
+        Integer position of each LSOA code in the store (-1 where it has no boundary).
+        """
+        return self.codes.get_indexer(lsoa_codes)
+
+    def has_boundary(self, lsoa_codes):
+        """
+        Boolean mask of the LSOA codes that have a boundary in the store.
+        """
+        return self.positions(lsoa_codes) >= 0
+
+    def centre(self, positions):
+        """
+        [lat, lon] at the mean centroid of the LSOAs at the given positions.
+        """
+        return [float(self.centroid_lat[positions].mean()), float(self.centroid_lon[positions].mean())]
+
+    def feature_collection(self, df_attributes, property_columns, lsoa_column=LSOA_CODE_COLUMN):
+        """
+        Join attribute values onto the stored boundaries.
+
+        Parameters:
+        df_attributes (DataFrame): One row per LSOA, with lsoa_column and property_columns.
+        property_columns (list): Columns to include as feature properties.
+        lsoa_column (str): Column holding the LSOA 2021 code.
+
+        Returns:
+        tuple: (GeoJSON FeatureCollection dict, positions of the LSOAs drawn).
+        LSOAs without a boundary in the store are left out.
+        """
+        positions = self.positions(df_attributes[lsoa_column])
+        has_boundary = positions >= 0
+        positions = positions[has_boundary]
+
+        columns = list(dict.fromkeys([lsoa_column] + list(property_columns)))
+        attributes = df_attributes.loc[has_boundary, columns]
+        #missing values become null rather than NaN, which is not valid json
+        records = attributes.astype(object).where(attributes.notna(), None).to_dict(orient='records')
+
+        features = [
+            {'type': 'Feature', 'id': code, 'geometry': self.geometries[position], 'properties': properties}
+            for code, position, properties in zip(attributes[lsoa_column], positions, records)]
+        return {'type': 'FeatureCollection', 'features': features}, positions
+
+
+def load_geometry_store(detail):
+    """
+    Load the LSOA boundaries at one level of detail, building the store first if needed.
+    Returns None if the boundary shapefile is not available.
+    """
+    if not os.path.exists(geojson_store_path(detail)) or (
+            os.path.exists(ref_store.LSOA_SHAPEFILE_PATH) and is_stale(detail)):
+        if not build_geometry_store():
+            return None
+    with open(geojson_store_path(detail)) as f:
+        feature_collection = json.load(f)
+    #built for another region (e.g. build_data/region.txt was removed since)
+    if feature_collection.get('region', '') != ref_store.region_fingerprint(ref_store.read_region()) and build_geometry_store(force=True):
+        with open(geojson_store_path(detail)) as f:
+            feature_collection = json.load(f)
+    return LsoaGeometryStore(feature_collection)
+
+
+def detail_for_feature_count(n_features):
+    """
+    Level of detail to draw for a map of n_features LSOAs.
+    """
+    for detail, limit in DETAIL_FEATURE_LIMITS:
+        if limit is None or n_features <= limit:
+            return detail
@@ -0,0 +1,90 @@
+import numpy as np
+
+#--------------------------------------------------------------
+# Precomputed age band totals for an LSOA baseline frame.
+#
+# The single year of age columns of the baseline are summed cumulatively
+# over age once, when the baseline is loaded (one array per gender, as
+# there is one baseline frame per gender). The population of any age band
+# for any set of LSOA rows is then two gathers and a subtraction, rather
+# than summing the band's columns across every selected row each time the
+# age range changes.
+#
+# Also used by lsoa_catchments.py for the batch forecasts, so no streamlit.
+#--------------------------------------------------------------
+
+FIRST_AGE_COLUMN = '0'
+
+
+class LsoaAgePrefixSums:
+    """
+    Cumulative single year of age population of each LSOA row of a baseline frame.
+
+    Attributes:
+    ages (ndarray): Single years of age, in column order.
+    prefix (ndarray): int64 [row, age] cumulative sum over age with a leading
+        zero, so prefix[r, a] is the population of row r aged below ages[a].
+    """
+
+    def __init__(self, ages, counts):
+        self.ages = np.asarray(ages, dtype=np.int64)
+        counts = np.asarray(counts, dtype=np.int64)
+        self.prefix = np.zeros((counts.shape[0], counts.shape[1] + 1), dtype=np.int64)
+        np.cumsum(counts, axis=1, out=self.prefix[:, 1:])
+
+    def age_position(self, age):
+        """
+        Position of a single year of age. Raises KeyError for ages outside of
+        the baseline, as selecting a missing age column would.
+        """
+        position = int(age) - int(self.ages[0])
+        if position < 0 or position >= len(self.ages):
+            raise KeyError(str(age))
+        return position
+
+    def band_totals(self, rows, min_age, max_age):
+        """
+        Population aged min_age to max_age (inclusive) of each of the given rows.
+
+        Parameters:
+        rows (ndarray): Row offsets into the baseline frame.
+        min_age (int): Youngest age in the band.
+        max_age (int): Oldest age in the band.
+
+        Returns:
+        ndarray: int64 total of each row, in the order given (zeros for an empty band).
+        """
+        start = self.age_position(min_age)
+        end = self.age_position(max_age) + 1
+        if end <= start:
+            return np.zeros(len(rows), dtype=np.int64)
+        return self.prefix[rows, end] - self.prefix[rows, start]
+
+
+def age_columns_in(baseline_lsoa_pop_syoa):
+    """
+    The single year of age columns of a baseline frame: the consecutive ages from '0'.
+    """
+    age_start_col_index = int(baseline_lsoa_pop_syoa.columns.get_loc(FIRST_AGE_COLUMN))
+    age_columns = []
+    for column in baseline_lsoa_pop_syoa.columns[age_start_col_index:]:
+        if not str(column).isdigit():
+            break
+        age_columns.append(column)
+    return age_columns
+
+
+def build_lsoa_age_prefix_sums(baseline_lsoa_pop_syoa):
+    """
+    Build the prefix sums for a baseline frame.
+
+    Parameters:
+    baseline_lsoa_pop_syoa (DataFrame): LSOA single year of age baseline, with
+        one column per single year of age from '0' onwards.
+
+    Returns:
+    LsoaAgePrefixSums
+    """
+    age_columns = age_columns_in(baseline_lsoa_pop_syoa)
+    counts = baseline_lsoa_pop_syoa[age_columns].to_numpy(dtype=np.int64)
+    return LsoaAgePrefixSums([int(column) for column in age_columns], counts)
@@ -0,0 +1,76 @@
+import numpy as np
+import pandas as pd
+
+from pages.page_functions import geography_index
+
+#--------------------------------------------------------------
+# Apportioning higher level population change down to LSOAs.
+#
+# Forecasts are only available for districts / UTLAs, so the % change for
+# each single year of age in an area is applied to every LSOA in that area.
+# Rather than updating the LSOA frame once per (area, age), the changes are
+# arranged as a growth factor matrix [area, age], each LSOA is mapped to its
+# area's row once, and all factors are applied in a single multiply over
+# the LSOA x age array.
+#--------------------------------------------------------------
+
+#column in the LSOA frame holding the higher level area, for each geography level
+GEOGRAPHY_LEVEL_COLUMNS = geography_index.GEOGRAPHY_LEVEL_COLUMNS
+
+#----------------------------------------------
+
+def growth_factor_matrix(df_higher_level_pop_change, age_columns):
+    """
+    Arrange % change by location and age as multiplicative growth factors.
+
+    Parameters:
+    df_higher_level_pop_change (DataFrame): 'Location', 'Age' and '% Change' columns
+        (as returned by forecast_population_by_age).
+    age_columns (list): Age column names (strings) of the LSOA frame, in order.
+
+    Returns:
+    tuple: (locations, factors) where factors is a float array [location, age]
+    of 1 + % change / 100, and 1.0 where there is no change for that location and age.
+    """
+    change = df_higher_level_pop_change[['Location', 'Age', '% Change']]
+    locations = pd.Index(pd.unique(change['Location']))
+
+    location_codes = locations.get_indexer(change['Location'])
+    age_codes = pd.Index(age_columns).get_indexer(change['Age'].astype(str))
+    in_lsoa_frame = age_codes >= 0
+
+    factors = np.ones((len(locations), len(age_columns)), dtype=np.float64)
+    #multiply rather than assign, so repeated (location, age) rows compound as they would if applied in turn
+    np.multiply.at(
+        factors,
+        (location_codes[in_lsoa_frame], age_codes[in_lsoa_frame]),
+        1 + (change['% Change'].to_numpy(dtype=np.float64)[in_lsoa_frame] / 100.0))
+
+    return locations, factors
+
+
+def lsoa_factor_rows(lsoa_locations, locations, factors):
+    """
+    Growth factors for each LSOA, given the higher level location of each LSOA.
+    LSOAs in a location with no change get factors of 1.0.
+    """
+    codes = locations.get_indexer(lsoa_locations)
+    #append a row of ones for LSOAs that are not in any of the locations (code -1)
+    factors_with_default = np.vstack([factors, np.ones((1, factors.shape[1]))])
+    return factors_with_default[codes]
+
+
+def apply_growth_factors(lsoa_age_values, lsoa_locations, locations, factors):
+    """
+    Multiply each LSOA's single year of age populations by its location's growth factors.
+
+    Parameters:
+    lsoa_age_values (ndarray): Population [LSOA, age].
+    lsoa_locations (array-like): Higher level location of each LSOA.
+    locations (Index): Locations of the rows in factors.
+    factors (ndarray): Growth factors [location, age].
+
+    Returns:
+    ndarray: Forecast population [LSOA, age].
+    """
+    return lsoa_age_values * lsoa_factor_rows(lsoa_locations, locations, factors)
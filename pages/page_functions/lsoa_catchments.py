@@ -0,0 +1,192 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from pages.page_functions import reference_store as ref_store
+from pages.page_functions import geography_index
+from pages.page_functions import lsoa_age_sums
+from pages.page_functions import service_demand
+from pages.page_functions import trajectory
+
+#--------------------------------------------------------------
+# Service populations from LSOA catchments.
+#
+# A long format coverage file can list the LSOAs each service covers (and
+# the share of each LSOA it serves) rather than districts / UTLAs. The
+# single year of age baselines of every LSOA are held as one cube
+# [gender, LSOA, age], with their cumulative sums over age built once when
+# it is loaded. For each gender and forecast year the LSOA forecast is the
+# baseline with the % change by single year of age of its district / UTLA
+# applied (as the mapping page apportions change), summed cumulatively
+# over age. The catchments are a sparse [service, LSOA] matrix of shares:
+# each of its entries takes its LSOA's total for the service's age band
+# from the prefix sums (two gathers and a subtraction) times the share,
+# and these are summed per service, for every service of the gender in one
+# pass. The work is proportional to the entries, however many different
+# age bands the services have, and only LSOAs in some catchment are forecast.
+#
+# No streamlit in here so it can be used by the pages and the command line.
+#--------------------------------------------------------------
+
+GENDERS = ['Persons', 'Males', 'Females']
+
+
+class LsoaAgeCube:
+    """
+    Single year of age baseline population of every LSOA, for each gender.
+
+    Attributes:
+    lsoa_codes (Index): LSOA 2021 codes, in the order of axis 1.
+    genders (list): Gender labels, in the order of axis 0.
+    ages (ndarray): Single years of age, in the order of axis 2.
+    counts (ndarray): int32 population [gender, LSOA, age].
+    prefix (ndarray): int64 cumulative sum of counts over age with a leading zero,
+        shaped [gender, age, LSOA] so prefix[g, a, l] is the population of LSOA l
+        aged below ages[a]. Ages are on axis 1 so that reading one age for the LSOAs
+        of a catchment stays within one row.
+    area_names (dict): Column name ('LAD23NM', 'LA Name') -> ndarray of the
+        district / UTLA of each LSOA (None where it is not known).
+    """
+
+    def __init__(self, lsoa_codes, genders, ages, counts, area_names):
+        self.lsoa_codes = pd.Index(lsoa_codes)
+        self.genders = list(genders)
+        self.ages = np.asarray(ages, dtype=np.int64)
+        self.counts = counts
+        self.area_names = area_names
+        self.gender_index = {gender: i for i, gender in enumerate(self.genders)}
+
+        self.prefix = np.zeros((counts.shape[0], counts.shape[2] + 1, counts.shape[1]), dtype=np.int64)
+        for g in range(counts.shape[0]):
+            self.prefix[g, 1:] = np.cumsum(counts[g], axis=1).T
+
+    def gender_position(self, gender):
+        """
+        Position of gender on axis 0, accepting 'Male'/'Males' style labels. None if unknown.
+        """
+        gender = ref_store.GENDER_LABELS.get(gender, gender)
+        return self.gender_index.get(gender)
+
+    def lsoa_locations(self, cube):
+        """
+        District or UTLA of each LSOA, whichever level the projection cube is for
+        (the one with more LSOAs in an area of the projections).
+        """
+        locations = pd.Index(cube.locations)
+        return max(self.area_names.values(), key=lambda names: (locations.get_indexer(names) >= 0).sum())
+
+    #----------------------------------------------
+
+    def service_population_trajectory(self, cube, catchments, lsoa_codes, genders, min_ages, max_ages, years):
+        """
+        Total population covered by each service in each year, from LSOA catchments.
+
+        The LSOA population in each year is the baseline with the % change by single year
+        of age of its district / UTLA from the first year in years applied (the same rules
+        as forecast_population_by_age), so the first year gives the LSOA baseline.
+
+        Parameters:
+        cube (ProjectionCube): Population projections, for the % changes.
+        catchments (sparse matrix or ndarray): Boolean coverage, or float shares served (services x LSOAs).
+        lsoa_codes (list): LSOA codes (columns of catchments).
+        genders (array-like): Gender seen by each service.
+        min_ages, max_ages (array-like): Age band (inclusive) of each service.
+        years (list): Projection years, the baseline year first.
+
+        Returns:
+        ndarray: float64 populations shaped [year, service]. LSOAs or genders that are
+        not in the baselines contribute zero, LSOAs outside the projections keep their
+        baseline population.
+        """
+        low, high = service_demand.age_band_positions(self.ages, min_ages, max_ages)
+        populations = np.zeros((len(years), len(low)), dtype=np.float64)
+        service_genders = service_demand.gender_positions(genders, self.gender_position)
+
+        #the entries of the catchments in service order: service, LSOA (position in the cube)
+        #and share, dropping LSOAs not in the baselines and services of unknown genders
+        catchments = sparse.csr_array(catchments)
+        catchments.sum_duplicates()
+        services = np.repeat(np.arange(catchments.shape[0]), np.diff(catchments.indptr))
+        lsoas = self.lsoa_codes.get_indexer(lsoa_codes)[catchments.indices]
+        shares = catchments.data.astype(np.float64)
+        keep = (lsoas >= 0) & (service_genders[services] >= 0)
+        if not keep.all():
+            services, lsoas, shares = services[keep], lsoas[keep], shares[keep]
+
+        #only the LSOAs in some catchment are forecast
+        used = np.zeros(len(self.lsoa_codes), dtype=bool)
+        used[lsoas] = True
+        used_lsoas = np.flatnonzero(used) if not used.all() else slice(None)
+        lsoa_locations = self.lsoa_locations(cube)[used_lsoas]
+        location_names = [name for name in pd.unique(lsoa_locations) if name is not None]
+
+        #where each entry's band starts and ends in the flattened [gender, age, LSOA] prefix sums
+        n_lsoas = len(self.lsoa_codes)
+        width = len(self.ages) + 1
+        service_offsets = service_genders * width * n_lsoas
+        entry_low = (service_offsets + low * n_lsoas)[services] + lsoas
+        entry_high = (service_offsets + high * n_lsoas)[services] + lsoas
+        genders_used = np.unique(service_genders[np.bincount(services, minlength=len(low)) > 0])
+
+        #% change by single year of age [year, location, age] of the LSOAs' areas, for each gender
+        location_factors = {}
+        for g in genders_used:
+            locations, percent_change = trajectory.age_change_trajectory(
+                cube, location_names, self.ages[0], self.ages[-1], years[0], years, self.genders[g])
+            #a row of no change for the LSOAs outside the locations
+            location_factors[g] = np.concatenate([1 + percent_change / 100, np.ones((len(years), 1, len(self.ages)))], axis=1)
+        codes = pd.Index(location_names).get_indexer(lsoa_locations)
+        codes[codes < 0] = len(location_names)
+
+        forecast_prefix = np.zeros(self.prefix.shape, dtype=np.float64)
+        for i, year in enumerate(years):
+            if year == years[0]:
+                #no change from the baseline year, the baseline prefix sums built at load are used
+                flat_prefix = self.prefix.ravel()
+            else:
+                for g in genders_used:
+                    forecast = self.counts[g, used_lsoas] * location_factors[g][i][codes]
+                    forecast_prefix[g][1:, used_lsoas] = np.cumsum(forecast, axis=1).T
+                flat_prefix = forecast_prefix.ravel()
+            #each entry: its LSOA's band total (two gathers and a subtraction) times its share, summed per service
+            band_totals = shares * (flat_prefix.take(entry_high) - flat_prefix.take(entry_low))
+            populations[i] = np.bincount(services, weights=band_totals, minlength=len(low))
+        return populations
+
+
+def build_lsoa_age_cube(baselines, lsoa_district_utla_lookup):
+    """
+    Build the cube from the baseline frame of each gender.
+
+    Parameters:
+    baselines (dict): Gender -> LSOA single year of age baseline frame.
+    lsoa_district_utla_lookup (DataFrame): Lookup with 'LSOA21CD' and 'LAD23NM' columns.
+
+    Returns:
+    LsoaAgeCube
+    """
+    #the LSOAs, their areas and the ages are taken from the first baseline
+    first_baseline = next(iter(baselines.values()))
+    index = geography_index.build_lsoa_geography_index(first_baseline, lsoa_district_utla_lookup)
+    all_rows = np.arange(len(first_baseline))
+    area_names = {column: index.area_names_for_rows(column, all_rows) for column in index.area_names}
+    lsoa_codes = pd.Index(index.lsoa_codes)
+    age_columns = lsoa_age_sums.age_columns_in(first_baseline)
+
+    counts = np.zeros((len(baselines), len(lsoa_codes), len(age_columns)), dtype=np.int32)
+    for g, baseline_lsoa_pop_syoa in enumerate(baselines.values()):
+        values = baseline_lsoa_pop_syoa[age_columns].to_numpy(dtype=np.int64)
+        if len(values) and values.max() > np.iinfo(np.int32).max:
+            raise ValueError('population counts are too large to hold as int32')
+        rows = lsoa_codes.get_indexer(baseline_lsoa_pop_syoa['LSOA 2021 Code'])
+        counts[g, rows[rows >= 0]] = values[rows >= 0]
+
+    return LsoaAgeCube(lsoa_codes, list(baselines), [int(age) for age in age_columns], counts, area_names)
+
+
+def load_lsoa_age_cube():
+    """
+    Load the baselines of every gender from the reference store into an LsoaAgeCube.
+    """
+    baselines = {gender: ref_store.load_baseline_syoa(gender) for gender in GENDERS}
+    return build_lsoa_age_cube(baselines, ref_store.load_reference_table('lookup_lsoa_to_district'))
@@ -1,8 +1,12 @@
 
+import json
+
 import streamlit as st
+import streamlit.components.v1 as components
 import geopandas as gpd
 import folium
 from folium.plugins import MarkerCluster
+from folium.plugins import VectorGridProtobuf
 import pandas as pd
 #import contextily as ctx
 #import matplotlib.pyplot as plt
@@ -11,6 +15,11 @@ from streamlit_folium import st_folium
 import altair as alt
 
 import branca #customer colour scales
+from branca.element import MacroElement
+from jinja2 import Template
+
+from pages.page_functions import vector_tiles
+from pages.page_functions import stage_profiler
 
 #----------------------------------------------
 @st.cache_data(ttl=1800)
@@ -167,53 +176,180 @@ def create_diverging_color_scale(gdf, net_change_column):
     return color_scale
 
 
-def render_folium_map_heatmap_net_change(gdf, change_column, line_weight=1, title='', LSOA_column = 'LSOA21CD'):
+@stage_profiler.profiled('render')
+def prepare_map_data(gdf, property_columns, LSOA_column, geometry_store, use_vector_tiles=False):
+    """
+    Get the data to draw and the map centre, either from a GeoDataFrame or by
+    joining the attribute values onto precomputed boundaries.
+
+    Parameters:
+    - gdf (GeoDataFrame or DataFrame): Data to plot. When geometry_store is given only the
+      LSOA_column and property_columns are used, and it does not need a geometry column.
+    - property_columns (list): Attribute columns needed by the style function and tooltip.
+    - LSOA_column (str): Column containing the LSOA 2021 code.
+    - geometry_store (LsoaGeometryStore or None): Precomputed WGS84 boundaries (see geometry_store.py).
+    - use_vector_tiles (bool): If True the boundaries come from the vector tiles, so only the
+      map centre is worked out and the attributes are returned as they are.
+
+    Returns:
+    - tuple: (data for folium.GeoJson, or the attributes for the vector tiles, [lat, lon] of the map centre)
+    """
+    if use_vector_tiles:
+        positions = geometry_store.positions(gdf[LSOA_column])
+        return gdf, geometry_store.centre(positions[positions >= 0])
+
+    if geometry_store is not None:
+        feature_collection, positions = geometry_store.feature_collection(gdf, property_columns, lsoa_column=LSOA_column)
+        return feature_collection, geometry_store.centre(positions)
+
+    # Set the CRS of the GeoDataFrame to EPSG 4326 (WGS 84) for Folium compatibility
+    gdf = gdf.to_crs(epsg=4326)
+    return gdf, [gdf.geometry.centroid.y.mean(), gdf.geometry.centroid.x.mean()]
+
+
+def add_vector_tile_layer(m, df_attributes, value_column, color_scale, LSOA_column, line_weight, fill_opacity, value_alias):
+    """
+    Add the LSOAs in df_attributes to the map from the prebuilt vector tiles (see vector_tiles.py).
+
+    The tiles hold the boundaries of every LSOA, and only the LSOA code -> (colour, value)
+    lookup for the LSOAs being mapped is written into the page. LSOAs not in the lookup
+    are not drawn.
+
+    Parameters:
+    - m (folium.Map): Map to add the layer to.
+    - df_attributes (DataFrame): One row per LSOA, with LSOA_column and value_column.
+    - value_column (str): Column to colour the LSOAs by.
+    - color_scale (branca colormap): Colour scale for value_column.
+    - LSOA_column (str): Column containing the LSOA 2021 code.
+    - line_weight (int): Thickness of the line (border) around the geometries.
+    - fill_opacity (float): Opacity of the fill colour.
+    - value_alias (str): Label for the value in the tooltip.
+    """
+    df_attributes = df_attributes.dropna(subset=[value_column])
+    values = df_attributes[value_column].tolist()
+    lsoa_lookup = {
+        code: [color_scale(value), value]
+        for code, value in zip(df_attributes[LSOA_column].tolist(), values)}
+
+    #built as a function so the lookup is created once rather than on every feature styled
+    options = """(function() {
+        var lsoaLookup = %s;
+        return {
+            "interactive": true,
+            "maxNativeZoom": %d,
+            "getFeatureId": function(feature) { return feature.properties.%s; },
+            "lsoaLookup": lsoaLookup,
+            "vectorTileLayerStyles": {
+                "%s": function(properties) {
+                    var entry = lsoaLookup[properties.%s];
+                    if (entry === undefined) { return []; }
+                    return {"fill": true, "fillColor": entry[0], "fillOpacity": %s, "color": "black", "weight": %s};
+                }
+            }
+        };
+    })()""" % (
+        json.dumps(lsoa_lookup), vector_tiles.MAX_ZOOM, vector_tiles.TILE_CODE_PROPERTY,
+        vector_tiles.TILE_LAYER_NAME, vector_tiles.TILE_CODE_PROPERTY, fill_opacity, line_weight)
+
+    layer = VectorGridProtobuf(vector_tiles.TILE_URL, name=value_alias, options=options, control=False)
+    layer.add_to(m)
+
+    #tooltip matching the GeoJson maps, looked up from the same LSOA code lookup
+    tooltip = MacroElement()
+    tooltip._template = Template("""
+        {% macro script(this, kwargs) %}
+        (function() {
+            var lsoaLookup = {{ this.layer.get_name() }}.options.lsoaLookup;
+            var tooltip = L.tooltip({"sticky": true});
+            {{ this.layer.get_name() }}.on('mouseover', function(e) {
+                var code = e.layer.properties.{{ this.code_property }};
+                if (!(code in lsoaLookup)) { return; }
+                tooltip.setLatLng(e.latlng).setContent(
+                    '<b>LSOA Code</b> ' + code + '<br><b>{{ this.value_alias }}</b> ' + lsoaLookup[code][1]);
+                {{ this.map.get_name() }}.openTooltip(tooltip);
+            });
+            {{ this.layer.get_name() }}.on('mouseout', function() {
+                {{ this.map.get_name() }}.closeTooltip(tooltip);
+            });
+        })();
+        {% endmacro %}
+        """)
+    tooltip.layer = layer
+    tooltip.map = m
+    tooltip.code_property = vector_tiles.TILE_CODE_PROPERTY
+    tooltip.value_alias = value_alias
+    tooltip.add_to(m)
+
+
+@stage_profiler.profiled('render')
+def render_folium_map_heatmap_net_change(gdf, change_column, line_weight=1, title='', LSOA_column = 'LSOA21CD', geometry_store=None, use_vector_tiles=False):
     """
     Render a Folium map with GeoDataFrame data and optional count data.
+    (see build_folium_map_heatmap_net_change)
+
+    Returns:
+    - Folium Map object
+    """
+    st.subheader(title)
+    m = build_folium_map_heatmap_net_change(gdf, change_column, line_weight, LSOA_column, geometry_store, use_vector_tiles)
+
+    # Render the map in Streamlit using streamlit_folium
+    #folium_static(m)#, width=400, height=750)
+    folium_static(m, width=550, height=650)
+
+    return m
+
+
+@stage_profiler.profiled('render')
+def build_folium_map_heatmap_net_change(gdf, change_column, line_weight=1, LSOA_column = 'LSOA21CD', geometry_store=None, use_vector_tiles=False):
+    """
+    Build a Folium map of change_column on a diverging colour scale, without drawing it.
 
     Parameters:
     - gdf (GeoDataFrame): GeoDataFrame containing the data to plot on the map.
     - count_df (DataFrame, optional): DataFrame containing count data per LSOA.
     - line_weight (int): Thickness of the line (border) around the geometries.
     - color_scheme (str): Color scheme for the choropleth map. Default is 'YlOrRd'.
+    - geometry_store (LsoaGeometryStore, optional): Precomputed boundaries to join the values onto,
+      instead of reprojecting and serialising the GeoDataFrame geometry.
+    - use_vector_tiles (bool): Draw the boundaries from the prebuilt vector tiles rather than
+      embedding them in the page (for large areas). Needs geometry_store for the map centre.
 
     Returns:
     - Folium Map object
     """
-    st.subheader(title)
-    # Set the CRS of the GeoDataFrame to EPSG 4326 (WGS 84) for Folium compatibility
-    gdf = gdf.to_crs(epsg=4326) #testing handling outside of the function
+    # Get the data to draw, in WGS 84 for Folium compatibility
+    map_data, map_centre = prepare_map_data(gdf, [change_column], LSOA_column, geometry_store, use_vector_tiles)
 
     # Create and apply a diverging color scale
     color_scale = create_diverging_color_scale(gdf, change_column)
 
-    # Create a Folium map centered at the mean of the GeoDataFrame geometries
-    m = folium.Map(location=[gdf.geometry.centroid.y.mean(), gdf.geometry.centroid.x.mean()], zoom_start=8.5) #higher number zooms in, lower number zooms out
+    # Create a Folium map centered at the mean of the geometries
+    m = folium.Map(location=map_centre, zoom_start=8.5) #higher number zooms in, lower number zooms out
 
     # Add OpenStreetMap tiles as the background (base layer)
     folium.TileLayer('openstreetmap').add_to(m)
 
-    # Use GeoJson to apply the style function
-    folium.GeoJson(
-        gdf,
-        style_function=lambda feature: {
-            'fillColor': color_scale(feature['properties'][change_column]),
-            'color': 'black',  # Border color
-            'weight': line_weight,
-            'fillOpacity': 0.7,
-        },
-        tooltip=folium.features.GeoJsonTooltip(fields=[LSOA_column, change_column],
-                                               aliases=['LSOA Code', 'Net Change'],
-                                               labels=True)
-    ).add_to(m)
+    if use_vector_tiles:
+        add_vector_tile_layer(m, map_data, change_column, color_scale, LSOA_column, line_weight, 0.7, 'Net Change')
+    else:
+        # Use GeoJson to apply the style function
+        folium.GeoJson(
+            map_data,
+            style_function=lambda feature: {
+                'fillColor': color_scale(feature['properties'][change_column]),
+                'color': 'black',  # Border color
+                'weight': line_weight,
+                'fillOpacity': 0.7,
+            },
+            tooltip=folium.features.GeoJsonTooltip(fields=[LSOA_column, change_column],
+                                                   aliases=['LSOA Code', 'Net Change'],
+                                                   labels=True)
+        ).add_to(m)
 
     # Add the color scale legend to the map
     color_scale.add_to(m)
 
-    # Render the map in Streamlit using streamlit_folium
-    #folium_static(m)#, width=400, height=750)
-    folium_static(m, width=550, height=650)
-
     return m
 
 #----------------------------------------------
@@ -233,31 +369,54 @@ def prepare_data_for_map(gdf, list_column_names_to_keep):
 
 
 
-def render_folium_map_heatmap(gdf, count_column=None, line_weight=1, color_scheme='YlOrRd', title='', LSOA_column = 'LSOA11CD'):
+@stage_profiler.profiled('render')
+def render_folium_map_heatmap(gdf, count_column=None, line_weight=1, color_scheme='YlOrRd', title='', LSOA_column = 'LSOA11CD', geometry_store=None, use_vector_tiles=False):
     """
     Render a Folium map with GeoDataFrame data and optional count data.
+    (see build_folium_map_heatmap)
+
+    Returns:
+    - Folium Map object
+    """
+    st.subheader(title)
+    m = build_folium_map_heatmap(gdf, count_column, line_weight, color_scheme, LSOA_column, geometry_store, use_vector_tiles)
+
+    # Render the map in Streamlit using streamlit_folium
+    #folium_static(m)#, width=400, height=750)
+    folium_static(m, width=550, height=650)
+
+    return m
+
+
+@stage_profiler.profiled('render')
+def build_folium_map_heatmap(gdf, count_column=None, line_weight=1, color_scheme='YlOrRd', LSOA_column = 'LSOA11CD', geometry_store=None, use_vector_tiles=False):
+    """
+    Build a Folium map of count_column, without drawing it.
 
     Parameters:
     - gdf (GeoDataFrame): GeoDataFrame containing the data to plot on the map.
     - count_df (DataFrame, optional): DataFrame containing count data per LSOA.
     - line_weight (int): Thickness of the line (border) around the geometries.
     - color_scheme (str): Color scheme for the choropleth map. Default is 'YlOrRd'.
+    - geometry_store (LsoaGeometryStore, optional): Precomputed boundaries to join the values onto,
+      instead of reprojecting and serialising the GeoDataFrame geometry.
+    - use_vector_tiles (bool): Draw the boundaries from the prebuilt vector tiles rather than
+      embedding them in the page (for large areas). Needs geometry_store for the map centre.
 
     Returns:
     - Folium Map object
     """
-    st.subheader(title)
-    # Set the CRS of the GeoDataFrame to EPSG 4326 (WGS 84) for Folium compatibility
-    gdf = gdf.to_crs(epsg=4326) #testing handling outside of the function
-
     # Remove entries with None values in the count_column to prevent errors
     gdf = gdf.dropna(subset=[count_column])
 
+    # Get the data to draw, in WGS 84 for Folium compatibility
+    map_data, map_centre = prepare_map_data(gdf, [count_column], LSOA_column, geometry_store, use_vector_tiles)
+
     # Create a color scale specifically for IMD quintiles
     color_scale = create_color_scale(gdf, count_column)
 
-    # Create a Folium map centered at the mean of the GeoDataFrame geometries
-    m = folium.Map(location=[gdf.geometry.centroid.y.mean(), gdf.geometry.centroid.x.mean()], zoom_start=8.5) #higher number zooms in, lower number zooms out
+    # Create a Folium map centered at the mean of the geometries
+    m = folium.Map(location=map_centre, zoom_start=8.5) #higher number zooms in, lower number zooms out
 
     # Add OpenStreetMap tiles as the background (base layer)
     folium.TileLayer('openstreetmap').add_to(m)
@@ -272,18 +431,21 @@ def render_folium_map_heatmap(gdf, count_column=None, line_weight=1, color_schem
     #labels=True)
     #).add_to(m)
 
-    folium.GeoJson(
-        gdf,
-        style_function=lambda feature: {
-            'fillColor': color_scale(feature['properties'][count_column]),
-            'color': 'black',
-            'weight': line_weight,
-            'fillOpacity': 0.5,
-        },
-        tooltip=folium.features.GeoJsonTooltip(fields=[LSOA_column, count_column],
-                                               aliases=['LSOA Code', 'IMD Quintile'],
-                                               labels=True)
-    ).add_to(m)
+    if use_vector_tiles:
+        add_vector_tile_layer(m, map_data, count_column, color_scale, LSOA_column, line_weight, 0.5, 'IMD Quintile')
+    else:
+        folium.GeoJson(
+            map_data,
+            style_function=lambda feature: {
+                'fillColor': color_scale(feature['properties'][count_column]),
+                'color': 'black',
+                'weight': line_weight,
+                'fillOpacity': 0.5,
+            },
+            tooltip=folium.features.GeoJsonTooltip(fields=[LSOA_column, count_column],
+                                                   aliases=['LSOA Code', 'IMD Quintile'],
+                                                   labels=True)
+        ).add_to(m)
 
     # Render choropleth map if count column is provided
     #if count_column is not None:
@@ -302,13 +464,25 @@ def render_folium_map_heatmap(gdf, count_column=None, line_weight=1, color_schem
     # Add the color scale legend
     color_scale.add_to(m)
 
-    # Render the map in Streamlit using streamlit_folium
-    #folium_static(m)#, width=400, height=750)
-    folium_static(m, width=550, height=650)
-
     return m
 
 
+@stage_profiler.profiled('render')
+def folium_map_html(m):
+    """
+    The html folium_static draws for a map, so a built map can be kept and redrawn without rebuilding it.
+    """
+    return folium.Figure().add_child(m).render()
+
+
+@stage_profiler.profiled('render')
+def show_map_html(map_html, width=550, height=650):
+    """
+    Draw html from folium_map_html, the same size as the maps drawn by the render functions.
+    """
+    components.html(map_html, width=width, height=height + 10)
+
+
 #----------------------------------------------
 #@st.cache_data(ttl=1800)
 def calculate_age_sum(df, min_age, max_age, lsoa_code_column):
@@ -0,0 +1,271 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from pages.page_functions import scenario_engine
+
+#--------------------------------------------------------------
+# Monte Carlo uncertainty bands around the demand forecasts.
+#
+# Prevalence rates, the error in the population projections and the total
+# demand modifier are drawn from user specified distributions, and every
+# draw is pushed through the same steps as the deterministic pipeline:
+#   LSOA need   = int(population * prevalence per 100k), per draw
+#   demand      = activity * (forecast need / baseline need)
+#   modified    = net demand change * (1 + total modifier / 100)
+# The draws x LSOAs arrays are worked on a block of LSOAs at a time (so
+# memory stays bounded), and large jobs can be spread over a process pool
+# (the pages run them in a single process, see pop_data_ETL_functions.py).
+# All random numbers are drawn up front from one seeded generator, so the
+# results are the same with or without the pool.
+#
+# No streamlit in here so it can be used by the pages and the command line.
+#--------------------------------------------------------------
+
+#distribution name -> names of its parameters, in the order they are passed
+DISTRIBUTIONS = {
+    'Fixed': ['value'],
+    'Normal': ['mean', 'standard deviation'],
+    'Uniform': ['low', 'high'],
+    'Triangular': ['low', 'most likely', 'high'],
+}
+
+PERCENTILES = [5, 25, 50, 75, 95]
+
+#draws x LSOAs worked on per block, and the job size above which blocks go to a process pool
+LSOA_BLOCK_ELEMENTS = 5_000_000
+PROCESS_POOL_MIN_ELEMENTS = 50_000_000
+
+#----------------------------------------------
+
+def sample(rng, distribution, parameters, n_draws):
+    """
+    Draw n_draws values from one of the DISTRIBUTIONS.
+
+    Parameters:
+    rng (numpy Generator): Random number generator.
+    distribution (str): Key of DISTRIBUTIONS.
+    parameters (list): Parameters of the distribution, in the order listed in DISTRIBUTIONS.
+    n_draws (int): Number of draws.
+    """
+    if distribution == 'Fixed':
+        return np.full(n_draws, float(parameters[0]))
+    if distribution == 'Normal':
+        return rng.normal(parameters[0], parameters[1], n_draws)
+    if distribution == 'Uniform':
+        return rng.uniform(parameters[0], parameters[1], n_draws)
+    if distribution == 'Triangular':
+        return rng.triangular(parameters[0], parameters[1], parameters[2], n_draws)
+    raise ValueError(f'unknown distribution {distribution!r}, expected one of {list(DISTRIBUTIONS)}')
+
+
+def percentile_labels(prefix):
+    return [f'{prefix} p{percentile}' for percentile in PERCENTILES]
+
+
+def percentile_positions(n_draws):
+    """
+    Order statistics either side of each of the PERCENTILES and the weight of the upper one
+    (numpy's default linear interpolation).
+    """
+    position = np.asarray(PERCENTILES, dtype=np.float64) / 100 * (n_draws - 1)
+    lower = np.floor(position).astype(np.int64)
+    upper = np.minimum(lower + 1, n_draws - 1)
+    return lower, upper, position - lower
+
+
+def sorted_percentiles(sorted_values, n_draws):
+    """
+    PERCENTILES down axis 0 of values already sorted along it.
+    """
+    lower, upper, weight = percentile_positions(n_draws)
+    low_values = sorted_values[lower].astype(np.float64)
+    return low_values + (sorted_values[upper] - low_values) * weight[:, None]
+
+
+def pool_workers():
+    """
+    Number of worker processes for large jobs (MONTE_CARLO_WORKERS, default: every CPU).
+    """
+    return int(os.environ.get('MONTE_CARLO_WORKERS', os.cpu_count() or 1))
+
+#----------------------------------------------
+
+def lsoa_need_block(baseline_population, forecast_population, baseline_rate, forecast_rate):
+    """
+    Need in a block of LSOAs for every draw.
+
+    Parameters:
+    baseline_population, forecast_population (ndarray): Population of each LSOA in the block.
+    baseline_rate, forecast_rate (ndarray): Need per head for each draw (the forecast rate
+        includes the projection error).
+
+    Returns:
+    tuple: (baseline need totals [draw], forecast need totals [draw], percentiles of net need change [percentile, LSOA])
+    """
+    # casting truncates, as int() does in calculate_and_insert_needs (an LSOA's need fits in int32)
+    baseline_need = (baseline_population[None, :] * baseline_rate[:, None]).astype(np.int32)
+    forecast_need = (forecast_population[None, :] * forecast_rate[:, None]).astype(np.int32)
+    net_need_change = np.sort(forecast_need - baseline_need, axis=0)
+
+    return (
+        baseline_need.sum(axis=1, dtype=np.int64),
+        forecast_need.sum(axis=1, dtype=np.int64),
+        sorted_percentiles(net_need_change, len(baseline_rate)),
+    )
+
+
+def simulate_lsoa_need(baseline_population, forecast_population, baseline_rate, forecast_rate, n_workers=None):
+    """
+    Run every draw over every LSOA, a block of LSOAs at a time.
+
+    Parameters:
+    baseline_population, forecast_population (array-like): Population of each LSOA.
+    baseline_rate, forecast_rate (ndarray): Need per head for each draw.
+    n_workers (int, optional): Worker processes (default: a pool only for large jobs).
+
+    Returns:
+    tuple: (baseline need totals [draw], forecast need totals [draw],
+    forecast need percentiles [percentile, LSOA], net need change percentiles [percentile, LSOA])
+    """
+    baseline_population = np.asarray(baseline_population, dtype=np.float64)
+    forecast_population = np.asarray(forecast_population, dtype=np.float64)
+    n_draws = len(baseline_rate)
+    n_lsoas = len(baseline_population)
+
+    # an LSOA's forecast need only rises with the forecast rate, so its percentiles
+    # are the need at the percentiles of the rate and no LSOA x draw array is needed
+    lower, upper, weight = percentile_positions(n_draws)
+    sorted_rate = np.sort(forecast_rate)
+    low_need = np.trunc(forecast_population[None, :] * sorted_rate[lower, None])
+    high_need = np.trunc(forecast_population[None, :] * sorted_rate[upper, None])
+    forecast_need_bands = low_need + (high_need - low_need) * weight[:, None]
+
+    block_size = max(1, LSOA_BLOCK_ELEMENTS // max(n_draws, 1))
+    blocks = [slice(start, min(start + block_size, n_lsoas)) for start in range(0, n_lsoas, block_size)]
+    block_args = [(baseline_population[block], forecast_population[block], baseline_rate, forecast_rate) for block in blocks]
+
+    if n_workers is None:
+        n_workers = pool_workers() if n_draws * n_lsoas >= PROCESS_POOL_MIN_ELEMENTS else 1
+    if n_workers > 1 and len(blocks) > 1:
+        with ProcessPoolExecutor(max_workers=min(n_workers, len(blocks))) as pool:
+            results = list(pool.map(lsoa_need_block, *zip(*block_args)))
+    else:
+        results = [lsoa_need_block(*args) for args in block_args]
+
+    baseline_need_total = np.zeros(n_draws, dtype=np.int64)
+    forecast_need_total = np.zeros(n_draws, dtype=np.int64)
+    for baseline_block_total, forecast_block_total, _ in results:
+        baseline_need_total += baseline_block_total
+        forecast_need_total += forecast_block_total
+
+    net_need_bands = np.concatenate([result[2] for result in results], axis=1) if results else np.empty((len(PERCENTILES), 0))
+    return baseline_need_total, forecast_need_total, forecast_need_bands, net_need_bands
+
+#----------------------------------------------
+
+def lsoa_demand_uncertainty(df_lsoa_population, activity, baseline_prevalence, forecast_prevalence, projection_error, modifier_total,
+                            n_draws=10000, seed=None, n_workers=None):
+    """
+    Monte Carlo bands for the mapping page's demand estimate and each LSOA's need.
+
+    Parameters:
+    df_lsoa_population (DataFrame): 'LSOA21CD', 'Baseline Population' and 'Forecast Population' columns.
+    activity (float): Baseline demand (the activity total entered on the page).
+    baseline_prevalence, forecast_prevalence, projection_error, modifier_total (tuple):
+        (distribution, parameters) for each uncertain input (see DISTRIBUTIONS).
+        Prevalences are per 100,000, projection error and modifier total are %.
+    n_draws (int): Number of draws.
+    seed (int, optional): Seed for the random number generator.
+    n_workers (int, optional): Worker processes (default: a pool only for large jobs).
+
+    Returns:
+    tuple: (DataFrame of the demand outcome of every draw, DataFrame of need percentile bands by LSOA)
+    """
+    rng = np.random.default_rng(seed)
+    draws = {
+        'Baseline prevalence': np.maximum(sample(rng, *baseline_prevalence, n_draws), 0),
+        'Forecast prevalence': np.maximum(sample(rng, *forecast_prevalence, n_draws), 0),
+        'Projection error %': sample(rng, *projection_error, n_draws),
+        'Total modifier %': sample(rng, *modifier_total, n_draws),
+    }
+
+    baseline_need, forecast_need, forecast_need_bands, net_need_bands = simulate_lsoa_need(
+        df_lsoa_population['Baseline Population'].to_numpy(),
+        df_lsoa_population['Forecast Population'].to_numpy(),
+        draws['Baseline prevalence'] / 100000,
+        np.maximum(1 + draws['Projection error %'] / 100, 0) * (draws['Forecast prevalence'] / 100000),
+        n_workers=n_workers)
+    baseline_need = baseline_need.astype(np.float64)
+    forecast_need = forecast_need.astype(np.float64)
+
+    # the demand steps of scenario_engine.demand_scenarios, one value per draw
+    with np.errstate(divide='ignore', invalid='ignore'):
+        percent_change = np.where(baseline_need != 0, (forecast_need - baseline_need) / baseline_need, np.nan)
+    forecast_demand = activity + (activity * percent_change)
+    net_demand_change = np.round(forecast_demand - activity, 0)
+
+    df_draws = pd.DataFrame(draws)
+    df_draws['Baseline Need'] = baseline_need
+    df_draws['Forecast Need'] = forecast_need
+    df_draws['Forecast Demand'] = forecast_demand
+    df_draws['Net Demand Change'] = net_demand_change
+    df_draws['Modified Net Demand Change'] = net_demand_change * (1 + draws['Total modifier %'] / 100)
+
+    df_lsoa_bands = pd.DataFrame(
+        np.concatenate([forecast_need_bands, net_need_bands]).T,
+        index=pd.Index(df_lsoa_population['LSOA21CD'].to_numpy(), name='LSOA21CD'),
+        columns=percentile_labels('Forecast Need') + percentile_labels('Net Need Change'))
+
+    return df_draws, df_lsoa_bands
+
+
+def service_demand_uncertainty(df_service_forecast, projection_error, modifier_total, n_draws=10000, seed=None):
+    """
+    Monte Carlo bands for each service's forecast demand and cost.
+
+    Parameters:
+    df_service_forecast (DataFrame): Full output of calculate_population_changes.
+    projection_error, modifier_total (tuple): (distribution, parameters) for the % error in the
+        projected population and the total demand modifier % (see DISTRIBUTIONS).
+    n_draws (int): Number of draws.
+    seed (int, optional): Seed for the random number generator.
+
+    Returns:
+    DataFrame: Percentile bands of forecasted demand, net demand change and net cost change for each service.
+    """
+    rng = np.random.default_rng(seed)
+    error = sample(rng, *projection_error, n_draws)[:, None]
+    modifier = sample(rng, *modifier_total, n_draws)[:, None]
+
+    baseline_population = df_service_forecast['Baseline Population'].to_numpy(dtype=np.float64)[None, :]
+    forecast_population = df_service_forecast['Forecast Population'].to_numpy(dtype=np.float64)[None, :] * (1 + error / 100)
+    attendances = df_service_forecast['attendances in 12 months'].to_numpy(dtype=np.float64)[None, :]
+    unit_cost = df_service_forecast['average cost per appt'].to_numpy(dtype=np.float64)[None, :]
+
+    # the demand steps of service_demand.demand_forecast, for every draw [draw, service]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        percent_change = np.where(baseline_population != 0, (forecast_population - baseline_population) / baseline_population * 100, 0.0)
+    forecasted_demand = np.round(attendances * (1 + (percent_change / 100)), 0)
+    net_demand_change = (forecasted_demand - attendances) * (1 + modifier / 100)
+    cost_demand_change = (net_demand_change * unit_cost) / 1000
+
+    bands = [
+        np.percentile(forecasted_demand, PERCENTILES, axis=0).T,
+        np.percentile(net_demand_change, PERCENTILES, axis=0).T,
+        np.percentile(cost_demand_change, PERCENTILES, axis=0).T,
+    ]
+    df_bands = pd.DataFrame(
+        np.concatenate(bands, axis=1),
+        columns=percentile_labels('Forecasted Demand') + percentile_labels('Net Est Demand Change') + percentile_labels('Net Cost Demand Change (£1000s)'))
+    df_bands.insert(0, 'Service name', df_service_forecast['Service name'].to_numpy())
+    return df_bands
+
+
+def outcome_bands(df_draws, columns=('Forecast Demand', 'Net Demand Change', 'Modified Net Demand Change')):
+    """
+    Percentile bands of the overall demand outcomes over the draws.
+    """
+    return scenario_engine.scenario_range(df_draws, columns=columns, percentiles=PERCENTILES)
@@ -0,0 +1,183 @@
+import hashlib
+import time
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from pages.page_functions import stage_profiler
+
+#--------------------------------------------------------------
+# Incremental recomputation of a page's pipeline.
+#
+# The pipeline is declared as named stages, each listing the page inputs
+# (parameters) and earlier stages it reads. When the page asks for some
+# stages, only the stages they depend on are visited, and a stage is only
+# rerun when the fingerprint of its inputs differs from its last runs. So
+# changing the prevalence reruns the need stage (and what reads it), not
+# the population stages before it.
+#
+# A stage that reruns but gives the same result as before does not make
+# the stages reading it rerun (e.g. the population change map only reads
+# the population columns, so a new prevalence leaves it as it was).
+#
+# Results are kept in a memo dict the page owns (held in st.session_state
+# so each user session has its own), with a few entries per stage so going
+# back to a recent selection is also instant.
+#
+# When a page is profiling its run (see stage_profiler.py), every stage
+# visited is recorded in the profile, reused or not.
+#--------------------------------------------------------------
+
+#results kept for each stage (unless the stage says otherwise), the least recently used is dropped first
+MEMO_ENTRIES_PER_STAGE = 4
+
+#----------------------------------------------
+
+def fingerprint(value):
+    """
+    Hashable summary of a value, equal for values with equal content.
+
+    Data frames, series and arrays are hashed on their content. Objects that are not
+    plain values or containers (e.g. cached reference data) are compared by identity.
+    """
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        digest = hashlib.blake2b(pd.util.hash_pandas_object(value, index=True).to_numpy().tobytes(), digest_size=16)
+        if isinstance(value, pd.DataFrame):
+            digest.update(repr(list(value.columns)).encode())
+        else:
+            digest.update(repr(value.name).encode())
+        return (type(value).__name__, value.shape, digest.hexdigest())
+    if isinstance(value, np.ndarray):
+        if value.dtype == object:
+            return ('ndarray', value.shape, fingerprint(pd.Series(value.ravel())))
+        digest = hashlib.blake2b(np.ascontiguousarray(value).tobytes(), digest_size=16)
+        return ('ndarray', value.shape, str(value.dtype), digest.hexdigest())
+    if isinstance(value, (list, tuple)):
+        return (type(value).__name__,) + tuple(fingerprint(item) for item in value)
+    if isinstance(value, dict):
+        return ('dict',) + tuple(sorted((repr(key), fingerprint(item)) for key, item in value.items()))
+    if isinstance(value, (set, frozenset)):
+        return ('set', frozenset(fingerprint(item) for item in value))
+    if isinstance(value, float) and value != value:
+        return ('nan',)
+    if value is None or isinstance(value, (str, bytes, bool, int, float, np.generic)):
+        return value
+    return ('id', type(value).__name__, id(value))
+
+
+def handed_out(value):
+    """
+    Copy of a memoised result, so callers (which often add columns in place) cannot change it.
+    """
+    if isinstance(value, (pd.DataFrame, pd.Series, np.ndarray)):
+        return value.copy()
+    if isinstance(value, tuple):
+        return tuple(handed_out(item) for item in value)
+    return value
+
+#----------------------------------------------
+
+class Stage:
+    """
+    A named step of a pipeline: function(*inputs), where each input is the name of
+    an earlier stage or of a parameter supplied when the pipeline is run.
+    memo_entries is the number of its results to keep (fewer for large results).
+    """
+    def __init__(self, name, function, inputs=(), memo_entries=MEMO_ENTRIES_PER_STAGE):
+        self.name = name
+        self.function = function
+        self.inputs = list(inputs)
+        self.memo_entries = memo_entries
+
+
+class PipelineGraph:
+    """
+    Stages in the order they were declared (each stage may only read stages declared before it).
+    """
+    def __init__(self, stages):
+        self.stages = OrderedDict()
+        for stage in stages:
+            if stage.name in self.stages:
+                raise ValueError(f'stage {stage.name!r} is declared twice')
+            self.stages[stage.name] = stage
+        self.last_run = []
+
+    def parameters(self):
+        """
+        Names of the parameters the stages read.
+        """
+        return sorted({name for stage in self.stages.values() for name in stage.inputs if name not in self.stages})
+
+    def dependencies(self, targets):
+        """
+        The target stages and every stage they read, in declaration order.
+        """
+        needed = set()
+        to_visit = list(targets)
+        while to_visit:
+            name = to_visit.pop()
+            if name not in self.stages:
+                raise KeyError(f'no stage named {name!r}')
+            if name in needed:
+                continue
+            needed.add(name)
+            to_visit += [input_name for input_name in self.stages[name].inputs if input_name in self.stages]
+        return [name for name in self.stages if name in needed]
+
+    def run(self, targets, params, memo):
+        """
+        Results of the target stages, rerunning only the stages whose inputs have changed.
+
+        Parameters:
+        targets (list): Names of the stages wanted.
+        params (dict): Parameter name -> value, for every parameter the stages needed read.
+        memo (dict): Results of earlier runs, updated in place (start with an empty dict).
+
+        Returns:
+        dict: Stage name -> result, for each target. Data frames and arrays are copies.
+        """
+        self.last_run = []
+        results = {}
+        result_keys = {}
+        for name in self.dependencies(targets):
+            stage = self.stages[name]
+            for input_name in stage.inputs:
+                if input_name not in self.stages and input_name not in params:
+                    raise ValueError(f'no value for parameter {input_name!r} of stage {name!r}')
+            key = tuple(
+                result_keys[input_name] if input_name in self.stages else fingerprint(params[input_name])
+                for input_name in stage.inputs)
+
+            entries = memo.setdefault(name, OrderedDict())
+            start = time.perf_counter()
+            with stage_profiler.measure(name, 'stage') as record:
+                if key in entries:
+                    entries.move_to_end(key)
+                    result, result_key = entries[key]
+                    status = 'reused'
+                else:
+                    inputs = [
+                        handed_out(results[input_name]) if input_name in self.stages else params[input_name]
+                        for input_name in stage.inputs]
+                    record['rows_in'] = stage_profiler.input_rows(inputs)
+                    result = stage.function(*inputs)
+                    result_key = fingerprint(result)
+                    entries[key] = (result, result_key)
+                    while len(entries) > stage.memo_entries:
+                        entries.popitem(last=False)
+                    status = 'computed'
+                record['status'] = status
+                record['rows_out'] = stage_profiler.row_count(result)
+
+            results[name] = result
+            result_keys[name] = result_key
+            self.last_run.append((name, status, time.perf_counter() - start))
+
+        return {name: handed_out(results[name]) for name in targets}
+
+    def run_summary(self):
+        """
+        Which stages the last run computed or reused, and how long each took.
+        """
+        return pd.DataFrame(self.last_run, columns=['Stage', 'Status', 'Seconds'])
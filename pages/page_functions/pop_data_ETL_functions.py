@@ -1,8 +1,24 @@
 
+import io
+import os
+
 import streamlit as st
 import altair as alt
 import pandas as pd
 import geopandas as gpd
+import numpy as np
+
+from pages.page_functions import reference_data as ref_data
+from pages.page_functions import reference_store as ref_store
+from pages.page_functions import forecast_engine
+from pages.page_functions import service_demand
+from pages.page_functions import lsoa_apportionment
+from pages.page_functions import trajectory
+from pages.page_functions import monte_carlo
+from pages.page_functions import pipeline_graph
+from pages.page_functions import result_cache
+from pages.page_functions import service_forecast_files as service_files
+from pages.page_functions import map_functions as map_func
 
 #--------------------------------------------------------------
 # define functions
@@ -16,32 +32,21 @@ def get_remaining_years(options, selected_year):
 
 def forecast_population(pop_df, local_authorities, min_age, max_age, start_year, forecast_year, gender):
 
-    # Filter data for the specified local authorities
-    df_filtered = pop_df[pop_df['local authority'].isin(local_authorities)]
-    
-    # Filter data for the specified gender
-    df_filtered = df_filtered[df_filtered['Gender'] == gender]
-    # Define age columns to sum based on min_age and max_age
-    age_columns = [str(age) for age in range(int(min_age), int(max_age) + 1)]
-    
-    # Filter and calculate for the start_year
-    baseline_data = df_filtered[df_filtered['Year'] == start_year]
-    baseline_pop = baseline_data[age_columns].sum(axis=1)
-   
-    baseline_total = baseline_pop.groupby(baseline_data['local authority']).sum()
-    
-    # Filter and calculate for the forecast_year
-    forecast_data = df_filtered[df_filtered['Year'] == forecast_year]
-    forecast_pop = forecast_data[age_columns].sum(axis=1)
-    forecast_total = forecast_pop.groupby(forecast_data['local authority']).sum()
+    # Get the dense array version of the projections (built once per frame, see forecast_engine.py)
+    cube = forecast_engine.projection_cube_for(pop_df)
+
+    # Sum the population between min_age and max_age for the baseline and forecast year, by local authority
+    baseline_total = cube.band_totals(local_authorities, gender, start_year, min_age, max_age)
+    forecast_total = cube.band_totals(local_authorities, gender, forecast_year, min_age, max_age)
 
     # Calculate net change and percentage change
     net_change = forecast_total - baseline_total
     percent_change = (net_change / baseline_total) * 100
     
     # Prepare the final DataFrame for output (working code on individual service use case)
+    # Location is taken from the index so the labels line up with the (sorted) totals
     result_df = pd.DataFrame({
-        'Location': local_authorities,
+        'Location': net_change.index,
         f'Total Pop Age {min_age}-{max_age} ({gender})': baseline_total,
         'Baseline Year Total': baseline_total,
         'Forecast Year Total': forecast_total,
@@ -129,80 +134,155 @@ def create_population_change_chart_service_upload(df, chart_metric, pop_proj_bas
 
 
 def get_population_for_service(pop_df, local_authorities, min_age, max_age, baseline_year, forecast_year, gender):
-    # Filter the population dataframe for the specified local authorities
-    la_df = pop_df[pop_df['local authority'].isin(local_authorities)]
-    
-    # Get the baseline population
-    baseline_df = la_df[(la_df['Year'] == baseline_year) & (la_df['Gender'] == gender)]
-    age_columns = [str(age) for age in range(min_age, max_age + 1)]
-    baseline_population = baseline_df[age_columns].sum().sum()
-
-    # Get the forecast population
-    forecast_df = la_df[(la_df['Year'] == forecast_year) & (la_df['Gender'] == gender)]
-    forecast_population = forecast_df[age_columns].sum().sum()
+    # Sum the age band population over the local authorities, for the baseline and forecast year
+    cube = forecast_engine.projection_cube_for(pop_df)
+    baseline_population = cube.band_totals(local_authorities, gender, baseline_year, min_age, max_age).sum()
+    forecast_population = cube.band_totals(local_authorities, gender, forecast_year, min_age, max_age).sum()
 
     return baseline_population, forecast_population
 
 # Example usage in Streamlit app
 def calculate_population_changes(service_df, pop_df, baseline_year, forecast_year):
-    # Assuming all columns after the 4th index are local authorities
-    local_authorities_columns = service_df.columns[6:]
-
-    # Initialize new columns for the output
-    service_df['Baseline Population'] = 0
-    service_df['Forecast Population'] = 0
-    service_df['Net Pop Change'] = 0
-    service_df['% Pop Change'] = 0.0
-    service_df['Forecasted Demand'] = 0
-    service_df['Net Est Demand Change'] = 0
-    service_df['Net Cost Demand Change (£1000s)'] = 0
-    service_df['attendances per wte'] = 0
-
-    for index, service_row in service_df.iterrows():
-        # Identify which local authorities are marked as 'yes'
-        selected_local_authorities = [la for la in local_authorities_columns if service_row[la] == 'yes']
-        
-        # Call the function to get populations
-        baseline_population, forecast_population = get_population_for_service(
-            pop_df,
-            selected_local_authorities,
-            service_row['min age seen'],
-            service_row['max age seen'],
-            baseline_year,
-            forecast_year,
-            service_row['gender seen']
-        )
-
-        # Calculate net change and percent change
-        net_change = forecast_population - baseline_population
-        
-        #st.write(f'baseline pop: {baseline_population} | forecast pop: {forecast_population}')
-
-        percent_change = (net_change / baseline_population * 100) if baseline_population else 0
-
-        # Calculate the forecasted demand by applying the percentage change to the attendances
-        forecasted_demand = round(service_row['attendances in 12 months'] * (1 + (percent_change / 100)),0)
-        net_change_forecast_demand = forecasted_demand - service_row['attendances in 12 months']
-        cost_demand_change = (net_change_forecast_demand * (service_row['average cost per appt'])) / 1000
-
-        #calculate the average number of attendances per wte
-        attends_per_wte = service_row['attendances in 12 months'] / service_row['clinical_wte'] 
-
-        # Update the service dataframe with the calculated populations
-        service_df.at[index, 'Baseline Population'] = baseline_population
-        service_df.at[index, 'Forecast Population'] = forecast_population
-        service_df.at[index, 'Net Pop Change'] = net_change
-        service_df.at[index, '% Pop Change'] = percent_change
-        service_df.at[index, 'Forecasted Demand'] = forecasted_demand
-        service_df.at[index, 'Net Est Demand Change'] = net_change_forecast_demand
-        service_df.at[index, 'Net Cost Demand Change (£1000s)'] = cost_demand_change
-        service_df.at[index, 'attendances per wte'] = attends_per_wte
-
-    # Now create a new dataframe with only the required columns
-    columns_to_keep = [service_df.columns[0]] + service_df.columns[-5:].tolist()
-    shortened_service_df = service_df[columns_to_keep]
-
-    return service_df, shortened_service_df
+    # All services are calculated in one pass by the batch engine (see service_demand.py)
+    return service_demand.calculate_population_changes(service_df, pop_df, baseline_year, forecast_year, lsoa_age_cube_for(service_df.columns))
+
+
+def lsoa_age_cube_for(service_columns):
+    # The LSOA baselines are only loaded for a file of LSOA catchments
+    if service_demand.LSOA_CATCHMENT_COLUMN in service_columns:
+        return ref_data.get_lsoa_age_cube()
+    return None
+
+
+def upload_key(users_file):
+    # Identifies an upload (or the path of the dummy data) across reruns
+    return users_file if isinstance(users_file, str) else users_file.file_id
+
+
+def service_upload_trajectory(users_file, service_df, pop_df, baseline_year):
+    """
+    Population of every service in a coverage upload for the baseline and every later
+    projection year, worked out in one pass (see service_demand.service_file_populations).
+    The result is kept in the session until the reference data changes, so changing the
+    forecast year (or any other widget) only takes a slice of it, see population_changes_for_year.
+
+    Parameters:
+    users_file (UploadedFile or str): The upload (or the path of a file) service_df was read from.
+    service_df (DataFrame): Service coverage file.
+    pop_df (CompactProjections or DataFrame): Population projections for the areas.
+    baseline_year (int): Baseline year.
+
+    Returns:
+    tuple: (DataFrame of one row per service, list of the years, populations shaped [year, service])
+    """
+    #uploads are always forecast from the district projections (add the geography level here if that changes)
+    run_key = (upload_key(users_file), ref_store.reference_data_version(), baseline_year)
+    previous_run = st.session_state.get('service_upload_trajectory')
+    if previous_run is None or previous_run['key'] != run_key:
+        years = trajectory.trajectory_years(pop_df, baseline_year)
+        with st.spinner('Forecasting services...'):
+            services_df, populations = service_demand.service_file_populations(service_df, pop_df, years, lsoa_age_cube_for(service_df.columns))
+        previous_run = {'key': run_key, 'services': services_df, 'years': years, 'populations': populations}
+        st.session_state['service_upload_trajectory'] = previous_run
+    return previous_run['services'], previous_run['years'], previous_run['populations']
+
+
+def population_changes_for_year(services_df, years, populations, forecast_year):
+    # Slice one forecast year out of a service trajectory, laid out as calculate_population_changes returns it
+    return service_demand.population_change_tables(services_df.copy(), populations[0], populations[years.index(forecast_year)])
+
+
+def add_risk_factor_columns(shortened_service_df, smoking_prevalence, overweight_or_obesity_prevalence, obesity_prevalence):
+    # Current and forecast estimates of each modifiable risk factor (see service_demand.py)
+    prevalences = {
+        'smoking': smoking_prevalence,
+        'overweight_or_obesity': overweight_or_obesity_prevalence,
+        'obesity': obesity_prevalence,
+    }
+    return service_demand.add_risk_factor_columns(shortened_service_df, prevalences)
+
+#------------------------------------------
+#large service coverage uploads are forecast a chunk of rows at a time into files kept
+#for the session rather than held in memory (see service_forecast_files.py). The page
+#shows the first services, and builds the downloads of every service only when clicked
+#------------------------------------------
+
+#uploads of at least this size take the chunked path
+STREAMING_UPLOAD_MIN_BYTES = 20 * 2**20
+#services shown (and charted) on the page from a chunked upload
+STREAMING_PREVIEW_SERVICES = 1000
+
+def upload_size(users_file):
+    # An uploaded file, or the path of the dummy data
+    return os.path.getsize(users_file) if isinstance(users_file, str) else users_file.size
+
+
+def open_upload(users_file):
+    # A reader of its own over the upload (or the path of a file), so reruns and downloads do not share a position
+    return open(users_file, 'rb') if isinstance(users_file, str) else io.BytesIO(users_file.getvalue())
+
+
+def forecast_service_upload_in_chunks(users_file, pop_df, baseline_year):
+    """
+    Population of every service in a large coverage upload for the baseline and every later
+    projection year, forecast a chunk of rows at a time into a file, with a progress bar
+    updated after each chunk. The files are kept for the session (and removed when it ends) until
+    the reference data changes, so changing the forecast year (or any other widget) only reads them.
+
+    Parameters:
+    users_file (UploadedFile or str): The upload (or the path of a file).
+    pop_df (CompactProjections or DataFrame): Population projections for the areas.
+    baseline_year (int): Baseline year.
+
+    Returns:
+    ServiceForecastFiles: The forecast, see service_forecast_files.py.
+    """
+    #uploads are always forecast from the district projections (add the geography level here if that changes)
+    run_key = (upload_key(users_file), ref_store.reference_data_version(), baseline_year)
+    previous_run = st.session_state.get('service_upload_stream')
+    if previous_run is not None and previous_run.key == run_key and previous_run.exists():
+        return previous_run
+    #the files of the previous run are removed once nothing refers to them
+    st.session_state.pop('service_upload_stream', None)
+    previous_run = None
+    service_files.remove_old_forecasts()
+
+    forecast_files = service_files.ServiceForecastFiles(run_key, trajectory.trajectory_years(pop_df, baseline_year))
+    total_bytes = max(upload_size(users_file), 1)
+    progress = st.progress(0.0, text='Forecasting services...')
+    with open_upload(users_file) as source:
+        lsoa_cube = lsoa_age_cube_for(pd.read_csv(source, nrows=0).columns)
+        source.seek(0)
+        service_chunks = pd.read_csv(source, chunksize=service_demand.SERVICE_CHUNK_ROWS)
+        for n_services in forecast_files.write_trajectory(service_chunks, pop_df, lsoa_cube):
+            progress.progress(min(source.tell() / total_bytes, 1.0), text=f'Forecast {n_services:,} services...')
+    progress.empty()
+
+    if forecast_files.n_services == 0:
+        forecast_files.remove()
+        st.warning('The file has no services in it.')
+        st.stop()
+
+    st.session_state['service_upload_stream'] = forecast_files
+    return forecast_files
+
+
+def full_forecast_download(users_file, forecast_files, forecast_year):
+    # download_button data: the full table of every service, built from the upload only when the button is clicked
+    def full_table_csv():
+        with open_upload(users_file) as source:
+            return forecast_files.full_table_csv(pd.read_csv(source, chunksize=service_demand.SERVICE_CHUNK_ROWS), forecast_year)
+    return full_table_csv
+
+
+def shortened_forecast_download(forecast_files, forecast_year, smoking_prevalence, overweight_or_obesity_prevalence, obesity_prevalence):
+    # download_button data: the shortened table of every service with the risk factor columns, built only when the button is clicked
+    prevalences = {
+        'smoking': smoking_prevalence,
+        'overweight_or_obesity': overweight_or_obesity_prevalence,
+        'obesity': obesity_prevalence,
+    }
+    return lambda: forecast_files.shortened_table_csv(forecast_year, prevalences)
 
 
 def create_scatter_chart(df, x_variable, y_variable, width, height):
@@ -264,75 +344,228 @@ def create_bar_chart(df, y_variable, x_variable='Service name'):
     return chart
 
 #--------------------------------------------------------------
-#load required files
+#population change for every year from the baseline in one pass (see trajectory.py),
+#so changing the forecast year only slices the precomputed results
 #--------------------------------------------------------------
+def forecast_population_trajectory(geography_level, local_authorities, min_age, max_age, start_year, gender):
+    # Total population in the age band for each local authority, for the baseline and every later projection year
+    def compute(geography_level, local_authorities, min_age, max_age, start_year, _, gender):
+        pop_df = ref_data.get_pop_projections(geography_level)
+        years = trajectory.trajectory_years(pop_df, start_year)
+        return trajectory.band_trajectory(pop_df, list(local_authorities), min_age, max_age, start_year, years, gender)
 
-#POP FORECASTS
-pop_proj_path_utla = r'build_data/pop_projections/pop_forecast_24_to_43.csv'
-pop_proj_path_district = r'build_data/pop_projections/district_pop_forecast_24_to_43.csv'
+    return cached_forecast_result('forecast_population_trajectory', compute, geography_level, local_authorities, min_age, max_age, start_year, None, gender)
 
-#--------------------------------------------------------------
-#Make dataframes
-#--------------------------------------------------------------
 
-#call function to create dict of necessary reference files
-df_pop_forecast_district = pd.read_csv(pop_proj_path_district)
-df_pop_forecast_utla = pd.read_csv(pop_proj_path_utla)
+def forecast_population_by_age_trajectory(geography_level, local_authorities, min_age, max_age, start_year, gender):
+    # Population by single year of age for each local authority, for the baseline and every later projection year
+    def compute(geography_level, local_authorities, min_age, max_age, start_year, _, gender):
+        pop_df = ref_data.get_pop_projections(geography_level)
+        years = trajectory.trajectory_years(pop_df, start_year)
+        return trajectory.age_trajectory(pop_df, list(local_authorities), min_age, max_age, start_year, years, gender)
+
+    return cached_forecast_result('forecast_population_by_age_trajectory', compute, geography_level, local_authorities, min_age, max_age, start_year, None, gender)
+
+
+def forecast_population_by_age_for_year(df_trajectory, forecast_year):
+    # Slice one forecast year out of the by age trajectory, laid out as forecast_population_by_age returns it
+    year_df = df_trajectory[df_trajectory['Year'] == forecast_year]
+    return year_df.drop(columns='Year').reset_index(drop=True)
+
+
+def forecast_population_for_year(df_trajectory, forecast_year, min_age, max_age, gender):
+    # Slice one forecast year out of the trajectory, laid out as forecast_population returns it
+    year_df = df_trajectory[df_trajectory['Year'] == forecast_year]
+    result_df = pd.DataFrame({
+        'Location': year_df['Location'].to_numpy(),
+        f'Total Pop Age {min_age}-{max_age} ({gender})': year_df['Baseline Year Total'].to_numpy(),
+        'Baseline Year Total': year_df['Baseline Year Total'].to_numpy(),
+        'Forecast Year Total': year_df['Forecast Year Total'].to_numpy(),
+        'Net Change': year_df['Net Change'].to_numpy(),
+        '% Change': year_df['% Change'].to_numpy()
+    }, index=pd.Index(year_df['Location'].to_numpy(), name='local authority'))
+
+    return result_df
+
 
-#get possible single years of age in the forecast pop df
-list_possible_ages = list(df_pop_forecast_district.iloc[:,2:-2].columns)
-list_possible_years = list(set(list(df_pop_forecast_district['Year'])))
+def lsoa_population_trajectory(df_lsoa_level, pop_df, local_authorities, min_age, max_age, start_year, gender, geography_level):
+    """
+    Forecast population of each LSOA for the baseline and every later projection year, applying
+    the % change by single year of age of its area (as apply_percent_changes_iteratively does for one year).
+
+    Parameters:
+    df_lsoa_level (DataFrame): Output of load_and_process_baseline_data.
+    pop_df (CompactProjections or DataFrame): Population projections for the selected geography level.
+
+    Returns:
+    DataFrame: Forecast population indexed by LSOA21CD, with one column per year.
+    """
+    years = trajectory.trajectory_years(pop_df, start_year)
+    age_columns = df_lsoa_level.columns[3:].tolist()
+    lsoa_age_values = df_lsoa_level[age_columns].to_numpy(dtype=np.float64)
+
+    if geography_level in lsoa_apportionment.GEOGRAPHY_LEVEL_COLUMNS:
+        locations, percent_change = trajectory.age_change_trajectory(pop_df, local_authorities, min_age, max_age, start_year, years, gender)
+        location_column = lsoa_apportionment.GEOGRAPHY_LEVEL_COLUMNS[geography_level]
+        forecast = trajectory.lsoa_forecast_trajectory(lsoa_age_values, df_lsoa_level[location_column], locations, percent_change)
+    else:
+        forecast = np.repeat(lsoa_age_values.sum(axis=1)[:, None], len(years), axis=1)
+
+    return pd.DataFrame(forecast, index=pd.Index(df_lsoa_level['LSOA 2021 Code'].to_numpy(), name='LSOA21CD'), columns=years)
+
+
+def summarise_lsoa_trajectory(df_lsoa_trajectory):
+    # Total forecast population over the LSOAs in each year, with the change from the first (baseline) year
+    totals = df_lsoa_trajectory.sum(axis=0)
+    summary_df = pd.DataFrame({'Year': totals.index.astype(int), 'Forecast Population': totals.to_numpy()})
+    summary_df['Net Change'] = summary_df['Forecast Population'] - summary_df['Forecast Population'].iloc[0]
+    summary_df['% Change'] = (summary_df['Net Change'] / summary_df['Forecast Population'].iloc[0]) * 100
+    return summary_df
+
+
+def create_trajectory_chart(df, y_variable, forecast_year, color_variable=None):
+    """
+    Line chart of a trajectory over every projection year, with the selected forecast year marked.
+
+    Parameters:
+    df (pd.DataFrame): Trajectory with a 'Year' column.
+    y_variable (str): The column name to be used for the y-axis.
+    forecast_year (int): Forecast year selected on the page (drawn as a dashed line).
+    color_variable (str, optional): Column to draw one line per value of (e.g. 'Location').
+
+    Returns:
+    alt.Chart: An Altair Chart object that can be rendered in Streamlit.
+    """
+    tooltip = ['Year', alt.Tooltip(f'{y_variable}:Q', title=y_variable, format=',.1f')]
+    encoding = {
+        'x': alt.X('Year:O', title='Year'),
+        'y': alt.Y(f'{y_variable}:Q', title=y_variable),
+        'tooltip': tooltip,
+    }
+    if color_variable is not None:
+        encoding['color'] = alt.Color(f'{color_variable}:N', title=color_variable)
+        encoding['tooltip'] = [color_variable] + tooltip
+
+    lines = alt.Chart(df).mark_line(point=True).encode(**encoding)
+    selected_year = alt.Chart(pd.DataFrame({'Year': [forecast_year]})).mark_rule(color='red', strokeDash=[4, 4]).encode(x='Year:O')
+
+    return (lines + selected_year).properties(
+        width=600,
+        height=400,
+        title=f'{y_variable} by year'
+    )
 
-list_possible_district_las = sorted(list(set(df_pop_forecast_district['local authority'])))
-list_possible_utlas = sorted(list(set(df_pop_forecast_utla['local authority'])))
 
+def create_sensitivity_chart(df, y_variable):
+    """
+    One line chart per parameter, showing y_variable as that parameter is varied on its own.
+
+    Parameters:
+    df (pd.DataFrame): 'Parameter', 'Parameter value' and y_variable columns (see scenario_engine.one_way_sensitivity).
+    y_variable (str): The column name to be used for the y-axis.
+
+    Returns:
+    alt.Chart: An Altair Chart object that can be rendered in Streamlit.
+    """
+    chart = alt.Chart(df).mark_line(point=True).encode(
+        x=alt.X('Parameter value:Q', title=None),
+        y=alt.Y(f'{y_variable}:Q', title=y_variable),
+        tooltip=['Parameter', 'Parameter value', alt.Tooltip(f'{y_variable}:Q', title=y_variable, format=',.0f')]
+    ).properties(
+        width=250,
+        height=300
+    ).facet(
+        column=alt.Column('Parameter:N', title=None)
+    ).resolve_scale(x='independent')
+
+    return chart
+
+
+def create_uncertainty_chart(df_draws, x_variable, df_bands):
+    """
+    Histogram of x_variable over the Monte Carlo draws, with the percentile bands marked.
+
+    Parameters:
+    df_draws (pd.DataFrame): One row per draw (see monte_carlo.lsoa_demand_uncertainty).
+    x_variable (str): The column name to be used for the x-axis.
+    df_bands (pd.DataFrame): Percentile table (see monte_carlo.outcome_bands).
+
+    Returns:
+    alt.Chart: An Altair Chart object that can be rendered in Streamlit.
+    """
+    histogram = alt.Chart(df_draws[[x_variable]].dropna()).mark_bar().encode(
+        x=alt.X(f'{x_variable}:Q', bin=alt.Bin(maxbins=60), title=x_variable),
+        y=alt.Y('count():Q', title='Draws'),
+    )
+
+    df_rules = df_bands.loc[x_variable].rename_axis('Percentile').reset_index(name=x_variable)
+    rules = alt.Chart(df_rules).mark_rule(color='red', strokeDash=[4, 4]).encode(
+        x=f'{x_variable}:Q',
+        tooltip=['Percentile', alt.Tooltip(f'{x_variable}:Q', format=',.0f')]
+    )
+
+    return (histogram + rules).properties(width=700, height=350)
+
+
+def create_profile_waterfall_chart(df_profile):
+    """
+    Waterfall of the steps of a profiled page run: a bar from the start to the end of
+    each step, in the order they started, nested steps indented under their callers.
+
+    Parameters:
+    df_profile (pd.DataFrame): StageProfiler.summary() of the run.
+
+    Returns:
+    alt.Chart: An Altair Chart object that can be rendered in Streamlit.
+    """
+    df = df_profile.copy()
+    #numbered, as a step can run more than once in a run (e.g. one map render per map)
+    df['Label'] = [f'{i + 1}. ' + '· ' * depth + step for i, (depth, step) in enumerate(zip(df['Depth'], df['Step']))]
+
+    chart = alt.Chart(df).mark_bar().encode(
+        x=alt.X('Start (s):Q', title='Seconds from the start of the run'),
+        x2='End (s):Q',
+        y=alt.Y('Label:N', sort=None, title=None),
+        color=alt.Color('Kind:N', title='Kind'),
+        opacity=alt.condition(alt.datum['Status'] == 'reused', alt.value(0.4), alt.value(1.0)),
+        tooltip=['Step', 'Kind', 'Status',
+                 alt.Tooltip('Seconds:Q', format=',.3f'),
+                 alt.Tooltip('Peak Memory (MB):Q', format=',.1f'),
+                 alt.Tooltip('Rows In:Q', format=','),
+                 alt.Tooltip('Rows Out:Q', format=',')]
+    ).properties(width=700, height=max(150, 22 * len(df)))
+
+    return chart
 
 #--------------------------------------------------------------
 #load and subset the lsoa and single year of age baseline population
 #--------------------------------------------------------------
 def load_and_process_baseline_data(pop_proj_gender, geography_level, list_of_areas_to_forecast, pop_proj_min_age, pop_proj_max_age):
-    # Determine file path based on gender selection
-    file_path = f"build_data/baseline_pop_lsoa_syoa_sex/2022_{pop_proj_gender.lower()}_lsoa_syoa.csv"
-    baseline_lsoa_pop_syoa = pd.read_csv(file_path)
-    
-    # Load the LSOA to district and UTLA lookup file and clean it
-    lsoa_district_utla_lookup = pd.read_csv('build_data/lookups/lsoa_2021_to_la_district.csv')
-    lsoa_district_utla_lookup.drop(['ObjectId', 'utla_name'], axis=1, inplace=True)
-
+    # Get the baseline for the gender selection covering the areas, its LSOA to district / UTLA index and its age prefix sums, from the shared reference data
+    baseline_lsoa_pop_syoa, lsoa_geography_index, lsoa_age_prefix_sums = ref_data.get_baseline_for_areas(
+        pop_proj_gender, geography_level, list_of_areas_to_forecast)
 
     # Determine the column to filter on based on user parameter selected
     filter_column = 'LA Name' if geography_level == 'Upper Tier or Unitary Authority' else 'LAD23NM'
 
-    # Merge LA districts into the syoa lsoa pop to allow filtering in next stage
-    baseline_lsoa_pop_syoa_updated = baseline_lsoa_pop_syoa.merge(
-        lsoa_district_utla_lookup, left_on='LSOA 2021 Code', right_on='LSOA21CD', how='left')
-
-    # Subset to the selected geography/ies
-    baseline_lsoa_pop_syoa_filtered = baseline_lsoa_pop_syoa_updated[
-        baseline_lsoa_pop_syoa_updated[filter_column].isin(list_of_areas_to_forecast)]
-
+    # Row positions of the LSOAs in the selected geography/ies (precomputed, so no merge or isin scan)
+    rows = lsoa_geography_index.rows_for_areas(filter_column, list_of_areas_to_forecast)
 
     # Find the index position where age columns start and calculate index positions for the age range
-    age_start_col_index = int(baseline_lsoa_pop_syoa_filtered.columns.get_loc('0'))  # Assuming '0' is the first age column
+    age_start_col_index = int(baseline_lsoa_pop_syoa.columns.get_loc('0'))  # Assuming '0' is the first age column
     min_col_index = age_start_col_index + int(pop_proj_min_age)
     max_col_index = age_start_col_index + int(pop_proj_max_age) + 1
+    lsoa_code_col_index = baseline_lsoa_pop_syoa.columns.get_loc('LSOA 2021 Code')
 
-    filter_col_index = baseline_lsoa_pop_syoa_filtered.columns.get_loc(filter_column)
-
-    # Select all rows, the third column (LSOA code), and the age range columns
-    baseline_lsoa_pop_syoa_filtered_subset_cols = baseline_lsoa_pop_syoa_filtered.iloc[
-        :, [2, filter_col_index] + list(range(min_col_index, max_col_index))]
+    # Gather the selected rows, the LSOA code, and the age range columns
+    baseline_lsoa_pop_syoa_filtered_subset_cols = baseline_lsoa_pop_syoa.iloc[
+        rows, [lsoa_code_col_index] + list(range(min_col_index, max_col_index))].copy()
 
-
-    # Summing rows from column index 2 to the last column
-    baseline_lsoa_pop_syoa_filtered_subset_cols['Baseline Population'] = baseline_lsoa_pop_syoa_filtered_subset_cols.iloc[:, 2:].sum(axis=1)
-
-    # Insert the new column at index position 1
-    # This requires creating a new DataFrame or adjusting the columns
-    column_order = baseline_lsoa_pop_syoa_filtered_subset_cols.columns.tolist()
-    # Move 'Total Population' to the second position (index 1)
-    new_columns = [column_order[0], 'Baseline Population'] + column_order[1:-1]
-    baseline_lsoa_pop_syoa_filtered_subset_cols = baseline_lsoa_pop_syoa_filtered_subset_cols[new_columns]
+    # Age band total from the prefix sums (no summing of the age columns), then adding it and the area name after the LSOA code
+    baseline_population = lsoa_age_prefix_sums.band_totals(rows, pop_proj_min_age, pop_proj_max_age)
+    baseline_lsoa_pop_syoa_filtered_subset_cols.insert(1, 'Baseline Population', baseline_population)
+    baseline_lsoa_pop_syoa_filtered_subset_cols.insert(
+        2, filter_column, lsoa_geography_index.area_names_for_rows(filter_column, rows))
 
     return baseline_lsoa_pop_syoa_filtered_subset_cols
 
@@ -343,27 +576,21 @@ def load_and_process_baseline_data(pop_proj_gender, geography_level, list_of_are
 def apply_percent_changes_iteratively(df_lsoa_level, df_higher_level_pop_change, geography_level):
     # Load DataFrames
     lsoa_counts_df = df_lsoa_level.copy(deep=True)
-    #percent_changes_df = df_higher_level_pop_change
-
-    # Iterate over each location and age in the percent_changes DataFrame
-    for _, change_row in df_higher_level_pop_change.iterrows():
-        location = change_row['Location']
-        age = str(change_row['Age'])  # Ensuring age is a string if your column names are strings
-        percent_change = change_row['% Change'] / 100.0
-
-        # Check if the age column exists in lsoa_counts_df to avoid KeyErrors
-        if age in lsoa_counts_df.columns:
-            # Construct the mask for rows where the LSOA code matches
-            if geography_level == 'District Authority or Place':
-                mask = lsoa_counts_df['LAD23NM'] == location
-            elif geography_level == 'Upper Tier or Unitary Authority':
-                mask = lsoa_counts_df['LA Name'] == location
-            else:
-                pass
-
-            # Apply the percent change to the population count for the matching rows and age column
-            # Ensure that operation is only performed where mask is True
-            lsoa_counts_df.loc[mask, age] = lsoa_counts_df.loc[mask, age] * (1 + percent_change)
+
+    # Age columns follow the LSOA code, baseline population and geography columns
+    age_columns = lsoa_counts_df.columns[3:].tolist()
+
+    # Arrange the percent changes as a (location x age) matrix of growth factors
+    locations, factors = lsoa_apportionment.growth_factor_matrix(df_higher_level_pop_change, age_columns)
+
+    # Apply every factor in one multiply, matching each LSOA to its location once
+    if geography_level in lsoa_apportionment.GEOGRAPHY_LEVEL_COLUMNS:
+        location_column = lsoa_apportionment.GEOGRAPHY_LEVEL_COLUMNS[geography_level]
+        lsoa_counts_df[age_columns] = lsoa_apportionment.apply_growth_factors(
+            lsoa_counts_df[age_columns].to_numpy(dtype=np.float64),
+            lsoa_counts_df[location_column],
+            locations,
+            factors)
 
     # Summing rows from column index 2 to the last column
     lsoa_counts_df['Forecast Population'] = lsoa_counts_df.iloc[:, 3:].sum(axis=1)
@@ -398,7 +625,7 @@ def forecast_population_by_age(pop_df, local_authorities, min_age, max_age, star
     Calculate population metrics for each age within a specified range for given local authorities.
 
     Parameters:
-    pop_df (DataFrame): The population DataFrame.
+    pop_df (CompactProjections or DataFrame): The population projections.
     local_authorities (list): List of local authorities to include.
     min_age (int): Minimum age in the range.
     max_age (int): Maximum age in the range.
@@ -410,43 +637,48 @@ def forecast_population_by_age(pop_df, local_authorities, min_age, max_age, star
     DataFrame: A DataFrame with population metrics by age for each local authority.
     """
 
-    # Filter data for the specified local authorities and gender
-    df_filtered = pop_df[(pop_df['local authority'].isin(local_authorities)) & (pop_df['Gender'] == gender)]
-
-    # Initialize a list to hold data for the final DataFrame
-    results = []
-
-    # Iterate over each age in the specified range
-    for age in range(int(min_age), int(max_age) + 1):
-        age_column = str(age)
+    # Get the dense array version of the projections (built once per frame, see forecast_engine.py)
+    cube = forecast_engine.projection_cube_for(pop_df)
+    ages = list(range(int(min_age), int(max_age) + 1))
 
-        # Filter and calculate for the baseline year
-        baseline_data = df_filtered[df_filtered['Year'] == start_year]
-        baseline_pop = baseline_data[age_column].groupby(baseline_data['local authority']).sum()
+    # Population for each age (rows) and local authority (columns) in the baseline and forecast year
+    baseline_pop, baseline_present = cube.single_age_counts(local_authorities, gender, start_year, min_age, max_age)
+    forecast_pop, forecast_present = cube.single_age_counts(local_authorities, gender, forecast_year, min_age, max_age)
 
-        # Filter and calculate for the forecast year
-        forecast_data = df_filtered[df_filtered['Year'] == forecast_year]
-        forecast_pop = forecast_data[age_column].groupby(forecast_data['local authority']).sum()
-
-        # Calculate net change and percentage change
-        net_change = forecast_pop - baseline_pop
-        percent_change = (net_change / baseline_pop * 100).fillna(0)  # Handle division by zero
+    # Calculate net change and percentage change
+    # (a location only in one of the two years has no net change, as with the aligned groupby totals)
+    both_present = baseline_present & forecast_present
+    either_present = baseline_present | forecast_present
+    net_change = np.where(both_present, forecast_pop - baseline_pop, 0)
+    if (either_present & ~both_present).any():
+        net_change = np.where(either_present & ~both_present, np.nan, net_change)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        percent_change = np.where(both_present, net_change / baseline_pop * 100, 0.0)
+    percent_change = np.nan_to_num(percent_change, nan=0.0, posinf=np.inf, neginf=-np.inf)  # Handle division by zero
+
+    # One row per age and location, ordered by age then location
+    result_df = pd.DataFrame({
+        'Location': list(local_authorities) * len(ages),
+        'Age': np.repeat(np.array(ages, dtype=np.int64), len(local_authorities)),
+        'Baseline Population': baseline_pop.ravel(),
+        'Forecast Population': forecast_pop.ravel(),
+        'Net Change': np.asarray(net_change).ravel(),
+        '% Change': percent_change.ravel()
+    })
 
-        # Store results for each age
-        for location in local_authorities:
-            results.append({
-                'Location': location,
-                'Age': age,
-                'Baseline Population': baseline_pop.get(location, 0),
-                'Forecast Population': forecast_pop.get(location, 0),
-                'Net Change': net_change.get(location, 0),
-                '% Change': percent_change.get(location, 0)
-            })
+    return result_df
 
-    # Create a DataFrame from the results
-    result_df = pd.DataFrame(results)
+#------------------------------------------
 
-    return result_df
+@st.cache_data(max_entries=8, show_spinner='Running Monte Carlo simulation...')
+def simulate_demand_uncertainty(df_lsoa_population, activity, baseline_prevalence, forecast_prevalence, projection_error, modifier_total, n_draws, seed):
+    """
+    Cached monte_carlo.lsoa_demand_uncertainty, so other widgets on the page do not rerun the draws.
+    """
+    #run in this process: the server is shared and multithreaded, so no process pool is started from a page
+    return monte_carlo.lsoa_demand_uncertainty(
+        df_lsoa_population[['LSOA21CD', 'Baseline Population', 'Forecast Population']],
+        activity, baseline_prevalence, forecast_prevalence, projection_error, modifier_total, n_draws=n_draws, seed=seed, n_workers=1)
 
 #------------------------------------------
 
@@ -528,4 +760,147 @@ def merge_imd_decile(df, df_lsoa_imd_decile):
 
     return merged_df
 
-#------------------------------------------
\ No newline at end of file
+#------------------------------------------
+
+def baseline_met_need(df_map_attributes, df_users_activity, lsoa_col, activity_count_col):
+    """
+    Baseline need less the activity seen in each LSOA (0 where the upload has no activity for an LSOA).
+
+    Returns:
+    DataFrame: LSOA21CD, Baseline Need, the activity count column and Baseline Met Need.
+    """
+    user_df = df_users_activity[[lsoa_col, activity_count_col]]
+    df_subset_baseline_met_need = df_map_attributes[['LSOA21CD', 'Baseline Need']]
+
+    # Merge the activity counts onto the LSOA attributes
+    df_subset_baseline_met_need = df_subset_baseline_met_need.merge(user_df, on=lsoa_col, how='left')
+
+    # Fill missing Activity_Count values with 0
+    df_subset_baseline_met_need[activity_count_col] = df_subset_baseline_met_need[activity_count_col].fillna(0)
+
+    # Calculate 'Baseline Met Need'
+    df_subset_baseline_met_need['Baseline Met Need'] = df_subset_baseline_met_need['Baseline Need'] - df_subset_baseline_met_need[activity_count_col]
+    return df_subset_baseline_met_need
+
+def cached_forecast_result(name, compute, geography_level, list_of_areas_to_forecast, min_age, max_age, baseline_year=None, forecast_year=None, gender=None):
+    """
+    compute(*parameters) through the shared bounded result cache, called with and keyed on
+    the normalised parameters (see result_cache.normalise_forecast_params) and the reference
+    data version, so results from before an update of build_data/ are not served from memory.
+
+    Returns:
+    A copy of the (cached) result.
+    """
+    params = result_cache.normalise_forecast_params(geography_level, list_of_areas_to_forecast, min_age, max_age, baseline_year, forecast_year, gender)
+    key = (name, ref_store.reference_data_version()) + params
+    return result_cache.forecast_results.get_or_compute(key, lambda: compute(*params))
+
+#------------------------------------------
+#the mapping page pipeline as a graph of stages (see pipeline_graph.py), so a widget
+#change only reruns the stages that read it, e.g. a new prevalence reruns the need
+#stage and the need maps, not the population stages or the other maps
+#------------------------------------------
+
+#the population stages go through the shared bounded result cache (see result_cache.py),
+#so selections made earlier (in this or another session, on either page) are not recomputed.
+#they work out every year from the baseline at once (see trajectory.py) and do not read the
+#forecast year, the stages that do only take that year's slice of them
+
+def lsoa_baseline_stage(pop_proj_gender, geography_level, list_of_areas_to_forecast, pop_proj_min_age, pop_proj_max_age):
+    def compute(geography_level, list_of_areas_to_forecast, pop_proj_min_age, pop_proj_max_age, _, __, pop_proj_gender):
+        return load_and_process_baseline_data(pop_proj_gender, geography_level, list(list_of_areas_to_forecast), pop_proj_min_age, pop_proj_max_age)
+
+    return cached_forecast_result('load_and_process_baseline_data', compute, geography_level, list_of_areas_to_forecast, pop_proj_min_age, pop_proj_max_age, None, None, pop_proj_gender)
+
+
+def lsoa_trajectory_stage(df_lsoa_syoa_selected_age_range, geography_level, list_of_areas_to_forecast, pop_proj_min_age, pop_proj_max_age, pop_proj_baseline_year, pop_proj_gender):
+    # The LSOA trajectory is fully determined by the selections the baseline was made from
+    def compute(geography_level, list_of_areas_to_forecast, min_age, max_age, start_year, _, gender):
+        pop_df = ref_data.get_pop_projections(geography_level)
+        return lsoa_population_trajectory(df_lsoa_syoa_selected_age_range, pop_df, list(list_of_areas_to_forecast), min_age, max_age, start_year, gender, geography_level)
+
+    return cached_forecast_result('lsoa_population_trajectory', compute, geography_level, list_of_areas_to_forecast, pop_proj_min_age, pop_proj_max_age, pop_proj_baseline_year, None, pop_proj_gender)
+
+
+def lsoa_forecast_stage(df_lsoa_syoa_selected_age_range, df_individual_ages_pop_change, geography_level):
+    # The forecast year's growth factors (sliced from the by age trajectory) applied to the LSOA baseline, in one multiply.
+    # Every year's LSOA x age frame is not kept, as for a national selection that would run to hundreds of MB
+    return apply_percent_changes_iteratively(df_lsoa_syoa_selected_age_range, df_individual_ages_pop_change, geography_level)
+
+
+def insert_needs_stage(df, baseline_prevalence, forecast_prevalence):
+    #no prevalence rates when demand is not modelled from prevalence, the LSOA population is passed on as it is
+    if baseline_prevalence is None or forecast_prevalence is None:
+        return df
+    return calculate_and_insert_needs(df, baseline_prevalence, forecast_prevalence)
+
+
+def imd_quintiles_stage(df):
+    return map_func.convert_deciles_to_quintiles(df, 'IMD Decile')
+
+
+def map_attributes_stage(df, lsoa_geometry_store):
+    #attributes only (no geometry) for the LSOAs that have a boundary to draw
+    if lsoa_geometry_store is None:
+        return df.iloc[0:0]
+    return df[lsoa_geometry_store.has_boundary(df['LSOA21CD'])]
+
+
+def map_values_stage(column):
+    #just the column a map draws, so the map is only rebuilt when that column changes
+    return lambda df_map_attributes: df_map_attributes[['LSOA21CD', column]]
+
+
+def heatmap_html_stage(df_values, lsoa_geometry_store, use_vector_tiles):
+    m = map_func.build_folium_map_heatmap(df_values, count_column=df_values.columns[-1], line_weight=1, color_scheme='RdYlGn', LSOA_column='LSOA21CD', geometry_store=lsoa_geometry_store, use_vector_tiles=use_vector_tiles)
+    return map_func.folium_map_html(m)
+
+
+def net_change_map_html_stage(df_values, lsoa_geometry_store, use_vector_tiles):
+    m = map_func.build_folium_map_heatmap_net_change(df_values, df_values.columns[-1], line_weight=1, geometry_store=lsoa_geometry_store, use_vector_tiles=use_vector_tiles)
+    return map_func.folium_map_html(m)
+
+
+trajectory_stage_inputs = ['geography_level', 'list_of_areas_to_forecast', 'pop_proj_min_age', 'pop_proj_max_age', 'pop_proj_baseline_year', 'pop_proj_gender']
+map_stage_inputs = ['lsoa_geometry_store', 'use_vector_tiles']
+
+LSOA_PIPELINE = pipeline_graph.PipelineGraph([
+    pipeline_graph.Stage('lsoa_baseline', lsoa_baseline_stage, ['pop_proj_gender', 'geography_level', 'list_of_areas_to_forecast', 'pop_proj_min_age', 'pop_proj_max_age']),
+    pipeline_graph.Stage('population_trajectory', forecast_population_trajectory, trajectory_stage_inputs),
+    pipeline_graph.Stage('population_by_age_trajectory', forecast_population_by_age_trajectory, trajectory_stage_inputs),
+    pipeline_graph.Stage('lsoa_trajectory', lsoa_trajectory_stage, ['lsoa_baseline'] + trajectory_stage_inputs),
+    #the forecast year's slices
+    pipeline_graph.Stage('population_change', forecast_population_for_year, ['population_trajectory', 'pop_proj_forecast_year', 'pop_proj_min_age', 'pop_proj_max_age', 'pop_proj_gender']),
+    pipeline_graph.Stage('population_change_by_age', forecast_population_by_age_for_year, ['population_by_age_trajectory', 'pop_proj_forecast_year']),
+    pipeline_graph.Stage('lsoa_forecast', lsoa_forecast_stage, ['lsoa_baseline', 'population_change_by_age', 'geography_level']),
+    pipeline_graph.Stage('lsoa_need', insert_needs_stage, ['lsoa_forecast', 'baseline_prevalence', 'forecast_prevalence']),
+    pipeline_graph.Stage('lsoa_imd', merge_imd_decile, ['lsoa_need', 'df_lsoa_imd_decile']),
+    pipeline_graph.Stage('lsoa_attributes', imd_quintiles_stage, ['lsoa_imd']),
+    pipeline_graph.Stage('lsoa_map_attributes', map_attributes_stage, ['lsoa_attributes', 'lsoa_geometry_store']),
+    #maps, built from just the values they draw and kept as html (one per map, as they can be large)
+    pipeline_graph.Stage('imd_map_values', map_values_stage('IMD Quintile'), ['lsoa_map_attributes']),
+    pipeline_graph.Stage('population_change_map_values', map_values_stage('Net Pop Change'), ['lsoa_map_attributes']),
+    pipeline_graph.Stage('need_change_map_values', map_values_stage('Net Need Change'), ['lsoa_map_attributes']),
+    pipeline_graph.Stage('met_need_map_values', baseline_met_need, ['lsoa_map_attributes', 'df_users_activity', 'lsoa_col', 'activity_count_col']),
+    pipeline_graph.Stage('imd_map', heatmap_html_stage, ['imd_map_values'] + map_stage_inputs, memo_entries=1),
+    pipeline_graph.Stage('population_change_map', net_change_map_html_stage, ['population_change_map_values'] + map_stage_inputs, memo_entries=1),
+    pipeline_graph.Stage('need_change_map', net_change_map_html_stage, ['need_change_map_values'] + map_stage_inputs, memo_entries=1),
+    pipeline_graph.Stage('met_need_map', net_change_map_html_stage, ['met_need_map_values'] + map_stage_inputs, memo_entries=1),
+])
+
+
+def run_lsoa_pipeline(targets, params):
+    """
+    Results of the mapping page pipeline stages in targets, rerunning only the stages
+    whose inputs have changed since earlier runs in this session.
+
+    Parameters:
+    targets (list): Names of stages of LSOA_PIPELINE.
+    params (dict): Values of the page inputs the stages read (see LSOA_PIPELINE.parameters()).
+
+    Returns:
+    dict: Stage name -> result.
+    """
+    memo = st.session_state.setdefault('lsoa_pipeline_memo', {})
+    with st.spinner('Modelling LSOA population...'):
+        return LSOA_PIPELINE.run(targets, params, memo)
@@ -0,0 +1,202 @@
+import os
+
+import streamlit as st
+
+from pages.page_functions import reference_store as ref_store
+from pages.page_functions import geography_index
+from pages.page_functions import lsoa_age_sums
+from pages.page_functions import lsoa_catchments
+from pages.page_functions import geometry_store
+from pages.page_functions import compact_projections
+
+#--------------------------------------------------------------
+# Process-wide registry of the reference data used by the pages.
+#
+# Everything is loaded once per server process with st.cache_resource and
+# the same objects are handed to every user session. The frames in the
+# registry are shared, so callers must treat them as read-only (filter or
+# copy them, never modify them in place).
+#
+# The cache is keyed on reference_store.reference_data_version(), which
+# changes whenever a file under build_data/ is updated, so replacing the
+# reference data invalidates the registry without restarting the app.
+#--------------------------------------------------------------
+
+GENDERS = ['Persons', 'Males', 'Females']
+
+#LSOA baselines up to this many rows are held whole in memory, larger (e.g. national) ones
+#are read from the store for the UTLAs selected (override with BASELINE_IN_MEMORY_MAX_LSOAS)
+DEFAULT_BASELINE_IN_MEMORY_MAX_LSOAS = 5000
+
+#baselines read for recent UTLA selections, when they are not held whole
+BASELINE_SELECTIONS_KEPT = 16
+
+#lookup from the geography level selected on the pages to the projection table
+GEOGRAPHY_LEVEL_PROJECTIONS = {
+    'Upper Tier or Unitary Authority': 'pop_proj_utla',
+    'District Authority or Place': 'pop_proj_district',
+}
+
+#----------------------------------------------
+
+@st.cache_resource(max_entries=1, show_spinner='Loading reference data...')
+def load_reference_data(version):
+    """
+    Load every reference table into a single dictionary.
+
+    Parameters:
+    version (str): Reference data version, used only as the cache key.
+
+    Returns:
+    dict: Nested dictionary of the reference data, laid out as:
+        'pop_projections': {'pop_proj_district': CompactProjections, 'pop_proj_utla': CompactProjections}
+        'pop_estimates': {'Persons': DataFrame, 'Males': DataFrame, 'Females': DataFrame}
+        'lookups': {'df_lsoa_to_district': DataFrame, 'df_imd_decile': DataFrame}
+        'indexes': {'lsoa_geography': {'Persons': LsoaGeographyIndex, ...},
+                    'lsoa_age_sums': {'Persons': LsoaAgePrefixSums, ...}} (one of each per baseline)
+
+    Baselines larger than baseline_in_memory_max_lsoas() are left out of 'pop_estimates' and
+    'indexes', see get_baseline_for_areas. LSOA boundaries are not held here, see get_lsoa_geometry_store.
+    """
+    #projections are held as integer codes and an int32 age matrix (see compact_projections.py)
+    dict_pop_projections = {}
+    dict_pop_projections['pop_proj_district'] = compact_projections.load_compact_projections('pop_proj_district')
+    dict_pop_projections['pop_proj_utla'] = compact_projections.load_compact_projections('pop_proj_utla')
+
+    dict_pop_estimates = {}
+    for gender in GENDERS:
+        if ref_store.stored_row_count(ref_store.baseline_table_name(gender)) <= baseline_in_memory_max_lsoas():
+            dict_pop_estimates[gender] = ref_store.load_baseline_syoa(gender)
+
+    dict_lookups = {}
+    dict_lookups['df_lsoa_to_district'] = ref_store.load_reference_table('lookup_lsoa_to_district')
+    dict_lookups['df_imd_decile'] = ref_store.load_reference_table('lsoa_imd_decile')
+
+    #LSOA to district / UTLA row index for each baseline, so areas can be selected without a merge
+    dict_indexes = {}
+    dict_indexes['lsoa_geography'] = {
+        gender: geography_index.build_lsoa_geography_index(dict_pop_estimates[gender], dict_lookups['df_lsoa_to_district'])
+        for gender in dict_pop_estimates}
+
+    #cumulative over age population of each LSOA, so the total for any age band is two gathers and a subtraction
+    dict_indexes['lsoa_age_sums'] = {
+        gender: lsoa_age_sums.build_lsoa_age_prefix_sums(dict_pop_estimates[gender]) for gender in dict_pop_estimates}
+
+    #master dictionary
+    dict_files = {}
+    dict_files['version'] = version
+    dict_files['pop_projections'] = dict_pop_projections
+    dict_files['pop_estimates'] = dict_pop_estimates
+    dict_files['lookups'] = dict_lookups
+    dict_files['indexes'] = dict_indexes
+
+    return dict_files
+
+
+def get_reference_data():
+    """
+    Return the shared reference data registry, reloading it if any file
+    under build_data/ has changed since it was loaded.
+    """
+    return load_reference_data(ref_store.reference_data_version())
+
+#----------------------------------------------
+
+def get_pop_projections(geography_level):
+    """
+    Return the shared population projections (a CompactProjections, to_frame() gives
+    the projection frame) for the selected geography level.
+    """
+    table_name = GEOGRAPHY_LEVEL_PROJECTIONS[geography_level]
+    return get_reference_data()['pop_projections'][table_name]
+
+#----------------------------------------------
+
+def baseline_in_memory_max_lsoas():
+    """
+    Largest LSOA baseline held whole in memory, from BASELINE_IN_MEMORY_MAX_LSOAS.
+    """
+    return int(os.environ.get('BASELINE_IN_MEMORY_MAX_LSOAS', DEFAULT_BASELINE_IN_MEMORY_MAX_LSOAS))
+
+
+@st.cache_resource(max_entries=BASELINE_SELECTIONS_KEPT, show_spinner=False)
+def load_baseline_for_utlas(version, pop_proj_gender, utlas):
+    """
+    Read the baseline rows for the given UTLAs from the store (only their row groups are read),
+    with an LSOA to district / UTLA index and the age prefix sums over them.
+
+    Parameters:
+    version (str): Reference data version, used only as the cache key.
+    utlas (tuple): UTLA names, sorted.
+    """
+    baseline_lsoa_pop_syoa = ref_store.load_baseline_syoa(pop_proj_gender, utlas=list(utlas))
+    lsoa_district_utla_lookup = load_reference_data(version)['lookups']['df_lsoa_to_district']
+    return (baseline_lsoa_pop_syoa,
+            geography_index.build_lsoa_geography_index(baseline_lsoa_pop_syoa, lsoa_district_utla_lookup),
+            lsoa_age_sums.build_lsoa_age_prefix_sums(baseline_lsoa_pop_syoa))
+
+
+def get_baseline_for_areas(pop_proj_gender, geography_level, areas):
+    """
+    Return an LSOA single year of age baseline covering the selected areas, with its LSOA
+    to district / UTLA index and its age prefix sums.
+
+    The whole shared baseline is returned when it is held in memory. Otherwise only the
+    rows of the UTLAs containing the areas are read from the store.
+
+    Returns:
+    tuple: (DataFrame, LsoaGeographyIndex, LsoaAgePrefixSums)
+    """
+    dict_files = get_reference_data()
+    if pop_proj_gender in dict_files['pop_estimates']:
+        return (dict_files['pop_estimates'][pop_proj_gender],
+                dict_files['indexes']['lsoa_geography'][pop_proj_gender],
+                dict_files['indexes']['lsoa_age_sums'][pop_proj_gender])
+
+    lookup = dict_files['lookups']['df_lsoa_to_district']
+    if geography_level == 'District Authority or Place':
+        utlas = lookup.loc[lookup[geography_index.DISTRICT_COLUMN].isin(areas), 'utla_name'].unique()
+    else:
+        utlas = areas
+    return load_baseline_for_utlas(dict_files['version'], pop_proj_gender, tuple(sorted({str(utla) for utla in utlas})))
+
+#----------------------------------------------
+
+@st.cache_resource(max_entries=1, show_spinner='Loading LSOA baselines...')
+def load_lsoa_age_cube(version):
+    """
+    Load the LSOA baselines of every gender as one cube, for LSOA catchments (see lsoa_catchments.py).
+
+    Parameters:
+    version (str): Reference data version, used only as the cache key.
+    """
+    return lsoa_catchments.load_lsoa_age_cube()
+
+
+def get_lsoa_age_cube():
+    """
+    Return the shared LSOA baselines cube (loaded the first time a file of LSOA catchments is used).
+    """
+    return load_lsoa_age_cube(ref_store.reference_data_version())
+
+#----------------------------------------------
+
+@st.cache_resource(max_entries=len(geometry_store.SIMPLIFY_TOLERANCES), show_spinner='Loading boundaries...')
+def load_lsoa_geometry_store(version, detail):
+    """
+    Load the precomputed LSOA boundaries at one level of detail (see geometry_store.py).
+
+    Parameters:
+    version (str): Reference data version, used only as the cache key.
+    detail (str): Level of detail ('full', 'fine', 'medium' or 'coarse').
+    """
+    return geometry_store.load_geometry_store(detail)
+
+
+def get_lsoa_geometry_store(n_features):
+    """
+    Return the shared precomputed LSOA boundaries at a level of detail suited
+    to drawing n_features LSOAs, or None if no boundary shapefile is available.
+    """
+    detail = geometry_store.detail_for_feature_count(n_features)
+    return load_lsoa_geometry_store(ref_store.reference_data_version(), detail)
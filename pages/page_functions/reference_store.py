@@ -0,0 +1,382 @@
+import hashlib
+import os
+import uuid
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+
+#--------------------------------------------------------------
+# Columnar store for the reference data shipped under build_data/
+#
+# The source CSVs are converted once into typed Arrow IPC (feather v2)
+# files under build_data/store/. Pages then read these files via a memory
+# map instead of re-parsing the CSVs on every Streamlit rerun.
+#
+# The sources can be the national ONS/NOMIS files: they are read in chunks
+# and, if build_data/region.txt lists the areas (districts or UTLAs) the
+# app is used for, only the rows for that region are kept. The LSOA
+# baselines are written as Parquet with one row group per UTLA, so the rows
+# for a few areas can be read without reading the rest (see
+# load_baseline_syoa).
+#
+# Nothing in this module imports streamlit, so it can be used from the
+# command line build step (build_reference_data.py) as well as the pages.
+#--------------------------------------------------------------
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+#the reference data can be kept outside the repo (e.g. the national files), see REFERENCE_DATA_DIR
+BUILD_DATA_DIR = os.environ.get('REFERENCE_DATA_DIR', os.path.join(REPO_ROOT, 'build_data'))
+STORE_DIR = os.path.join(BUILD_DATA_DIR, 'store')
+
+#name of each table in the store, mapped to its source csv and the kind of cleaning it needs
+REFERENCE_SOURCES = {
+    'pop_proj_district': ('pop_projections/district_pop_forecast_24_to_43_jucd_only.csv', 'pop_projection'),
+    'pop_proj_utla': ('pop_projections/utla_pop_forecast_24_to_43_jucd_only.csv', 'pop_projection'),
+    'baseline_persons': ('baseline_pop_lsoa_syoa_sex/2022_persons_lsoa_syoa.csv', 'baseline_syoa'),
+    'baseline_males': ('baseline_pop_lsoa_syoa_sex/2022_males_lsoa_syoa.csv', 'baseline_syoa'),
+    'baseline_females': ('baseline_pop_lsoa_syoa_sex/2022_females_lsoa_syoa.csv', 'baseline_syoa'),
+    'lookup_lsoa_to_district': ('lookups/lsoa_2021_to_la_district.csv', 'lookup'),
+    'lsoa_imd_decile': ('lsoa_imd_decile/lsoa_imd_decile.csv', 'lookup'),
+}
+
+#LSOA 2021 boundaries (only the local subset ships with the repo)
+LSOA_SHAPEFILE_PATH = os.path.join(BUILD_DATA_DIR, 'shapefiles_subset', 'local_area_shapefile.shp')
+
+#optional list of the areas (district or UTLA names, one per line) the store is limited to
+REGION_PATH = os.path.join(BUILD_DATA_DIR, 'region.txt')
+
+#rows of a source csv read at a time, so a national file is never held in memory whole
+CSV_CHUNK_ROWS = 20000
+
+#column each table is limited to the region on, and whether it holds area names or LSOA codes
+REGION_FILTER_COLUMNS = {
+    'pop_proj_district': ('local authority', 'areas'),
+    'pop_proj_utla': ('local authority', 'areas'),
+    'baseline_persons': ('LSOA 2021 Code', 'lsoas'),
+    'baseline_males': ('LSOA 2021 Code', 'lsoas'),
+    'baseline_females': ('LSOA 2021 Code', 'lsoas'),
+    'lookup_lsoa_to_district': ('LSOA21CD', 'lsoas'),
+    'lsoa_imd_decile': ('FeatureCode', 'lsoas'),
+}
+
+#tables written as Parquet with one row group per value of a column (in place of Arrow IPC)
+ROW_GROUP_COLUMNS = {
+    'baseline_persons': 'LA Name',
+    'baseline_males': 'LA Name',
+    'baseline_females': 'LA Name',
+}
+
+#schema metadata key recording the region a store file was built for
+REGION_METADATA_KEY = b'region'
+
+#the projection files are not consistent in how they label gender (e.g. 'Male' and 'Males')
+GENDER_LABELS = {
+    'Male': 'Males',
+    'Female': 'Females',
+    'Person': 'Persons',
+}
+
+#----------------------------------------------
+
+def source_path(table_name):
+    return os.path.join(BUILD_DATA_DIR, REFERENCE_SOURCES[table_name][0])
+
+
+def store_path(table_name):
+    if table_name in ROW_GROUP_COLUMNS:
+        return os.path.join(STORE_DIR, f'{table_name}.parquet')
+    return os.path.join(STORE_DIR, f'{table_name}.arrow')
+
+#----------------------------------------------
+
+def source_encoding(path):
+    """
+    Encoding to read a raw reference csv with: utf-8 (removing any byte order mark from the header),
+    or latin1 as some of the NOMIS/ONS downloads are not valid utf-8. The file is checked a block at a time.
+    """
+    with open(path, encoding='utf-8-sig') as f:
+        try:
+            while f.read(2**20):
+                pass
+        except UnicodeDecodeError:
+            return 'latin1'
+    return 'utf-8-sig'
+
+
+def read_source_csv_chunks(path, chunk_rows=CSV_CHUNK_ROWS):
+    """
+    Read a raw reference csv as an iterator of frames of up to chunk_rows rows.
+    """
+    return pd.read_csv(path, encoding=source_encoding(path), chunksize=chunk_rows)
+
+
+def parse_thousands(series):
+    """
+    Convert quoted totals such as "130,470" into integers.
+    """
+    if pd.api.types.is_numeric_dtype(series):
+        return series.astype('int64')
+    return series.astype(str).str.replace(',', '', regex=False).astype('int64')
+
+
+def age_columns_in(df):
+    """
+    Return the single year of age columns ('0' to '90') in the order they appear.
+    """
+    return [col for col in df.columns if str(col).isdigit()]
+
+#----------------------------------------------
+
+def clean_pop_projection(df):
+    df['All Ages'] = parse_thousands(df['All Ages'])
+    age_columns = age_columns_in(df)
+    df[age_columns] = df[age_columns].astype('int64')
+    df['Year'] = df['Year'].astype('int64')
+    df['Gender'] = df['Gender'].replace(GENDER_LABELS)
+    return df
+
+
+def clean_baseline_syoa(df):
+    #drop any trailing notes rows the ONS downloads carry below the data
+    df = df.dropna(subset=['LSOA 2021 Code']).reset_index(drop=True)
+    df['Total'] = parse_thousands(df['Total'])
+    age_columns = age_columns_in(df)
+    df[age_columns] = df[age_columns].astype('int64')
+    return df
+
+
+def clean_lookup(df):
+    return df
+
+
+CLEANERS = {
+    'pop_projection': clean_pop_projection,
+    'baseline_syoa': clean_baseline_syoa,
+    'lookup': clean_lookup,
+}
+
+#----------------------------------------------
+
+def read_region():
+    """
+    Area names listed in build_data/region.txt, sorted (None if there is no region file, keeping every row).
+    """
+    if not os.path.exists(REGION_PATH):
+        return None
+    with open(REGION_PATH, encoding='utf-8-sig') as f:
+        areas = {line.strip() for line in f if line.strip() and not line.lstrip().startswith('#')}
+    return sorted(areas)
+
+
+def region_fingerprint(region_areas):
+    """
+    Short hash of the region's area names, recorded in each store file ('' when there is no region).
+    """
+    if region_areas is None:
+        return ''
+    return hashlib.sha1('\n'.join(sorted(region_areas)).encode()).hexdigest()[:12]
+
+
+def region_selection(region_areas):
+    """
+    Expand the region's area names, with the LSOA lookup, into the districts, UTLAs and LSOAs it covers.
+
+    Parameters:
+    region_areas (list): District (LAD23NM) or UTLA names, or None for no region.
+
+    Returns:
+    dict: {'areas': set of district and UTLA names, 'lsoas': set of LSOA codes, 'fingerprint': str},
+    or None when there is no region.
+    """
+    if region_areas is None:
+        return None
+    areas = set()
+    lsoas = set()
+    for chunk in read_source_csv_chunks(source_path('lookup_lsoa_to_district')):
+        in_region = chunk['LAD23NM'].isin(region_areas) | chunk['utla_name'].isin(region_areas)
+        areas.update(chunk.loc[in_region, 'LAD23NM'])
+        areas.update(chunk.loc[in_region, 'utla_name'])
+        lsoas.update(chunk.loc[in_region, 'LSOA21CD'])
+    unknown = sorted(set(region_areas) - areas)
+    if unknown:
+        raise ValueError(f'region areas not in the LSOA lookup: {", ".join(unknown)}')
+    return {'areas': areas, 'lsoas': lsoas, 'fingerprint': region_fingerprint(region_areas)}
+
+
+def filter_to_region(df, table_name, selection):
+    """
+    Rows of a chunk of table_name in the region (all of them when selection is None).
+    """
+    if selection is None:
+        return df
+    column, kind = REGION_FILTER_COLUMNS[table_name]
+    return df[df[column].isin(selection[kind])].reset_index(drop=True)
+
+#----------------------------------------------
+
+def reference_data_version():
+    """
+    Return a short hash identifying the current state of the reference data.
+    It is derived from the size and modification time of every source file, so
+    any update under build_data/ produces a new version. A table shipped without its
+    source file counts by its store file instead.
+    """
+    paths = [source_path(table_name) if os.path.exists(source_path(table_name)) else store_path(table_name)
+             for table_name in REFERENCE_SOURCES] + [REGION_PATH]
+    shapefile_stem = os.path.splitext(LSOA_SHAPEFILE_PATH)[0]
+    paths += [shapefile_stem + ext for ext in ('.shp', '.shx', '.dbf', '.prj')]
+
+    fingerprint = hashlib.sha1()
+    for path in paths:
+        if os.path.exists(path):
+            stat = os.stat(path)
+            fingerprint.update(f'{os.path.relpath(path, BUILD_DATA_DIR)}:{stat.st_size}:{stat.st_mtime_ns};'.encode())
+    return fingerprint.hexdigest()[:12]
+
+#----------------------------------------------
+
+def stored_region(table_name):
+    """
+    Region fingerprint recorded in the store file for table_name.
+    """
+    path = store_path(table_name)
+    if table_name in ROW_GROUP_COLUMNS:
+        metadata = pq.read_schema(path).metadata
+    else:
+        with pa.memory_map(path, 'r') as source:
+            metadata = pa.ipc.open_file(source).schema.metadata
+    return (metadata or {}).get(REGION_METADATA_KEY, b'').decode()
+
+
+def is_stale(table_name):
+    """
+    A store file is stale when it is missing, older than its source csv, or was built for another region.
+    A store file without its source csv (e.g. a deployment shipping only build_data/store/) is kept as it is.
+    """
+    path = store_path(table_name)
+    if not os.path.exists(path):
+        return True
+    if not os.path.exists(source_path(table_name)):
+        return False
+    if os.path.getmtime(path) < os.path.getmtime(source_path(table_name)):
+        return True
+    return stored_region(table_name) != region_fingerprint(read_region())
+
+
+def write_store_table(df, table_name, fingerprint):
+    """
+    Write a cleaned table to the store, recording the region it was built for.
+    """
+    table = pa.Table.from_pandas(df)
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), REGION_METADATA_KEY: fingerprint.encode()})
+
+    os.makedirs(STORE_DIR, exist_ok=True)
+    #write to a temp file of its own first, so a concurrent reader never sees a partial file
+    #and concurrent builders (other sessions or replicas) never write to the same file
+    tmp_path = f'{store_path(table_name)}.{uuid.uuid4().hex}.tmp'
+    if table_name in ROW_GROUP_COLUMNS:
+        #one row group per area, whose min / max statistics let a filtered read skip the other areas
+        column = ROW_GROUP_COLUMNS[table_name]
+        with pq.ParquetWriter(tmp_path, table.schema, compression='snappy') as writer:
+            for _, group in df.groupby(column, sort=False, dropna=False):
+                writer.write_table(table.take(group.index.to_numpy()))
+    else:
+        #uncompressed so it can be memory mapped when read
+        feather.write_feather(table, tmp_path, compression='uncompressed')
+    os.replace(tmp_path, store_path(table_name))
+
+
+def build_reference_table(table_name, selection=None):
+    """
+    Parse the source csv for table_name a chunk at a time, keeping only the rows
+    in the region, and write it to the store.
+
+    Parameters:
+    table_name (str): One of the keys in REFERENCE_SOURCES.
+    selection (dict): Output of region_selection (read from build_data/region.txt if not given).
+    """
+    if selection is None:
+        selection = region_selection(read_region())
+    relative_path, kind = REFERENCE_SOURCES[table_name]
+
+    chunks = [filter_to_region(CLEANERS[kind](chunk), table_name, selection)
+              for chunk in read_source_csv_chunks(source_path(table_name))]
+    df = pd.concat(chunks, ignore_index=True)
+    if table_name in ROW_GROUP_COLUMNS:
+        #rows of an area together (in their original order), one row group each
+        df = df.sort_values(ROW_GROUP_COLUMNS[table_name], kind='stable').reset_index(drop=True)
+
+    write_store_table(df, table_name, selection['fingerprint'] if selection is not None else '')
+    return df
+
+
+def build_reference_store(force=False):
+    """
+    Build (or refresh) every table in the store.
+
+    Parameters:
+    force (bool): Rebuild all tables, even those that are up to date.
+
+    Returns:
+    list: Names of the tables that were (re)built.
+    """
+    stale = [table_name for table_name in REFERENCE_SOURCES if force or is_stale(table_name)]
+    if stale:
+        selection = region_selection(read_region())
+        for table_name in stale:
+            build_reference_table(table_name, selection)
+    return stale
+
+
+def load_reference_table(table_name, filters=None):
+    """
+    Load a table from the columnar store, building it first if the store
+    file is missing or out of date.
+
+    Parameters:
+    table_name (str): One of the keys in REFERENCE_SOURCES.
+    filters (list): Parquet filters such as [('LA Name', 'in', ['Derby'])], for the
+        tables in ROW_GROUP_COLUMNS. Only the row groups that can match are read.
+
+    Returns:
+    DataFrame: The typed reference table.
+    """
+    if table_name not in REFERENCE_SOURCES:
+        raise KeyError(f'Unknown reference table: {table_name}')
+    if is_stale(table_name):
+        build_reference_table(table_name)
+    if table_name in ROW_GROUP_COLUMNS:
+        return pq.read_table(store_path(table_name), filters=filters).to_pandas()
+    if filters is not None:
+        raise ValueError(f'{table_name} is not stored in row groups, so cannot be read with filters')
+    return feather.read_table(store_path(table_name), memory_map=True).to_pandas()
+
+
+def stored_row_count(table_name):
+    """
+    Number of rows in a store table, from its metadata (building it first if out of date).
+    """
+    if is_stale(table_name):
+        build_reference_table(table_name)
+    if table_name in ROW_GROUP_COLUMNS:
+        return pq.read_metadata(store_path(table_name)).num_rows
+    with pa.memory_map(store_path(table_name), 'r') as source:
+        return pa.ipc.open_file(source).read_all().num_rows
+
+
+def baseline_table_name(pop_proj_gender):
+    return f'baseline_{pop_proj_gender.lower()}'
+
+
+def load_baseline_syoa(pop_proj_gender, utlas=None):
+    """
+    Load the 2022 LSOA single year of age baseline for 'Persons', 'Males' or 'Females'.
+
+    Parameters:
+    pop_proj_gender (str): 'Persons', 'Males' or 'Females'.
+    utlas (list): Only read the LSOAs in these UTLAs ('LA Name'), None for every LSOA.
+    """
+    filters = None if utlas is None else [('LA Name', 'in', list(utlas))]
+    return load_reference_table(baseline_table_name(pop_proj_gender), filters=filters)
@@ -0,0 +1,179 @@
+import os
+import sys
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from pages.page_functions import pipeline_graph
+from pages.page_functions import disk_cache
+
+#--------------------------------------------------------------
+# Memory bounded LRU cache for the population forecast results.
+#
+# Analysts flip between the same few gender / age band / geography
+# selections on both pages. The forecast frames for those selections are
+# kept here, shared by every session in the process, up to a fixed number
+# of MB (FORECAST_RESULT_CACHE_MB, default 256). When a new result would go
+# over the cap the least recently used results are dropped, so unlike
+# st.cache_data the cache cannot grow without limit on a shared server.
+#
+# Keys are built from normalised parameters (area lists sorted with
+# duplicates dropped, ages and years as int), and the functions are called
+# with the same normalised values, so a result found in the cache is the
+# same as the one that would have been computed. The pages add the
+# reference data version to their keys, so after an update of build_data/
+# results of the old data are no longer found (and age out of the cache).
+# Results are handed out as copies, as the pages add columns to them in place.
+#
+# Results missing from memory are looked for in the disk cache (see
+# disk_cache.py) before being computed, so restarted and other replicas
+# reuse them too.
+#--------------------------------------------------------------
+
+DEFAULT_MAX_MB = 256
+
+#----------------------------------------------
+
+def result_size(value):
+    """
+    Approximate memory used by a cached result, in bytes.
+    """
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(index=True, deep=True))
+    if isinstance(value, np.ndarray):
+        return int(value.nbytes)
+    if isinstance(value, (tuple, list)):
+        return sys.getsizeof(value) + sum(result_size(item) for item in value)
+    return sys.getsizeof(value)
+
+
+def normalise_areas(areas):
+    """
+    Areas as a sorted tuple without duplicates, so the same selection in any order gives the same key.
+    """
+    return tuple(sorted({str(area) for area in areas}))
+
+
+def normalise_forecast_params(geography_level, areas, min_age, max_age, baseline_year=None, forecast_year=None, gender=None):
+    """
+    The parameters shared by the forecast functions, in a normalised form (see normalise_areas, ages and years as int).
+
+    Returns:
+    tuple: (geography_level, areas, min_age, max_age, baseline_year, forecast_year, gender)
+    """
+    return (
+        str(geography_level),
+        normalise_areas(areas),
+        int(min_age),
+        int(max_age),
+        None if baseline_year is None else int(baseline_year),
+        None if forecast_year is None else int(forecast_year),
+        None if gender is None else str(gender),
+    )
+
+#----------------------------------------------
+
+class ResultCache:
+    """
+    Thread safe LRU cache of results, bounded by their total size in bytes,
+    optionally backed by a slower cache (e.g. disk_cache.DiskResultCache) with the same get / put.
+    """
+    def __init__(self, max_bytes, backing=None):
+        self.max_bytes = max_bytes
+        self.backing = backing
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.evicted_bytes = 0
+        self.rejected = 0
+
+    def get(self, key):
+        """
+        Returns:
+        tuple: (True, copy of the result) if key is cached, otherwise (False, None).
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return False, None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return True, pipeline_graph.handed_out(entry[0])
+
+    def put(self, key, value):
+        """
+        Cache value under key, dropping the least recently used results until it fits.
+        A result larger than the whole cap is not cached.
+        """
+        size = result_size(value)
+        with self._lock:
+            if size > self.max_bytes:
+                self.rejected += 1
+                return
+            if key in self._entries:
+                self.current_bytes -= self._entries.pop(key)[1]
+            while self._entries and self.current_bytes + size > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+                self.evictions += 1
+                self.evicted_bytes += evicted_size
+            self._entries[key] = (value, size)
+            self.current_bytes += size
+
+    def get_or_compute(self, key, compute):
+        """
+        The cached result for key (from memory, then the backing cache), or compute() (which is then cached in both).
+        """
+        found, value = self.get(key)
+        if found:
+            return value
+        if self.backing is not None:
+            found, value = self.backing.get(key)
+        if not found:
+            value = compute()
+            if self.backing is not None:
+                self.backing.put(key, value)
+        self.put(key, value)
+        return pipeline_graph.handed_out(value)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def metrics(self):
+        """
+        Size and hit / eviction counts, for monitoring.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'size_mb': self.current_bytes / 2**20,
+                'max_mb': self.max_bytes / 2**20,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'evicted_mb': self.evicted_bytes / 2**20,
+                'rejected': self.rejected,
+            }
+
+
+def max_bytes_from_environment():
+    """
+    Cache cap from FORECAST_RESULT_CACHE_MB (DEFAULT_MAX_MB if not set).
+    """
+    return int(float(os.environ.get('FORECAST_RESULT_CACHE_MB', DEFAULT_MAX_MB)) * 2**20)
+
+
+#the cache shared by the pages (one per process), backed by the disk cache shared between processes
+forecast_results = ResultCache(max_bytes_from_environment(), backing=disk_cache.disk_cache_from_environment())
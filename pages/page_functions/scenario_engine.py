@@ -0,0 +1,165 @@
+import numpy as np
+import pandas as pd
+
+#--------------------------------------------------------------
+# Demand scenarios over grids of prevalence and demand modifier values.
+#
+# Once the LSOA baseline and forecast populations are known, the demand
+# estimate on the mapping page is a cheap final step:
+#   need        = sum over LSOAs of int(population * prevalence per 100k)
+#   demand      = activity * (forecast need / baseline need)
+#   modified    = net demand change * (1 + sum of the modifiers / 100)
+# so a whole grid of scenarios is worked out as arrays (need totals for
+# every prevalence value, then an outer product over the grid) instead of
+# rerunning the page for each combination. Only the sum of the eight
+# modifier sliders matters, so modifiers are swept as a single total.
+#
+# monte_carlo.py (and so forecast_service_demand.py) uses scenario_range
+# from here, so streamlit stays out of this module.
+#--------------------------------------------------------------
+
+#largest number of LSOA x prevalence values worked on at once when totalling need
+NEED_CHUNK_ELEMENTS = 4_000_000
+
+SCENARIO_COLUMNS = [
+    'Baseline prevalence',
+    'Forecast prevalence',
+    'Total modifier %',
+    'Baseline Need',
+    'Forecast Need',
+    '% Need Change',
+    'Forecast Demand',
+    'Net Demand Change',
+    'Modified Net Demand Change',
+]
+
+#----------------------------------------------
+
+def parameter_grid(low, high, steps):
+    """
+    Evenly spaced values from low to high inclusive (just low if steps is 1 or low == high).
+    """
+    if steps <= 1 or low == high:
+        return np.array([float(low)])
+    return np.linspace(float(low), float(high), int(steps))
+
+
+def need_totals(population, prevalences):
+    """
+    Total need over the LSOAs for each prevalence (per 100,000 population), truncating
+    each LSOA's need to a whole number as calculate_and_insert_needs does.
+
+    Parameters:
+    population (array-like): Population of each LSOA.
+    prevalences (array-like): Prevalence values per 100,000.
+
+    Returns:
+    ndarray: int64 total need for each prevalence.
+    """
+    population = np.asarray(population, dtype=np.float64)
+    prevalences = np.asarray(prevalences, dtype=np.float64)
+    totals = np.empty(len(prevalences), dtype=np.int64)
+
+    chunk = max(1, NEED_CHUNK_ELEMENTS // max(len(population), 1))
+    for start in range(0, len(prevalences), chunk):
+        rates = prevalences[start:start + chunk, None] / 100000
+        totals[start:start + chunk] = np.trunc(population[None, :] * rates).astype(np.int64).sum(axis=1)
+    return totals
+
+
+def demand_scenarios(baseline_population, forecast_population, activity, baseline_prevalences, forecast_prevalences, modifier_totals):
+    """
+    Evaluate every combination of baseline prevalence, forecast prevalence and total modifier.
+
+    Parameters:
+    baseline_population, forecast_population (array-like): Population of each LSOA.
+    activity (float): Baseline demand (the activity total entered on the page).
+    baseline_prevalences, forecast_prevalences (array-like): Prevalence values per 100,000.
+    modifier_totals (array-like): Sum of the demand modifier sliders (%).
+
+    Returns:
+    DataFrame: One row per scenario, with the columns in SCENARIO_COLUMNS.
+    Scenarios with no baseline need have a missing % change and demand.
+    """
+    baseline_prevalences = np.asarray(baseline_prevalences, dtype=np.float64)
+    forecast_prevalences = np.asarray(forecast_prevalences, dtype=np.float64)
+    modifier_totals = np.asarray(modifier_totals, dtype=np.float64)
+
+    baseline_need = need_totals(baseline_population, baseline_prevalences).astype(np.float64)
+    forecast_need = need_totals(forecast_population, forecast_prevalences).astype(np.float64)
+
+    # [baseline prevalence, forecast prevalence] grid of need change
+    with np.errstate(divide='ignore', invalid='ignore'):
+        percent_change = np.where(
+            baseline_need[:, None] != 0,
+            (forecast_need[None, :] - baseline_need[:, None]) / baseline_need[:, None],
+            np.nan)
+    forecast_demand = activity + (activity * percent_change)
+    net_demand_change = np.round(forecast_demand - activity, 0)
+
+    # modifiers scale the net change: [baseline prevalence, forecast prevalence, modifier]
+    modified_net_demand_change = net_demand_change[:, :, None] * (1 + modifier_totals[None, None, :] / 100)
+
+    shape = modified_net_demand_change.shape
+    grid_b, grid_f, grid_m = np.meshgrid(np.arange(shape[0]), np.arange(shape[1]), np.arange(shape[2]), indexing='ij')
+    grid_b, grid_f, grid_m = grid_b.ravel(), grid_f.ravel(), grid_m.ravel()
+
+    return pd.DataFrame({
+        'Baseline prevalence': baseline_prevalences[grid_b],
+        'Forecast prevalence': forecast_prevalences[grid_f],
+        'Total modifier %': modifier_totals[grid_m],
+        'Baseline Need': baseline_need[grid_b],
+        'Forecast Need': forecast_need[grid_f],
+        '% Need Change': percent_change[grid_b, grid_f] * 100,
+        'Forecast Demand': forecast_demand[grid_b, grid_f],
+        'Net Demand Change': net_demand_change[grid_b, grid_f],
+        'Modified Net Demand Change': modified_net_demand_change.ravel(),
+    }, columns=SCENARIO_COLUMNS)
+
+#----------------------------------------------
+
+def scenario_range(df_scenarios, columns=('Forecast Demand', 'Net Demand Change', 'Modified Net Demand Change'), percentiles=(0, 10, 50, 90, 100)):
+    """
+    Spread of the scenario results, as a table of percentiles for each output column.
+    """
+    rows = {}
+    for column in columns:
+        values = df_scenarios[column].dropna().to_numpy()
+        rows[column] = np.percentile(values, percentiles) if len(values) else np.full(len(percentiles), np.nan)
+    labels = ['Min' if p == 0 else 'Max' if p == 100 else 'Median' if p == 50 else f'{p}th percentile' for p in percentiles]
+    return pd.DataFrame.from_dict(rows, orient='index', columns=labels)
+
+
+def one_way_sensitivity(df_scenarios, central_values, output_column='Modified Net Demand Change'):
+    """
+    How the output changes as each parameter is varied on its own, with the other
+    parameters held at the grid value closest to their central (entered) value.
+
+    Parameters:
+    df_scenarios (DataFrame): Output of demand_scenarios.
+    central_values (dict): Parameter column -> central value, for 'Baseline prevalence',
+        'Forecast prevalence' and 'Total modifier %'.
+
+    Returns:
+    DataFrame: 'Parameter', 'Parameter value' and output_column, one row per grid value of each parameter.
+    """
+    parameters = list(central_values)
+    # the grid value nearest to each central value
+    nearest = {}
+    for parameter in parameters:
+        grid_values = np.unique(df_scenarios[parameter].to_numpy())
+        nearest[parameter] = grid_values[np.argmin(np.abs(grid_values - central_values[parameter]))]
+
+    frames = []
+    for parameter in parameters:
+        held = np.ones(len(df_scenarios), dtype=bool)
+        for other in parameters:
+            if other != parameter:
+                held &= df_scenarios[other].to_numpy() == nearest[other]
+        varied = df_scenarios.loc[held, [parameter, output_column]].sort_values(parameter)
+        frames.append(pd.DataFrame({
+            'Parameter': parameter,
+            'Parameter value': varied[parameter].to_numpy(),
+            output_column: varied[output_column].to_numpy(),
+        }))
+    return pd.concat(frames, ignore_index=True)
@@ -0,0 +1,406 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from pages.page_functions import forecast_engine
+
+#--------------------------------------------------------------
+# Batch service demand engine.
+#
+# Works out the baseline and forecast population for every service in a
+# coverage file in one pass: the coverage becomes a sparse boolean matrix
+# (services x areas), which is multiplied into the prefix sums over age of
+# the projection cube, and the population of each service's age band is
+# the difference of two columns of the product.
+#
+# Coverage files come in two layouts: wide, with one yes/no column per
+# area after the service information, or long, with a LONG_FORMAT_AREA_COLUMN
+# and one row per service and area covered (for catalogues covering many
+# areas, where a column per area makes the file large and slow to read).
+# A long file can give the share of each area a service serves, and can
+# list LSOAs (LSOA_CATCHMENT_COLUMN) rather than districts / UTLAs, in
+# which case the populations come from the LSOA baselines (see lsoa_catchments.py).
+#
+# No streamlit in here so it can be used by the pages and the command line.
+#--------------------------------------------------------------
+
+#the first columns of a service coverage file, the area columns follow these
+SERVICE_INFO_COLUMNS = [
+    'Service name',
+    'min age seen',
+    'max age seen',
+    'gender seen',
+    'attendances in 12 months',
+    'average cost per appt',
+    'clinical_wte',
+]
+FIRST_AREA_COLUMN_INDEX = 6
+
+#the area column of a long format coverage file, which has a row per service and area covered
+LONG_FORMAT_AREA_COLUMN = 'area covered'
+#or, for catchments made of LSOAs, the LSOA code column
+LSOA_CATCHMENT_COLUMN = 'LSOA covered'
+#optional column of a long format file: the share (0 to 1) of the area's population the service serves
+CATCHMENT_SHARE_COLUMN = 'share served'
+
+#rows of a service coverage file forecast at a time by stream_service_trajectory
+SERVICE_CHUNK_ROWS = 5000
+
+#modifiable risk factors estimated among the people seen by a service:
+#key -> (description used in the column names, default prevalence %)
+RISK_FACTORS = {
+    'smoking': ('smokers', 13.2),
+    'overweight_or_obesity': ('overweight or obese pts', 64.0),
+    'obesity': ('obese pts', 26.0),
+}
+
+
+def area_columns_in(service_df):
+    """
+    Return the area (yes/no coverage) columns of a service coverage file.
+    """
+    return [col for col in service_df.columns[FIRST_AREA_COLUMN_INDEX:] if col not in SERVICE_INFO_COLUMNS]
+
+
+def is_long_format(service_df):
+    """
+    True for a long format coverage file (one row per service and area, or LSOA, covered).
+    """
+    return LONG_FORMAT_AREA_COLUMN in service_df.columns or is_lsoa_catchment(service_df)
+
+
+def is_lsoa_catchment(service_df):
+    """
+    True for a long format coverage file of LSOA catchments.
+    """
+    return LSOA_CATCHMENT_COLUMN in service_df.columns
+
+#----------------------------------------------
+
+def coverage_matrix(service_df, area_columns):
+    """
+    Convert the yes/no area columns into a sparse boolean matrix (services x areas).
+    """
+    return sparse.csr_array((service_df[area_columns] == 'yes').to_numpy())
+
+
+def long_format_coverage(service_df):
+    """
+    Services and their coverage from a long format coverage file, where each row
+    is one area (or LSOA) covered by a service (the service information repeated on each).
+
+    Returns:
+    tuple: (DataFrame of the first row of each service, in the order they first
+    appear, without the area and share columns; sparse matrix (services x areas),
+    boolean, or float shares if the file has a CATCHMENT_SHARE_COLUMN; list of the area names)
+    """
+    area_column = LSOA_CATCHMENT_COLUMN if is_lsoa_catchment(service_df) else LONG_FORMAT_AREA_COLUMN
+    service_codes, service_names = pd.factorize(service_df['Service name'])
+    area_codes, area_names = pd.factorize(service_df[area_column])
+
+    #np.unique gives the first row of each service in code (first appearance) order
+    _, first_rows = np.unique(service_codes[service_codes >= 0], return_index=True)
+    first_rows = np.flatnonzero(service_codes >= 0)[first_rows]
+    services_df = service_df.iloc[first_rows].drop(columns=[area_column, CATCHMENT_SHARE_COLUMN], errors='ignore')
+
+    #rows with no area give a service that covers nothing
+    covered = (service_codes >= 0) & (area_codes >= 0)
+    if CATCHMENT_SHARE_COLUMN in service_df.columns:
+        #a missing share is the whole area, the shares of an area listed twice for a service are added
+        shares = service_df[CATCHMENT_SHARE_COLUMN].to_numpy(dtype=np.float64, na_value=1.0)[covered]
+    else:
+        #an area listed twice is covered once
+        shares = np.ones(covered.sum(), dtype=bool)
+    coverage = sparse.csr_array(
+        (shares, (service_codes[covered], area_codes[covered])),
+        shape=(len(service_names), len(area_names)))
+    coverage.sum_duplicates()
+    return services_df, coverage, list(area_names)
+
+
+def service_coverage(service_df):
+    """
+    Services, coverage matrix and area names of a wide (yes/no columns) or long
+    format coverage file.
+
+    Returns:
+    tuple: (DataFrame of one row per service, sparse matrix (services x areas, or LSOAs),
+    list of the area names (or LSOA codes))
+    """
+    if is_long_format(service_df):
+        return long_format_coverage(service_df)
+    area_columns = area_columns_in(service_df)
+    return service_df, coverage_matrix(service_df, area_columns), area_columns
+
+#----------------------------------------------
+
+def age_band_positions(ages, min_ages, max_ages):
+    """
+    Positions in prefix sums over the single years of age in ages of the start and end
+    of each age band (inclusive ages). Raises KeyError for ages outside of ages.
+    """
+    min_ages = np.asarray(min_ages, dtype=np.int64)
+    max_ages = np.asarray(max_ages, dtype=np.int64)
+    age_start = int(ages[0])
+    low = min_ages - age_start
+    high = max_ages - age_start + 1
+    out_of_range = (low < 0) | (high > len(ages))
+    if out_of_range.any():
+        bad_age = min_ages[out_of_range][0] if low[out_of_range][0] < 0 else max_ages[out_of_range][0]
+        raise KeyError(str(bad_age))
+    return low, high
+
+
+def gender_positions(genders, gender_position):
+    """
+    Position of each service's gender, looking each distinct gender up once with
+    gender_position (which returns None for unknown genders, given as -1).
+    """
+    gender_codes, gender_labels = pd.factorize(pd.Series(genders, dtype=object))
+    label_positions = np.array([-1 if gender_position(g) is None else gender_position(g) for g in gender_labels], dtype=np.int64)
+    return np.append(label_positions, -1)[gender_codes]
+
+
+def covered_band_totals(coverage, prefix, low, high):
+    """
+    Population in each service's age band summed over the areas it covers: the rows of
+    coverage (services x areas) multiplied into prefix (cumulative population over age
+    [area, age], with a leading zero), then the difference of the columns at high and low.
+    Only the prefix columns that start or end some band are multiplied.
+    """
+    boundaries, boundary_positions = np.unique(np.concatenate([low, high]), return_inverse=True)
+    sums = coverage @ prefix[:, boundaries]
+    rows = np.arange(len(low))
+    return sums[rows, boundary_positions[len(low):]] - sums[rows, boundary_positions[:len(low)]]
+
+
+def service_population_trajectory(cube, coverage, area_names, genders, min_ages, max_ages, years):
+    """
+    Total population covered by each service in each year: the population in the
+    service's age band and gender, summed over the areas it covers.
+
+    The coverage is multiplied into the prefix sums of the cube (sparse [service, area]
+    x [area, age] for each gender and year), giving the cumulative over age population
+    of every service's areas at once, and each band is the difference of two of those.
+
+    Parameters:
+    cube (ProjectionCube): Population projections.
+    coverage (sparse matrix or ndarray): Boolean coverage, or float shares served (services x areas).
+    area_names (list): Names of the areas (columns of coverage).
+    genders (array-like): Gender seen by each service.
+    min_ages, max_ages (array-like): Age band (inclusive) of each service.
+    years (list): Projection years.
+
+    Returns:
+    ndarray: Populations shaped [year, service] (int64, or float64 for shares).
+    Areas, genders or years that are not in the projections contribute zero.
+    """
+    low, high = age_band_positions(cube.ages, min_ages, max_ages)
+    n_services = len(low)
+
+    #coverage of the cube's locations, dropping areas not in the projections
+    area_positions = cube.location_positions(area_names)
+    known = np.flatnonzero(area_positions >= 0)
+    to_locations = sparse.csr_array(
+        (np.ones(len(known), dtype=np.int64), (known, area_positions[known])),
+        shape=(len(area_names), len(cube.locations)))
+    coverage = sparse.csr_array(coverage)
+    location_coverage = (coverage.astype(np.int64) if coverage.dtype == bool else coverage) @ to_locations
+
+    service_genders = gender_positions(genders, cube.gender_position)
+    populations = np.zeros((len(years), n_services), dtype=location_coverage.dtype)
+    for i, year in enumerate(years):
+        y = cube.year_position(year)
+        if y is None:
+            continue
+        for g in np.unique(service_genders[service_genders >= 0]):
+            services = np.flatnonzero(service_genders == g)
+            prefix = cube.prefix[:, g, y, :] * cube.present[:, g, y, None]
+            populations[i, services] = covered_band_totals(location_coverage[services], prefix, low[services], high[services])
+    return populations
+
+
+def service_populations(cube, coverage, area_names, genders, min_ages, max_ages, year):
+    """
+    Total population covered by each service in one year (see service_population_trajectory).
+    """
+    return service_population_trajectory(cube, coverage, area_names, genders, min_ages, max_ages, [year])[0]
+
+
+def demand_forecast(service_df, baseline_population, forecast_population):
+    """
+    Population change and the demand, cost and workforce forecasts that follow from it.
+
+    Parameters:
+    service_df (DataFrame): Service coverage file.
+    baseline_population (ndarray): Baseline population of each service [service].
+    forecast_population (ndarray): Forecast population of each service, either [service]
+        or [year, service] for several forecast years at once.
+
+    Returns:
+    dict: Column name -> ndarray (shaped like forecast_population), in output order.
+    """
+    # Calculate net change and percent change (0 where there is no baseline population)
+    net_change = forecast_population - baseline_population
+    with np.errstate(divide='ignore', invalid='ignore'):
+        percent_change = np.where(baseline_population != 0, net_change / baseline_population * 100, 0.0)
+
+    # Calculate the forecasted demand by applying the percentage change to the attendances
+    attendances = service_df['attendances in 12 months'].to_numpy()
+    forecasted_demand = np.round(attendances * (1 + (percent_change / 100)), 0)
+    net_change_forecast_demand = forecasted_demand - attendances
+    cost_demand_change = (net_change_forecast_demand * service_df['average cost per appt'].to_numpy()) / 1000
+
+    # Calculate the average number of attendances per wte
+    attends_per_wte = np.broadcast_to(attendances / service_df['clinical_wte'].to_numpy(), np.shape(forecast_population))
+
+    return {
+        'Baseline Population': np.broadcast_to(baseline_population, np.shape(forecast_population)),
+        'Forecast Population': forecast_population,
+        'Net Pop Change': net_change,
+        '% Pop Change': percent_change,
+        'Forecasted Demand': forecasted_demand,
+        'Net Est Demand Change': net_change_forecast_demand,
+        'Net Cost Demand Change (£1000s)': cost_demand_change,
+        'attendances per wte': attends_per_wte,
+    }
+
+#----------------------------------------------
+
+def service_file_populations(service_df, pop_df, years, lsoa_cube=None):
+    """
+    Population covered by each service of a coverage file in each year.
+
+    Parameters:
+    service_df (DataFrame): Service coverage file (wide or long format).
+    pop_df (CompactProjections or DataFrame): Population projections for the areas.
+    years (list): Projection years.
+    lsoa_cube (LsoaAgeCube): LSOA baselines, needed for LSOA catchments (see lsoa_catchments.py).
+
+    Returns:
+    tuple: (DataFrame of one row per service, populations shaped [year, service])
+    """
+    # All columns after the service information are areas (or, in long format, each row is an area covered)
+    lsoa_catchments = is_lsoa_catchment(service_df)
+    service_df, coverage, area_names = service_coverage(service_df)
+
+    cube = forecast_engine.projection_cube_for(pop_df)
+    genders = service_df['gender seen'].to_numpy()
+    min_ages = service_df['min age seen'].to_numpy()
+    max_ages = service_df['max age seen'].to_numpy()
+
+    if lsoa_catchments:
+        if lsoa_cube is None:
+            raise ValueError('the LSOA baselines (lsoa_cube) are needed for a file of LSOA catchments')
+        return service_df, lsoa_cube.service_population_trajectory(cube, coverage, area_names, genders, min_ages, max_ages, years)
+    return service_df, service_population_trajectory(cube, coverage, area_names, genders, min_ages, max_ages, years)
+
+
+def calculate_population_changes(service_df, pop_df, baseline_year, forecast_year, lsoa_cube=None):
+    """
+    Add population and demand forecasts to each service in a coverage file.
+
+    Parameters:
+    service_df (DataFrame): Service coverage, with the columns in SERVICE_INFO_COLUMNS
+        followed by one 'yes'/'no' column per area, or in long format (see long_format_coverage).
+    pop_df (CompactProjections or DataFrame): Population projections for the areas.
+    baseline_year (int): Baseline year.
+    forecast_year (int): Forecast year.
+    lsoa_cube (LsoaAgeCube): LSOA baselines, needed for LSOA catchments (see lsoa_catchments.py).
+
+    Returns:
+    tuple: (service_df (one row per service for a long format file) with the forecast
+    columns added, shortened DataFrame of the service name and the last 5 forecast columns)
+    """
+    # Baseline and forecast year in one pass, shaped [year, service]
+    service_df, populations = service_file_populations(service_df, pop_df, [baseline_year, forecast_year], lsoa_cube)
+    return population_change_tables(service_df, populations[0], populations[1])
+
+
+def population_change_tables(service_df, baseline_population, forecast_population):
+    """
+    The tables calculate_population_changes returns, from the baseline and forecast
+    population of each service (e.g. one year of a service_file_populations trajectory).
+
+    Parameters:
+    service_df (DataFrame): One row per service (the forecast columns are added to it).
+    baseline_population, forecast_population (ndarray): Population of each service [service].
+
+    Returns:
+    tuple: (service_df with the forecast columns added, shortened DataFrame of the
+    service name and the last 5 forecast columns)
+    """
+    # Update the service dataframe with the calculated populations and demand forecast
+    for column, values in demand_forecast(service_df, baseline_population, forecast_population).items():
+        service_df[column] = values
+
+    # Now create a new dataframe with only the required columns
+    columns_to_keep = [service_df.columns[0]] + service_df.columns[-5:].tolist()
+    shortened_service_df = service_df[columns_to_keep]
+
+    return service_df, shortened_service_df
+
+
+def stream_service_trajectory(service_chunks, pop_df, years, lsoa_cube=None):
+    """
+    service_file_populations for a service coverage file read in chunks of rows
+    (e.g. pd.read_csv(..., chunksize=SERVICE_CHUNK_ROWS)), for files too large to hold
+    whole. Each service is forecast from its own rows, so the results are the same as
+    for the whole file, and only one chunk is in memory at a time.
+    The rows of each service in a long format file must be consecutive, see whole_service_chunks.
+
+    Parameters:
+    service_chunks (iterable): DataFrames of consecutive rows of a service coverage file.
+    pop_df (CompactProjections or DataFrame): Population projections for the areas.
+    years (list): Projection years.
+    lsoa_cube (LsoaAgeCube): LSOA baselines, needed for LSOA catchments (see lsoa_catchments.py).
+
+    Yields:
+    tuple: (DataFrame of one row per service, populations shaped [year, service]) for each chunk.
+    """
+    for service_df in whole_service_chunks(service_chunks):
+        yield service_file_populations(service_df, pop_df, years, lsoa_cube)
+
+
+def whole_service_chunks(service_chunks):
+    """
+    Chunks of a long format coverage file regrouped so that no service is split between
+    two of them, by holding back the rows of the last service of each chunk until the next.
+    The rows of each service must be consecutive. Wide format chunks are passed on as they are.
+    """
+    carried = None
+    for service_df in service_chunks:
+        if not is_long_format(service_df):
+            yield service_df
+            continue
+        if carried is not None:
+            service_df = pd.concat([carried, service_df])
+        names = service_df['Service name'].to_numpy()
+        other_services = np.flatnonzero(names != names[-1])
+        split = other_services[-1] + 1 if len(other_services) else 0
+        carried = service_df.iloc[split:]
+        if split:
+            yield service_df.iloc[:split]
+    if carried is not None and len(carried):
+        yield carried
+
+
+def add_risk_factor_columns(shortened_service_df, prevalences):
+    """
+    Estimate the number of people with each modifiable risk factor in the
+    current and forecast demand of each service.
+
+    Parameters:
+    shortened_service_df (DataFrame): Shortened output of calculate_population_changes.
+    prevalences (dict): Prevalence (%) for each key of RISK_FACTORS.
+
+    Returns:
+    DataFrame: shortened_service_df with a 'Current est ...' and a 'Forecast est ...'
+    column added for each risk factor.
+    """
+    current_demand = shortened_service_df['Forecasted Demand'] - shortened_service_df['Net Est Demand Change']
+    for risk_factor, (description, _) in RISK_FACTORS.items():
+        shortened_service_df[f'Current est {description}'] = round(current_demand * (prevalences[risk_factor] / 100), 0)
+    for risk_factor, (description, _) in RISK_FACTORS.items():
+        shortened_service_df[f'Forecast est {description}'] = round(shortened_service_df['Forecasted Demand'] * (prevalences[risk_factor] / 100), 0)
+    return shortened_service_df
@@ -0,0 +1,177 @@
+import io
+import os
+import shutil
+import tempfile
+import time
+import weakref
+
+import pandas as pd
+
+from pages.page_functions import service_demand
+
+#--------------------------------------------------------------
+# Files holding the forecasts of large service coverage uploads.
+#
+# A large upload is forecast a chunk of rows at a time (see
+# service_demand.stream_service_trajectory): the information and the
+# population of each service in every year from the baseline are appended
+# to a csv file rather than held in memory. The tables for a forecast year
+# are then read back from it, a chunk at a time when they are downloaded.
+#
+# Each forecast has a directory of its own under SERVICE_FORECAST_DIR,
+# removed when its ServiceForecastFiles is garbage collected (the session
+# holding it ends, or replaces it with a new forecast) or the process
+# exits. Directories left behind anyway (e.g. by a server that was killed)
+# are removed whenever a new forecast is started, once they are older than
+# MAX_AGE_HOURS, or the oldest first while together they are over MAX_MB.
+#--------------------------------------------------------------
+
+SERVICE_FORECAST_DIR = os.path.join(tempfile.gettempdir(), 'service_forecasts')
+MAX_AGE_HOURS = 24
+MAX_MB = 2048
+
+#rows of the trajectory file read at a time when a table is downloaded
+DOWNLOAD_CHUNK_ROWS = 20000
+
+#----------------------------------------------
+
+def population_column(year):
+    return f'Population {year}'
+
+
+def directory_size(directory):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(directory) for name in names)
+
+
+def remove_old_forecasts(parent=SERVICE_FORECAST_DIR, max_age_hours=MAX_AGE_HOURS, max_mb=MAX_MB):
+    """
+    Remove the forecast directories under parent older than max_age_hours, then the
+    oldest of the rest while together they take more than max_mb.
+
+    Returns:
+    int: The number of directories removed.
+    """
+    if not os.path.isdir(parent):
+        return 0
+    directories = []
+    for name in os.listdir(parent):
+        path = os.path.join(parent, name)
+        try:
+            directories.append((os.path.getmtime(path), directory_size(path), path))
+        except FileNotFoundError:
+            #removed by another session while listing
+            continue
+    directories.sort()
+
+    removed = 0
+    total_bytes = sum(size for _, size, _ in directories)
+    for modified, size, path in directories:
+        if time.time() - modified <= max_age_hours * 3600 and total_bytes <= max_mb * 2**20:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total_bytes -= size
+        removed += 1
+    return removed
+
+#----------------------------------------------
+
+class ServiceForecastFiles:
+    """
+    The trajectory file of one forecast of a service coverage file.
+
+    Attributes:
+    key: What the forecast is of (e.g. the upload and baseline year), for callers reusing it.
+    years (list): Years of the population columns, the baseline year first.
+    directory (str): Directory of the files, removed along with this object.
+    trajectory_path (str): csv with one row per service: its SERVICE_INFO_COLUMNS and
+        a population_column for each year.
+    n_services (int): Services written to the trajectory file.
+    """
+    def __init__(self, key, years, parent=SERVICE_FORECAST_DIR):
+        self.key = key
+        self.years = list(years)
+        os.makedirs(parent, exist_ok=True)
+        self.directory = tempfile.mkdtemp(prefix='service_forecast_', dir=parent)
+        self.trajectory_path = os.path.join(self.directory, 'trajectory.csv')
+        self.n_services = 0
+        self._finalizer = weakref.finalize(self, shutil.rmtree, self.directory, ignore_errors=True)
+
+    def remove(self):
+        self._finalizer()
+
+    def exists(self):
+        # False once the files have been removed (e.g. by remove_old_forecasts in another session)
+        return os.path.exists(self.trajectory_path)
+
+    def write_trajectory(self, service_chunks, pop_df, lsoa_cube=None):
+        """
+        Forecast every year for a service coverage file read in chunks of rows, appending
+        each chunk's services to the trajectory file as soon as it is done.
+
+        Yields:
+        int: The number of services written so far, after each chunk.
+        """
+        for services_df, populations in service_demand.stream_service_trajectory(service_chunks, pop_df, self.years, lsoa_cube):
+            trajectory_df = services_df[[column for column in service_demand.SERVICE_INFO_COLUMNS if column in services_df.columns]].copy()
+            for i, year in enumerate(self.years):
+                trajectory_df[population_column(year)] = populations[i]
+            trajectory_df.to_csv(self.trajectory_path, mode='w' if self.n_services == 0 else 'a', header=self.n_services == 0, index=False)
+            self.n_services += len(trajectory_df)
+            yield self.n_services
+
+    #----------------------------------------------
+
+    def read_trajectory(self, forecast_year, **read_csv_args):
+        # The service information with the baseline and forecast year populations (read exactly, as written)
+        columns = [population_column(self.years[0]), population_column(forecast_year)]
+        return pd.read_csv(
+            self.trajectory_path,
+            usecols=lambda column: not column.startswith('Population ') or column in columns,
+            float_precision='round_trip',
+            **read_csv_args)
+
+    def population_changes(self, trajectory_df, forecast_year, service_df=None):
+        # population_change_tables for rows of the trajectory file (on service_df, the same services, if given)
+        baseline_population = trajectory_df[population_column(self.years[0])].to_numpy()
+        forecast_population = trajectory_df[population_column(forecast_year)].to_numpy()
+        if service_df is None:
+            service_df = trajectory_df.drop(columns=[population_column(year) for year in set([self.years[0], forecast_year])])
+        return service_demand.population_change_tables(service_df, baseline_population, forecast_population)
+
+    def changes_for_year(self, forecast_year, nrows=None):
+        """
+        The tables calculate_population_changes returns (with the service information
+        columns only), for the first nrows services (default all of them).
+        """
+        return self.population_changes(self.read_trajectory(forecast_year, nrows=nrows), forecast_year)
+
+    def full_table_csv(self, service_chunks, forecast_year):
+        """
+        The full table for forecast_year (the rows of the coverage file, one per service,
+        with the forecast columns added) as csv bytes, built a chunk at a time.
+
+        Parameters:
+        service_chunks (iterable): DataFrames of consecutive rows of the same coverage file
+            (e.g. pd.read_csv(..., chunksize=service_demand.SERVICE_CHUNK_ROWS)).
+        forecast_year (int): Forecast year.
+        """
+        output = io.BytesIO()
+        trajectory_rows = self.read_trajectory(forecast_year, iterator=True)
+        for i, service_df in enumerate(service_demand.whole_service_chunks(service_chunks)):
+            #the chunks give the services in the order they were forecast in
+            services_df = service_demand.service_coverage(service_df)[0]
+            full_df, _ = self.population_changes(trajectory_rows.get_chunk(len(services_df)), forecast_year, services_df)
+            full_df.to_csv(output, header=i == 0, index=False)
+        trajectory_rows.close()
+        return output.getvalue()
+
+    def shortened_table_csv(self, forecast_year, prevalences):
+        """
+        The shortened table for forecast_year, with the modifiable risk factor columns
+        (see service_demand.add_risk_factor_columns), as csv bytes built a chunk at a time.
+        """
+        output = io.BytesIO()
+        for i, trajectory_df in enumerate(self.read_trajectory(forecast_year, chunksize=DOWNLOAD_CHUNK_ROWS)):
+            _, shortened_df = self.population_changes(trajectory_df, forecast_year)
+            service_demand.add_risk_factor_columns(shortened_df.copy(), prevalences).to_csv(output, header=i == 0, index=False)
+        return output.getvalue()
@@ -0,0 +1,81 @@
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from pages.page_functions import forecast_engine
+
+#--------------------------------------------------------------
+# Population projections shared between processes.
+#
+# The worker processes of the batch runner all read the same projections.
+# Rather than each one reloading the store or being sent a pickled copy,
+# the parent copies the arrays of the projection cube (counts, prefix sums
+# and present flags) into shared memory once and gives the workers a small
+# handle (the block names, shapes and dtypes, and the area / gender / year
+# labels). Each worker builds a ProjectionCube over the shared blocks
+# without copying them.
+#
+# No streamlit in here so it can be used by the pages and the command line.
+#--------------------------------------------------------------
+
+CUBE_ARRAYS = ('counts', 'prefix', 'present')
+
+#----------------------------------------------
+
+@contextmanager
+def shared_projection_cube(cube):
+    """
+    Copy the arrays of a ProjectionCube into shared memory for as long as the block runs.
+
+    Yields:
+    dict: Picklable handle for attach_projection_cube. The shared memory is freed
+    when the block ends, so the workers using it must have finished by then.
+    """
+    blocks = []
+    handle = {
+        'locations': list(cube.locations),
+        'genders': list(cube.genders),
+        'years': list(cube.years),
+        'ages': cube.ages.tolist(),
+        'arrays': {},
+    }
+    try:
+        for name in CUBE_ARRAYS:
+            array = getattr(cube, name)
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            blocks.append(block)
+            np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+            handle['arrays'][name] = (block.name, array.shape, array.dtype.str)
+        yield handle
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+
+def attach_projection_cube(handle):
+    """
+    ProjectionCube over the shared memory of a handle from shared_projection_cube (read only).
+
+    Returns:
+    tuple: (cube, blocks), keep blocks referenced for as long as the cube is used.
+    """
+    blocks = []
+    arrays = {}
+    for name, (block_name, shape, dtype) in handle['arrays'].items():
+        block = shared_memory.SharedMemory(name=block_name)
+        blocks.append(block)
+        arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+        arrays[name].flags.writeable = False
+
+    cube = forecast_engine.ProjectionCube(
+        locations=handle['locations'],
+        genders=handle['genders'],
+        years=handle['years'],
+        ages=np.array(handle['ages'], dtype=np.int64),
+        counts=arrays['counts'],
+        present=arrays['present'],
+        prefix=arrays['prefix'],
+    )
+    return cube, blocks
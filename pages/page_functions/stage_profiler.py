@@ -0,0 +1,238 @@
+import contextvars
+import datetime
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+import uuid
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+#--------------------------------------------------------------
+# Profiling of one run of a page: wall time, peak memory and row counts of
+# each pipeline stage and each map render call.
+#
+# A page makes a StageProfiler the active one for its run (activate); the
+# pipeline graph, functions wrapped in @profiled and `with measure(...)`
+# blocks then record into it. With no active profiler they only look up a
+# context variable, so they cost nothing measurable when profiling is off.
+#
+# Peak memory is traced with tracemalloc (Python allocations, including the
+# numpy / pandas buffers), only while a measured call is running as tracing
+# slows everything down. tracemalloc is process wide, so with several
+# sessions profiling at once the peaks include each other's allocations.
+#--------------------------------------------------------------
+
+#a json lines file each profiled run is appended to (if set), for runs reported as slow
+PROFILE_LOG_ENV = 'STAGE_PROFILE_LOG'
+
+_active_profiler = contextvars.ContextVar('stage_profiler', default=None)
+
+#measured calls running (in any thread) that need tracemalloc, which is stopped when the last one ends
+_tracing_lock = threading.Lock()
+_tracing_calls = 0
+_started_tracing = False
+
+#----------------------------------------------
+
+def row_count(value):
+    """
+    Rows of a data frame, series or array (None for anything else, e.g. map html).
+    """
+    if isinstance(value, (pd.DataFrame, pd.Series, np.ndarray)):
+        return len(value)
+    if isinstance(value, tuple):
+        return input_rows(value)
+    return None
+
+
+def input_rows(values):
+    """
+    Total rows of the data frames, series and arrays among the inputs of a call (None if there are none).
+    """
+    counts = [row_count(value) for value in values]
+    counts = [count for count in counts if count is not None]
+    return sum(counts) if counts else None
+
+
+def start_tracing():
+    global _tracing_calls, _started_tracing
+    with _tracing_lock:
+        if _tracing_calls == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _started_tracing = True
+        _tracing_calls += 1
+
+
+def stop_tracing():
+    global _tracing_calls, _started_tracing
+    with _tracing_lock:
+        _tracing_calls -= 1
+        #tracing turned on elsewhere (e.g. PYTHONTRACEMALLOC) is left on
+        if _tracing_calls == 0 and _started_tracing:
+            tracemalloc.stop()
+            _started_tracing = False
+
+#----------------------------------------------
+
+class StageProfiler:
+    """
+    Timings of the measured calls of one page run, in the order they started.
+
+    Each record has the step name, its kind ('stage' for pipeline stages, 'render'
+    for map rendering, 'step' for other page steps), its status ('computed' or
+    'reused' for stages, 'called' otherwise), when it started and how long it took
+    (seconds from the start of the run), the peak memory it allocated above what
+    was in use when it started (MB), the rows it was given and returned, and how
+    deeply it was nested in other measured calls.
+    """
+    def __init__(self, page, trace_memory=True):
+        self.page = page
+        self.run_id = uuid.uuid4().hex[:12]
+        self.started_at = datetime.datetime.now().isoformat(timespec='seconds')
+        self.trace_memory = trace_memory
+        self.records = []
+        self.total_seconds = None
+        self.start = time.perf_counter()
+        #[record, traced memory at its start, highest peak of the calls nested in it] of each call running
+        self.open_calls = []
+
+    @contextmanager
+    def measure(self, name, kind='stage', rows_in=None):
+        """
+        Time (and trace the memory of) the block, yielding its record so the
+        block can set its 'status' and 'rows_out'.
+        """
+        record = {'step': name, 'kind': kind, 'status': 'called', 'depth': len(self.open_calls),
+                  'start': time.perf_counter() - self.start, 'seconds': None, 'peak_mb': None,
+                  'rows_in': rows_in, 'rows_out': None}
+        self.records.append(record)
+
+        if self.trace_memory:
+            start_tracing()
+            current, peak = tracemalloc.get_traced_memory()
+            #the peak so far belongs to the call this one is nested in, reset_peak below loses it
+            if self.open_calls:
+                self.open_calls[-1][2] = max(self.open_calls[-1][2], peak)
+            tracemalloc.reset_peak()
+        else:
+            current = 0
+        call = [record, current, 0]
+        self.open_calls.append(call)
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['seconds'] = time.perf_counter() - start
+            self.open_calls.pop()
+            if self.trace_memory:
+                _, peak = tracemalloc.get_traced_memory()
+                peak = max(peak, call[2])
+                record['peak_mb'] = max(peak - current, 0) / 2**20
+                if self.open_calls:
+                    self.open_calls[-1][2] = max(self.open_calls[-1][2], peak)
+                stop_tracing()
+
+    def finish(self):
+        """
+        Note the end of the run (its total time).
+        """
+        self.total_seconds = time.perf_counter() - self.start
+        return self
+
+    #----------------------------------------------
+
+    def summary(self):
+        """
+        The records as a frame, one row per measured call with its start and end (seconds from the start of the run).
+        """
+        df = pd.DataFrame(self.records, columns=['step', 'kind', 'status', 'depth', 'start', 'seconds', 'peak_mb', 'rows_in', 'rows_out'])
+        df['end'] = df['start'] + df['seconds']
+        df = df.rename(columns={
+            'step': 'Step', 'kind': 'Kind', 'status': 'Status', 'depth': 'Depth', 'start': 'Start (s)', 'end': 'End (s)',
+            'seconds': 'Seconds', 'peak_mb': 'Peak Memory (MB)', 'rows_in': 'Rows In', 'rows_out': 'Rows Out'})
+        return df[['Step', 'Kind', 'Status', 'Depth', 'Start (s)', 'End (s)', 'Seconds', 'Peak Memory (MB)', 'Rows In', 'Rows Out']]
+
+    def to_json(self, params=None):
+        """
+        The run as a json string: page, run id, start time, total seconds, the page parameters
+        (if given, as strings) and the records.
+        """
+        return json.dumps({
+            'page': self.page,
+            'run_id': self.run_id,
+            'started_at': self.started_at,
+            'total_seconds': self.total_seconds,
+            'params': {name: summarise_param(value) for name, value in (params or {}).items()},
+            'steps': self.records,
+        })
+
+    def write_log(self, params=None, path=None):
+        """
+        Append the run (to_json) to the json lines file at path (default: STAGE_PROFILE_LOG).
+
+        Returns:
+        str: The file written to, or None if no file is set.
+        """
+        path = path or os.environ.get(PROFILE_LOG_ENV)
+        if not path:
+            return None
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(self.to_json(params) + '\n')
+        return path
+
+
+def summarise_param(value):
+    #frames are logged by their size only, anything else as its repr (lists of areas can be long)
+    if isinstance(value, (pd.DataFrame, pd.Series, np.ndarray)):
+        return f'{type(value).__name__} of {len(value)} rows'
+    text = repr(value)
+    return text if len(text) <= 200 else text[:200] + '...'
+
+#----------------------------------------------
+
+def activate(profiler):
+    """
+    Make profiler the one the measured calls of this run record into (None turns profiling off).
+    Pages call this at the start of every run, so a profiler is never left on from an earlier run.
+    """
+    _active_profiler.set(profiler)
+
+
+def active_profiler():
+    return _active_profiler.get()
+
+
+@contextmanager
+def measure(name, kind='step', rows_in=None):
+    """
+    StageProfiler.measure on the active profiler, or a throwaway record if there is none.
+    """
+    profiler = _active_profiler.get()
+    if profiler is None:
+        yield {}
+        return
+    with profiler.measure(name, kind, rows_in) as record:
+        yield record
+
+
+def profiled(kind='render'):
+    """
+    Decorator measuring each call of a function (under its name) when a profiler is active.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            profiler = _active_profiler.get()
+            if profiler is None:
+                return function(*args, **kwargs)
+            with profiler.measure(function.__name__, kind, input_rows(list(args) + list(kwargs.values()))) as record:
+                result = function(*args, **kwargs)
+                record['rows_out'] = row_count(result)
+            return result
+        return wrapper
+    return decorator
@@ -0,0 +1,246 @@
+import numpy as np
+import pandas as pd
+
+from pages.page_functions import forecast_engine
+from pages.page_functions import service_demand
+
+#--------------------------------------------------------------
+# Population change trajectories: the change from the baseline year to
+# every later projection year, worked out in one pass.
+#
+# The pages pick a single forecast year, but analysts step through 10-20
+# years. Rather than re-running the pipeline for each year, the projection
+# cube is indexed with every year at once (an extra axis on the same prefix
+# sum lookups), and the pages slice the year they need out of the result.
+#
+# No streamlit in here so it can be used by the pages and the command line.
+#--------------------------------------------------------------
+
+def trajectory_years(pop_df, baseline_year, last_year=None):
+    """
+    Projection years from baseline_year (inclusive) to last_year (default: the last projection year).
+    """
+    cube = forecast_engine.projection_cube_for(pop_df)
+    return [year for year in cube.years if year >= baseline_year and (last_year is None or year <= last_year)]
+
+#----------------------------------------------
+
+def band_trajectory(pop_df, local_authorities, min_age, max_age, baseline_year, years, gender):
+    """
+    Total population aged min_age to max_age for each local authority and year,
+    with the net and % change from the baseline year.
+
+    Parameters:
+    pop_df (CompactProjections or DataFrame): Population projections.
+    local_authorities (list): Local authorities to include.
+    min_age, max_age (int): Age band (inclusive).
+    baseline_year (int): Baseline year.
+    years (list): Forecast years.
+    gender (str): 'Persons', 'Males' or 'Females' (or 'Male'/'Female').
+
+    Returns:
+    DataFrame: One row per year and local authority (sorted by name), with 'Year', 'Location',
+    'Baseline Year Total', 'Forecast Year Total', 'Net Change' and '% Change' columns.
+    As with forecast_population, a local authority with data in only one of the two
+    years is kept with a missing total and change.
+    """
+    columns = ['Year', 'Location', 'Baseline Year Total', 'Forecast Year Total', 'Net Change', '% Change']
+    cube = forecast_engine.projection_cube_for(pop_df)
+    low = cube.age_position(min_age)
+    high = cube.age_position(max_age) + 1
+
+    g = cube.gender_position(gender)
+    b = cube.year_position(baseline_year)
+    year_positions = [cube.year_position(year) for year in years]
+    years = [year for year, y in zip(years, year_positions) if y is not None]
+    year_positions = np.array([y for y in year_positions if y is not None], dtype=np.int64)
+    if g is None or b is None or len(years) == 0:
+        return pd.DataFrame(columns=columns)
+
+    names = sorted({location for location in local_authorities if location in cube.location_index})
+    positions = cube.location_positions(names)
+
+    # Age band totals [year, location] from the prefix sums, and the baseline [location]
+    forecast_total = (cube.prefix[positions[None, :], g, year_positions[:, None], high]
+                      - cube.prefix[positions[None, :], g, year_positions[:, None], low])
+    baseline_total = cube.prefix[positions, g, b, high] - cube.prefix[positions, g, b, low]
+    forecast_present = cube.present[positions[None, :], g, year_positions[:, None]]
+    baseline_present = np.broadcast_to(cube.present[positions, g, b], forecast_present.shape)
+    baseline_total = np.broadcast_to(baseline_total, forecast_total.shape)
+
+    keep = baseline_present | forecast_present
+    if (keep & ~(baseline_present & forecast_present)).any():
+        forecast_total = np.where(forecast_present, forecast_total, np.nan)
+        baseline_total = np.where(baseline_present, baseline_total, np.nan)
+
+    net_change = forecast_total - baseline_total
+    with np.errstate(divide='ignore', invalid='ignore'):
+        percent_change = (net_change / baseline_total) * 100
+
+    return pd.DataFrame({
+        'Year': np.repeat(np.array(years, dtype=np.int64), len(names))[keep.ravel()],
+        'Location': np.tile(np.array(names, dtype=object), len(years))[keep.ravel()],
+        'Baseline Year Total': baseline_total[keep],
+        'Forecast Year Total': forecast_total[keep],
+        'Net Change': net_change[keep],
+        '% Change': percent_change[keep],
+    }, columns=columns)
+
+
+def age_trajectory(pop_df, local_authorities, min_age, max_age, baseline_year, years, gender):
+    """
+    Population by single year of age of each local authority in each year, with the
+    net and % change from the baseline year (forecast_population_by_age for every year at once).
+
+    Parameters:
+    pop_df (CompactProjections or DataFrame): Population projections.
+    local_authorities (list): Local authorities to include.
+    min_age, max_age (int): Age band (inclusive).
+    baseline_year (int): Baseline year.
+    years (list): Forecast years.
+    gender (str): 'Persons', 'Males' or 'Females' (or 'Male'/'Female').
+
+    Returns:
+    DataFrame: One row per year, age and local authority (ordered by year, then age, then
+    local authority in the order given), with 'Year', 'Location', 'Age', 'Baseline Population',
+    'Forecast Population', 'Net Change' and '% Change' columns, following the same rules as
+    forecast_population_by_age.
+    """
+    cube = forecast_engine.projection_cube_for(pop_df)
+    local_authorities = list(local_authorities)
+    ages = np.arange(int(min_age), int(max_age) + 1, dtype=np.int64)
+    low = cube.age_position(min_age)
+    high = cube.age_position(max_age) + 1
+
+    g = cube.gender_position(gender)
+    positions = cube.location_positions(local_authorities)
+    p = np.maximum(positions, 0)
+
+    def counts_for(year_positions):
+        # Population [year, location, age] and whether each location has data [year, location]
+        y = np.maximum(year_positions, 0)
+        if g is None:
+            return (np.zeros((len(y), len(p), len(ages)), dtype=np.int64), np.zeros((len(y), len(p)), dtype=bool))
+        present = (positions >= 0)[None, :] & (year_positions >= 0)[:, None] & cube.present[p[None, :], g, y[:, None]]
+        return np.where(present[..., None], cube.counts[p[None, :], g, y[:, None], low:high], 0), present
+
+    b = cube.year_position(baseline_year)
+    baseline_pop, baseline_present = counts_for(np.array([-1 if b is None else b], dtype=np.int64))
+    forecast_pop, forecast_present = counts_for(np.array([-1 if cube.year_position(year) is None else cube.year_position(year) for year in years], dtype=np.int64))
+
+    # (a location only in one of the two years has no net change, as in forecast_population_by_age)
+    both_present = (baseline_present & forecast_present)[..., None]
+    either_present = (baseline_present | forecast_present)[..., None]
+    net_change = np.where(both_present, forecast_pop - baseline_pop, 0)
+    if (either_present & ~both_present).any():
+        net_change = np.where(either_present & ~both_present, np.nan, net_change)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        percent_change = np.where(both_present, net_change / baseline_pop * 100, 0.0)
+    percent_change = np.nan_to_num(percent_change, nan=0.0, posinf=np.inf, neginf=-np.inf)
+
+    # [year, location, age] -> rows ordered by year, age, then location
+    def rows(values):
+        return np.broadcast_to(values, forecast_pop.shape).transpose(0, 2, 1).ravel()
+
+    return pd.DataFrame({
+        'Year': np.repeat(np.array(years, dtype=np.int64), len(ages) * len(local_authorities)),
+        'Location': np.tile(np.array(local_authorities, dtype=object), len(years) * len(ages)),
+        'Age': np.tile(np.repeat(ages, len(local_authorities)), len(years)),
+        'Baseline Population': rows(baseline_pop),
+        'Forecast Population': rows(forecast_pop),
+        'Net Change': rows(net_change),
+        '% Change': rows(percent_change),
+    })
+
+
+def age_change_trajectory(pop_df, local_authorities, min_age, max_age, baseline_year, years, gender):
+    """
+    % change from the baseline year for each single year of age, local authority and year.
+
+    Uses the same rules as forecast_population_by_age: the change is 0 where a local
+    authority is missing from either year or the baseline population is 0 and unchanged.
+
+    Returns:
+    tuple: (locations, percent_change) where locations is an Index of the local
+    authorities (duplicates dropped, in the order given) and percent_change is a
+    float array shaped [year, location, age].
+    """
+    cube = forecast_engine.projection_cube_for(pop_df)
+    locations = pd.Index(pd.unique(pd.Series(list(local_authorities), dtype=object)))
+    low = cube.age_position(min_age)
+    high = cube.age_position(max_age) + 1
+
+    percent_change = np.zeros((len(years), len(locations), high - low), dtype=np.float64)
+    g = cube.gender_position(gender)
+    b = cube.year_position(baseline_year)
+    if g is None or b is None:
+        return locations, percent_change
+
+    positions = cube.location_positions(locations)
+    known = positions >= 0
+    p = np.maximum(positions, 0)
+    baseline_pop = cube.counts[p, g, b, low:high]
+    baseline_present = known & cube.present[p, g, b]
+
+    for i, year in enumerate(years):
+        y = cube.year_position(year)
+        if y is None:
+            continue
+        both_present = baseline_present & cube.present[p, g, y]
+        net_change = cube.counts[p, g, y, low:high] - baseline_pop
+        with np.errstate(divide='ignore', invalid='ignore'):
+            year_change = np.where(both_present[:, None], net_change / baseline_pop * 100, 0.0)
+        percent_change[i] = np.nan_to_num(year_change, nan=0.0, posinf=np.inf, neginf=-np.inf)
+
+    return locations, percent_change
+
+
+def lsoa_forecast_trajectory(lsoa_age_values, lsoa_locations, locations, percent_change):
+    """
+    Forecast population of each LSOA in each year, apportioning the % change by
+    single year of age of its local authority (as apply_percent_changes_iteratively does
+    for a single year).
+
+    Parameters:
+    lsoa_age_values (ndarray): Baseline population [LSOA, age].
+    lsoa_locations (array-like): Local authority of each LSOA.
+    locations (Index): Local authorities of percent_change.
+    percent_change (ndarray): % change [year, location, age] (from age_change_trajectory).
+
+    Returns:
+    ndarray: Forecast population [LSOA, year].
+    """
+    lsoa_age_values = np.asarray(lsoa_age_values, dtype=np.float64)
+    factors = 1 + percent_change / 100
+    codes = locations.get_indexer(lsoa_locations)
+
+    # LSOAs outside the locations keep their baseline population in every year
+    forecast = np.repeat(lsoa_age_values.sum(axis=1)[:, None], factors.shape[0], axis=1)
+    for code in np.unique(codes[codes >= 0]):
+        rows = np.flatnonzero(codes == code)
+        #[LSOA, age] x [age, year] for every LSOA in the location at once
+        forecast[rows] = lsoa_age_values[rows] @ factors[:, code, :].T
+    return forecast
+
+
+def service_change_trajectory(service_df, pop_df, baseline_year, years, lsoa_cube=None):
+    """
+    Population change and demand forecast for every service and year (the columns
+    calculate_population_changes adds for a single forecast year). lsoa_cube is
+    needed for LSOA catchments (see lsoa_catchments.py).
+
+    Returns:
+    DataFrame: One row per year and service, with 'Year', 'Service name' and the forecast columns.
+    """
+    # Baseline and every forecast year in one lookup, shaped [year, service]
+    service_df, populations = service_demand.service_file_populations(
+        service_df, pop_df, [baseline_year] + list(years), lsoa_cube)
+    forecast = service_demand.demand_forecast(service_df, populations[0], populations[1:])
+
+    trajectory_df = pd.DataFrame({
+        'Year': np.repeat(np.array(years, dtype=np.int64), len(service_df)),
+        'Service name': np.tile(service_df['Service name'].to_numpy(), len(years)),
+    })
+    for column, values in forecast.items():
+        trajectory_df[column] = np.asarray(values).ravel()
+    return trajectory_df
@@ -0,0 +1,195 @@
+import os
+import shutil
+
+import numpy as np
+import shapely
+
+from pages.page_functions import reference_store as ref_store
+from pages.page_functions import geometry_store
+
+#mapbox_vector_tile is optional, it is only needed to build the tiles (not to draw them)
+try:
+    import mapbox_vector_tile
+except ImportError:
+    mapbox_vector_tile = None
+
+#--------------------------------------------------------------
+# Vector tiles of the LSOA boundaries, for maps covering large areas.
+#
+# Embedding every polygon in the page (as the GeoJSON maps do) stops being
+# usable beyond a few thousand LSOAs. Instead the boundaries are cut once
+# into a pyramid of Mapbox vector tiles ({z}/{x}/{y}.pbf) under static/,
+# which Streamlit serves as plain files (enableStaticServing in
+# .streamlit/config.toml). The browser only fetches the tiles in view and
+# the values to plot are sent separately as a small LSOA code -> value
+# lookup used to style each feature.
+#--------------------------------------------------------------
+
+TILE_DIR = os.path.join(ref_store.REPO_ROOT, 'static', 'lsoa_tiles')
+
+#url the tiles are served from by streamlit static file serving
+TILE_URL = '/app/static/lsoa_tiles/{z}/{x}/{y}.pbf'
+
+#name of the layer inside each tile, and the feature property holding the LSOA code
+TILE_LAYER_NAME = 'lsoa'
+TILE_CODE_PROPERTY = geometry_store.LSOA_CODE_COLUMN
+
+#zoom levels tiles are built for, the map overzooms the deepest level beyond MAX_ZOOM
+MIN_ZOOM = 6
+MAX_ZOOM = 12
+
+#coordinate resolution inside a tile, and the margin (in the same units) kept around
+#each tile so borders are not drawn along the tile edges
+TILE_EXTENT = 4096
+TILE_BUFFER = 64
+
+#maps with more LSOAs than this are drawn from the vector tiles when they are available
+MIN_FEATURES_FOR_TILES = 5000
+
+#half the width of the web mercator world, in metres
+WEB_MERCATOR_HALF_WIDTH = 20037508.342789244
+
+#----------------------------------------------
+
+def is_buildable():
+    """
+    True if the optional mapbox_vector_tile package is installed.
+    """
+    return mapbox_vector_tile is not None
+
+
+def tile_version(shapefile_path=ref_store.LSOA_SHAPEFILE_PATH):
+    """
+    Stamp written alongside the tiles, so they are rebuilt when the shapefile, region or zoom levels change.
+    """
+    region = ref_store.region_fingerprint(ref_store.read_region())
+    return f'{os.stat(shapefile_path).st_mtime_ns}-{MIN_ZOOM}-{MAX_ZOOM}-{region}'
+
+
+def version_path():
+    return os.path.join(TILE_DIR, 'version.txt')
+
+
+def is_stale(shapefile_path=ref_store.LSOA_SHAPEFILE_PATH):
+    if not os.path.exists(version_path()):
+        return True
+    with open(version_path()) as f:
+        return f.read().strip() != tile_version(shapefile_path)
+
+
+def tiles_available():
+    """
+    True if up to date tiles have been built for the current boundary shapefile.
+    """
+    return os.path.exists(ref_store.LSOA_SHAPEFILE_PATH) and not is_stale()
+
+#----------------------------------------------
+
+def tile_size(zoom):
+    """
+    Width of a tile at the zoom level, in web mercator metres.
+    """
+    return 2 * WEB_MERCATOR_HALF_WIDTH / 2 ** zoom
+
+
+def tile_bounds(zoom, x, y):
+    """
+    (minx, miny, maxx, maxy) of an XYZ tile, in web mercator metres.
+    """
+    size = tile_size(zoom)
+    minx = -WEB_MERCATOR_HALF_WIDTH + x * size
+    maxy = WEB_MERCATOR_HALF_WIDTH - y * size
+    return (minx, maxy - size, minx + size, maxy)
+
+
+def tile_range(bounds, zoom):
+    """
+    x and y ranges of the tiles covering bounds (minx, miny, maxx, maxy) at the zoom level.
+    """
+    size = tile_size(zoom)
+    last = 2 ** zoom - 1
+    min_x = max(int((bounds[0] + WEB_MERCATOR_HALF_WIDTH) // size), 0)
+    max_x = min(int((bounds[2] + WEB_MERCATOR_HALF_WIDTH) // size), last)
+    min_y = max(int((WEB_MERCATOR_HALF_WIDTH - bounds[3]) // size), 0)
+    max_y = min(int((WEB_MERCATOR_HALF_WIDTH - bounds[1]) // size), last)
+    return range(min_x, max_x + 1), range(min_y, max_y + 1)
+
+
+def encode_tile(codes, geometries, bounds):
+    """
+    Encode the (already clipped) LSOA geometries falling in one tile.
+    """
+    features = [
+        {'geometry': geometry, 'properties': {TILE_CODE_PROPERTY: code}}
+        for code, geometry in zip(codes, geometries)]
+    return mapbox_vector_tile.encode(
+        [{'name': TILE_LAYER_NAME, 'features': features}],
+        default_options={'quantize_bounds': bounds, 'extents': TILE_EXTENT})
+
+
+def build_zoom_level(codes, geometries, zoom):
+    """
+    Write every non empty tile at one zoom level.
+
+    Parameters:
+    codes (ndarray): LSOA code of each geometry.
+    geometries (ndarray): LSOA boundaries in web mercator (EPSG 3857).
+    zoom (int): Zoom level.
+
+    Returns:
+    int: Number of tiles written.
+    """
+    #simplify to about a pixel at this zoom, keeping the edges shared between LSOAs
+    geometries = geometry_store.simplify_boundaries(geometries, tile_size(zoom) / 256)
+    tree = shapely.STRtree(geometries)
+    margin = tile_size(zoom) * TILE_BUFFER / TILE_EXTENT
+
+    x_range, y_range = tile_range(shapely.total_bounds(geometries), zoom)
+    n_tiles = 0
+    for x in x_range:
+        for y in y_range:
+            bounds = tile_bounds(zoom, x, y)
+            in_tile = tree.query(shapely.box(*bounds))
+            if len(in_tile) == 0:
+                continue
+            clipped = shapely.clip_by_rect(
+                geometries[in_tile], bounds[0] - margin, bounds[1] - margin, bounds[2] + margin, bounds[3] + margin)
+            keep = ~shapely.is_empty(clipped)
+            if not keep.any():
+                continue
+
+            tile_path = os.path.join(TILE_DIR, str(zoom), str(x), f'{y}.pbf')
+            os.makedirs(os.path.dirname(tile_path), exist_ok=True)
+            with open(tile_path, 'wb') as f:
+                f.write(encode_tile(codes[in_tile][keep], clipped[keep], bounds))
+            n_tiles += 1
+    return n_tiles
+
+
+def build_vector_tiles(force=False, shapefile_path=ref_store.LSOA_SHAPEFILE_PATH):
+    """
+    Build (or refresh) the LSOA vector tiles under static/lsoa_tiles.
+
+    Returns:
+    int: Number of tiles written (0 if they were up to date or there is no shapefile).
+    """
+    if not is_buildable():
+        raise ImportError('Building vector tiles needs the mapbox-vector-tile package (pip install mapbox-vector-tile).')
+    if not os.path.exists(shapefile_path) or not (force or is_stale(shapefile_path)):
+        return 0
+
+    selection = ref_store.region_selection(ref_store.read_region())
+    gdf_lsoa = geometry_store.read_lsoa_boundaries(shapefile_path, selection).to_crs(epsg=3857)
+    codes = gdf_lsoa[geometry_store.LSOA_CODE_COLUMN].to_numpy(dtype=object)
+    geometries = np.asarray(gdf_lsoa.geometry)
+
+    #start from an empty directory so tiles no longer covered by the shapefile are not left behind
+    shutil.rmtree(TILE_DIR, ignore_errors=True)
+    n_tiles = 0
+    for zoom in range(MIN_ZOOM, MAX_ZOOM + 1):
+        n_tiles += build_zoom_level(codes, geometries, zoom)
+
+    os.makedirs(TILE_DIR, exist_ok=True)
+    with open(version_path(), 'w') as f:
+        f.write(tile_version(shapefile_path))
+    return n_tiles
@@ -0,0 +1,93 @@
+"""
+Prepopulate the disk result cache (see pages/page_functions/disk_cache.py)
+with the population forecasts for common selections, so the first users
+after a deploy or a reference data update do not wait for them.
+
+For each level of geography, every area on its own and all the areas
+together (the pages' default selection) are forecast for each gender and
+standard age band, from the baseline year to every later projection year
+(the pages slice the forecast year out of these). This runs the same stage
+functions the pages use, so the results are found by the pages of every
+replica sharing the cache directory (FORECAST_DISK_CACHE_DIR).
+
+Usage:
+    python warm_result_cache.py
+    python warm_result_cache.py --geography district --age-bands 0-17 18-64 65-90 --baseline-year 2024
+"""
+import argparse
+import itertools
+import time
+
+from pages.page_functions import pop_data_ETL_functions as pop_ETL
+from pages.page_functions import reference_data as ref_data
+from pages.page_functions import result_cache
+
+#--geography option -> level of geography as named on the pages
+GEOGRAPHY_LEVELS = {
+    'district': 'District Authority or Place',
+    'utla': 'Upper Tier or Unitary Authority',
+}
+
+DEFAULT_AGE_BANDS = ['0-17', '18-64', '65-90', '0-90']
+DEFAULT_GENDERS = ['Persons', 'Males', 'Females']
+
+
+def age_band(text):
+    min_age, max_age = (int(age) for age in text.split('-'))
+    if min_age > max_age:
+        raise argparse.ArgumentTypeError(f'age band {text!r} should be min-max')
+    return min_age, max_age
+
+
+def warm_selection(geography_level, areas, min_age, max_age, gender, baseline_year):
+    """
+    Run the population stages of both pages for one selection, which caches their results.
+    """
+    params = (geography_level, areas, min_age, max_age, baseline_year, gender)
+    df_baseline = pop_ETL.lsoa_baseline_stage(gender, geography_level, areas, min_age, max_age)
+    pop_ETL.forecast_population_trajectory(*params)
+    pop_ETL.forecast_population_by_age_trajectory(*params)
+    pop_ETL.lsoa_trajectory_stage(df_baseline, *params)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Prepopulate the disk result cache with forecasts for common selections.')
+    parser.add_argument('--geography', choices=list(GEOGRAPHY_LEVELS) + ['all'], default='all',
+                        help='Level(s) of geography to warm (default: all).')
+    parser.add_argument('--age-bands', nargs='+', type=age_band, default=[age_band(band) for band in DEFAULT_AGE_BANDS],
+                        help=f"Age bands as min-max (default: {' '.join(DEFAULT_AGE_BANDS)}).")
+    parser.add_argument('--genders', nargs='+', choices=DEFAULT_GENDERS, default=DEFAULT_GENDERS, help='Genders (default: all).')
+    parser.add_argument('--baseline-year', type=int, default=None, help='Baseline year (default: the first projection year).')
+    args = parser.parse_args()
+
+    disk_cache = result_cache.forecast_results.backing
+    if disk_cache is None:
+        parser.error('the disk result cache is turned off (FORECAST_DISK_CACHE_MB is 0)')
+
+    geographies = list(GEOGRAPHY_LEVELS) if args.geography == 'all' else [args.geography]
+    start = time.perf_counter()
+    n_selections = 0
+    for geography in geographies:
+        geography_level = GEOGRAPHY_LEVELS[geography]
+        projections = ref_data.get_pop_projections(geography_level)
+        years = projections.available_years()
+        baseline_year = args.baseline_year if args.baseline_year is not None else years[0]
+        if baseline_year not in years:
+            parser.error(f'no population projections for {baseline_year} (available: {years[0]}-{years[-1]})')
+
+        areas = sorted(projections.locations)
+        area_selections = [[area] for area in areas] + [areas]
+        for selection, (min_age, max_age), gender in itertools.product(area_selections, args.age_bands, args.genders):
+            warm_selection(geography_level, selection, min_age, max_age, gender, baseline_year)
+            n_selections += 1
+        print(f'{geography}: {len(area_selections)} area selections x {len(args.age_bands)} age bands x {len(args.genders)} genders, '
+              f'baseline {baseline_year} to {years[-1]}')
+
+    metrics = disk_cache.metrics()
+    print(f"warmed {n_selections} selections in {time.perf_counter() - start:.1f}s: "
+          f"{metrics['writes']} results written, {metrics['hits']} already cached, "
+          f"{metrics['entries']} results ({metrics['size_mb']:.1f} MB) in {disk_cache.cache_dir}")
+
+
+if __name__ == '__main__':
+    main()